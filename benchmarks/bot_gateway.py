@@ -0,0 +1,72 @@
+"""Compare bot startup time and memory between the default and lean gateway profiles.
+
+Each profile logs in with the real bot token in a fresh process and reports the
+time until on_ready and the resident set size at that point.
+
+    python benchmarks/bot_gateway.py [--runs 3]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+def run_profile(lean: bool):
+    import discord
+    from config import DISCORD_TOKEN
+    from discord_app.gateway import gateway_options
+
+    started = time.perf_counter()
+    client = discord.Client(**gateway_options(lean))
+
+    @client.event
+    async def on_ready():
+        print(json.dumps({
+            'lean': lean,
+            'ready_seconds': round(time.perf_counter() - started, 3),
+            'rss_mb': round(current_rss_mb(), 1),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'cached_members': sum(len(guild.members) for guild in client.guilds),
+            'cached_messages': len(client.cached_messages),
+        }))
+        await client.close()
+
+    client.run(DISCORD_TOKEN, log_handler=None)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--profile', choices=['default', 'lean'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args.profile == 'lean')
+        return
+
+    for profile in ('default', 'lean'):
+        results = []
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, __file__, '--profile', profile],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        ready = sorted(r['ready_seconds'] for r in results)
+        rss = sorted(r['rss_mb'] for r in results)
+        print(f"{profile:>8}: ready {ready[len(ready) // 2]:.2f}s (median of {args.runs}), "
+              f"RSS {rss[len(rss) // 2]:.1f} MB, "
+              f"members cached {results[-1]['cached_members']}")
+
+if __name__ == '__main__':
+    main()
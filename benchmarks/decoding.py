@@ -0,0 +1,88 @@
+"""Compare full and reduced decoding of screenshots.
+
+For every image in a directory, times the full decode each task used to do
+against the reduced decode it does now: the black bar measurement, the
+vision model panel and the costume crop. The average decoded size stands in
+for peak memory, since Pillow holds the whole decoded image at once.
+
+    python benchmarks/decoding.py path/to/screenshots
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from celery_app.decoding import open_image, open_reduced, decode_region
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+def costume_box(img):
+    crop_dimension = math.floor(img.height * 0.32592)
+    crop_left = math.floor(img.width * 0.32308)
+    crop_top = math.floor(img.height * 0.28241)
+    return (crop_left, crop_top, crop_left + crop_dimension, crop_top + crop_dimension)
+
+def timed(decode):
+    """Time a decode; ``decode`` returns the image it decoded from, for its size."""
+    started = time.perf_counter()
+    img = decode()
+    return time.perf_counter() - started, img.width * img.height * len(img.getbands())
+
+def loaded(img, use):
+    use(img)
+    return img
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--costume-size', type=int, default=512)
+    args = parser.parse_args()
+
+    cases = {
+        'bars': (
+            lambda content: loaded(open_image(content), lambda img: img.convert('L')),
+            lambda content: loaded(open_reduced(content, (1024, 1), mode='L')[0], lambda img: img.convert('L')),
+        ),
+        'panel': (
+            lambda content: loaded(open_image(content), lambda img: img.load()),
+            lambda content: loaded(open_reduced(content, (1044, 835))[0], lambda img: img.load()),
+        ),
+        'costume': (
+            lambda content: loaded(open_image(content), lambda img: img.crop(costume_box(img))),
+            lambda content: loaded(open_image(content), lambda img: decode_region(img, costume_box(img), args.costume_size)),
+        ),
+    }
+    totals = {name: [0.0, 0.0, 0, 0] for name in cases}
+    count = 0
+    for name in sorted(os.listdir(args.directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(args.directory, name), 'rb') as f:
+            content = f.read()
+        count += 1
+        for case, (full, reduced) in cases.items():
+            full_seconds, full_bytes = timed(lambda: full(content))
+            reduced_seconds, reduced_bytes = timed(lambda: reduced(content))
+            total = totals[case]
+            total[0] += full_seconds
+            total[1] += reduced_seconds
+            total[2] += full_bytes
+            total[3] += reduced_bytes
+
+    if not count:
+        print(f"No images in {args.directory}")
+        return
+    print(f"{count} images")
+    for case, (full_seconds, reduced_seconds, full_bytes, reduced_bytes) in totals.items():
+        print(
+            f"{case:8} full {full_seconds / count * 1000:7.1f} ms  reduced {reduced_seconds / count * 1000:7.1f} ms  "
+            f"decoded {full_bytes / count / 2**20:6.1f} MiB -> {reduced_bytes / count / 2**20:6.1f} MiB"
+        )
+
+if __name__ == '__main__':
+    main()
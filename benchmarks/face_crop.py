@@ -0,0 +1,100 @@
+"""Compare local face detection with the GPT-4o crop for hero illustrations.
+
+Runs the cascade detector on every image in a directory and, with --llm, asks
+GPT-4o for its crop the way process_hero_illustration_task does. Reports the
+latency of each method, how often the detector was confident enough to be
+used, and the IoU between the two crops where both exist.
+
+    python benchmarks/face_crop.py path/to/illustrations [--llm]
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import time
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+def llm_crop(image_content, img):
+    from celery_app.llm_client import chat_completion
+    from celery_app.prompts.hero_illustration_prompt import illustration_prompt
+
+    data_url = 'data:image/png;base64,' + base64.b64encode(image_content).decode('utf-8')
+    payload = {
+        "model": "gpt-4o",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": illustration_prompt + f"{img.size[0]}x{img.size[1]} pixels."},
+                    {"type": "image_url", "image_url": {"url": data_url}},
+                ],
+            },
+        ],
+        "max_tokens": 1000,
+    }
+    result = chat_completion(payload, 'hero-illustrations')
+    return json.loads(result.content.strip('```json').strip('```'))
+
+def iou(a, b):
+    left, top = max(a['x'], b['x']), max(a['y'], b['y'])
+    right = min(a['x'] + a['width'], b['x'] + b['width'])
+    bottom = min(a['y'] + a['height'], b['y'] + b['height'])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = a['width'] * a['height'] + b['width'] * b['height'] - intersection
+    return intersection / union if union else 0.0
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--llm', action='store_true', help='also request the GPT-4o crop for comparison')
+    args = parser.parse_args()
+
+    from celery_app.face_detection import detect_face_crop
+
+    local_times, llm_times, overlaps = [], [], []
+    detected = total = 0
+    for name in sorted(os.listdir(args.directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        total += 1
+        with open(os.path.join(args.directory, name), 'rb') as f:
+            image_content = f.read()
+        img = Image.open(io.BytesIO(image_content))
+
+        started = time.perf_counter()
+        local = detect_face_crop(img)
+        local_times.append(time.perf_counter() - started)
+        detected += local is not None
+
+        remote = None
+        if args.llm:
+            started = time.perf_counter()
+            remote = llm_crop(image_content, img)
+            llm_times.append(time.perf_counter() - started)
+        if local and remote:
+            overlaps.append(iou(local, remote))
+        print(f"{name}: local {local} llm {remote}")
+
+    print(f"\n{total} images, detector confident on {detected}")
+    print(f"local: p50 {percentile(local_times, 0.5) * 1000:.0f} ms, p95 {percentile(local_times, 0.95) * 1000:.0f} ms")
+    if llm_times:
+        print(f"  llm: p50 {percentile(llm_times, 0.5):.2f} s, p95 {percentile(llm_times, 0.95):.2f} s")
+    if overlaps:
+        print(f"agreement: mean IoU {sum(overlaps) / len(overlaps):.2f}, "
+              f"{sum(o >= 0.5 for o in overlaps)}/{len(overlaps)} with IoU >= 0.5")
+
+if __name__ == '__main__':
+    main()
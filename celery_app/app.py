@@ -2,9 +2,9 @@
 
 import json
 import logging
-import boto3
 import threading
 from celery import Celery
+from kombu import Queue
 
 from celery_app.tasks.process_costume import process_costume_task
 from celery_app.tasks.process_illustration_costume import process_costume_illustration_task
@@ -17,7 +17,10 @@ from .tasks.process_hero_bio import process_hero_bio_task
 from .tasks.process_hero_stats import process_hero_stats_task
 from .tasks.process_weapon_information import process_weapon_information_task
 from .tasks.process_hero_review import process_hero_review_task
-from .utils import handle_expired_keys, redis_client, boto3_config
+from .tasks.batch_extraction import BATCHED_FOLDERS, queue_for_batch
+from .tasks.backfill import start_backfill, poll_backfill
+from .tasks.shadow_extraction import shadow_extract
+from .utils import handle_expired_keys, redis_client, get_s3_client
 from config import DEV_BROKER_URL, DEV_RESULT_BACKEND, AWS_S3_BUCKET
 
 bucket_name = AWS_S3_BUCKET
@@ -39,6 +42,21 @@ def make_celery():
         backend=DEV_RESULT_BACKEND,
     )
 
+    # CPU-bound image work goes to its own queue and prefork workers; everything
+    # else waits on I/O and stays on the default queue's high-concurrency workers
+    celery.conf.task_queues = (
+        Queue('celery'),
+        Queue('images'),
+    )
+    celery.conf.task_default_queue = 'celery'
+    celery.conf.task_routes = {
+        'celery_app.tasks.image_ops.*': {'queue': 'images'},
+        # Decodes every screenshot it submits
+        'celery_app.tasks.backfill.start_backfill': {'queue': 'images'},
+    }
+    # A long task shouldn't sit on prefetched image work another worker could do
+    celery.conf.worker_prefetch_multiplier = 1
+
     # Return the Celery instance
     return celery
 
@@ -133,11 +151,8 @@ def setup_periodic_tasks(sender, **kwargs):
 
 @celery.task
 def check_and_process_s3_images(folder):
-    global redis_client, bucket_name, boto3_config
+    s3_client = get_s3_client()
     try:
-        # Initialize S3 client using app.config variables
-        s3_client = boto3.client('s3', **boto3_config)
-
         # Check for images in the specified S3 bucket folder
         response = s3_client.list_objects_v2(
             Bucket=AWS_S3_BUCKET,
@@ -171,18 +186,14 @@ def check_and_process_s3_images(folder):
                     if len(file_name_parts) >= 2:
                         slug_name = file_name_parts[0]
                         # Call the appropriate task
-                        if folder == "hero-stories":
-                            process_hero_story_task.delay(key, folder, slug_name)
+                        if folder in BATCHED_FOLDERS:
+                            queue_for_batch(folder, key, slug_name)
                         elif folder == "hero-portraits":
                             region = file_name_parts[1]
                             process_hero_portrait_task.delay(key, folder, slug_name, region)
                         elif folder == "hero-illustrations":
                             region = file_name_parts[1]
                             process_hero_illustration_task.delay(key, folder, slug_name, region)
-                        elif folder == "hero-bios":                        
-                            process_hero_bio_task.delay(key, folder, slug_name)
-                        elif folder == "hero-stats":                        
-                            process_hero_stats_task.delay(key, folder, slug_name)
                         elif folder == "costumes":
                             costume_type = file_name_parts[0]
                             item_name = file_name_parts[1].replace('(dot)', '.')
@@ -0,0 +1,41 @@
+import io
+import math
+import logging
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+def open_image(source):
+    """Open an image from bytes or a path without decoding it yet."""
+    return Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+
+def open_reduced(source, min_size, mode=None):
+    """Open an image at the smallest size that's still at least ``min_size``.
+
+    JPEGs decode straight to 1/2, 1/4 or 1/8 scale when that's enough, which
+    skips most of the decode; other formats come back at full size. Returns
+    (img, scale), scale being the decoded width over the original width.
+    """
+    img = open_image(source)
+    width = img.width
+    if img.format == 'JPEG' and min_size:
+        img.draft(mode or img.mode, min_size)
+    return img, img.width / width
+
+def decode_region(img, box, min_size=0):
+    """Decode as little of an unloaded image as it takes to cut ``box`` out of it.
+
+    ``box`` is (left, top, right, bottom) in full resolution pixels. JPEGs
+    decode at the smallest draft scale that keeps the region's short side at
+    least ``min_size`` (so the crop comes back smaller when that's allowed).
+    Other formats decode in full, as Pillow has no public way to decode part
+    of them.
+    """
+    left, top, right, bottom = box
+    if img.format == 'JPEG' and min_size:
+        scale = min(1.0, min_size / min(right - left, bottom - top))
+        width = img.width
+        img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        scale = img.width / width
+        box = (math.floor(left * scale), math.floor(top * scale), math.floor(right * scale), math.floor(bottom * scale))
+    return img.crop(box)
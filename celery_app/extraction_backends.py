@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import time
+import difflib
+import logging
+from abc import ABC, abstractmethod
+from .llm_client import routed_completion, is_json
+from .preprocessing import crop_panel
+from .utils import redis_client
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+logger = logging.getLogger(__name__)
+
+def parse_task_map(value):
+    """Parse 'task-type=backend,task-type=backend' settings."""
+    mapping = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        task_type, _, backend = entry.partition('=')
+        mapping[task_type.strip()] = backend.strip()
+    return mapping
+
+# Which backend extracts each task type; anything unlisted uses OpenAI.
+# e.g. EXTRACTION_BACKENDS="hero-stories=tesseract"
+TASK_BACKENDS = parse_task_map(os.environ.get('EXTRACTION_BACKENDS', ''))
+# A second backend to run after the first for comparison only; its output is
+# logged against the real one and then discarded. It runs as its own task, on
+# the queue its backend belongs on, so it never holds up the primary.
+# e.g. EXTRACTION_SHADOW="hero-stories=tesseract,hero-bios=tesseract"
+SHADOW_BACKENDS = parse_task_map(os.environ.get('EXTRACTION_SHADOW', ''))
+
+# Bio fields and how they're labelled on the Hero Information panel
+BIO_LABELS = {
+    'age': 'Age',
+    'height': 'Height',
+    'weight': 'Weight',
+    'species': 'Species',
+    'role': 'Role',
+    'element': 'Element',
+}
+
+class ExtractionBackend(ABC):
+    """Turns a screenshot into the JSON text a task would get back from the model.
+
+    ``extract`` returns (content, source), where source names what produced
+    it, e.g. the route model, for per-route poll stats. ``queue`` is the Celery
+    queue the backend's work belongs on when it runs as a task of its own.
+    """
+
+    name = None
+    queue = 'celery'
+
+    @abstractmethod
+    def extract(self, task_type, payload, image_content):
+        """``payload`` is the chat request the task built."""
+
+class OpenAIBackend(ExtractionBackend):
+    name = 'openai'
+
+    def extract(self, task_type, payload, image_content):
+        result = routed_completion(payload, task_type, accept=is_json)
+        return result.content, result.route_model
+
+class TesseractBackend(ExtractionBackend):
+    """Local OCR for the text-heavy story and bio screens."""
+
+    name = 'tesseract'
+    # Decoding and OCR are CPU-bound
+    queue = 'images'
+
+    def extract(self, task_type, payload, image_content):
+        if pytesseract is None:
+            raise RuntimeError("pytesseract is not installed")
+        text = pytesseract.image_to_string(crop_panel(image_content, task_type).convert('L'))
+        if task_type == 'hero-stories':
+            return json.dumps({'story': ocr_paragraphs(text)}), self.name
+        if task_type == 'hero-bios':
+            return json.dumps(parse_bio(text)), self.name
+        raise ValueError(f"Tesseract can't extract {task_type}")
+
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend(), TesseractBackend())}
+
+def ocr_paragraphs(text):
+    """Rejoin lines wrapped by the panel width, keeping blank-line paragraph breaks."""
+    paragraphs = [' '.join(line.strip() for line in block.splitlines() if line.strip()) for block in re.split(r'\n\s*\n', text)]
+    return '<br /><br />'.join(paragraph for paragraph in paragraphs if paragraph)
+
+def parse_bio(text):
+    """Read labelled bio values, leaving anything not found empty like the model does."""
+    bio = {name: '' for name in list(BIO_LABELS) + ['rarity']}
+    for name, label in BIO_LABELS.items():
+        match = re.search(rf'^\s*{label}\s*[:\-]?\s*(.+?)\s*$', text, re.IGNORECASE | re.MULTILINE)
+        if match:
+            bio[name] = match.group(1)
+    digits = re.sub(r'\D', '', bio['age'])
+    bio['age'] = int(digits) if digits else 0
+    return bio
+
+def get_backend(task_type):
+    return BACKENDS[TASK_BACKENDS.get(task_type, 'openai')]
+
+def timed_extract(backend, task_type, payload, image_content):
+    started = time.monotonic()
+    content, source = backend.extract(task_type, payload, image_content)
+    return content, source, time.monotonic() - started
+
+def extract(task_type, payload, key=None, extracted=None):
+    """Extract a screenshot with the backend configured for its task type.
+
+    Backends that belong on the 'images' queue have already run while the
+    screenshot was prepared there, and ``extracted`` is their (content,
+    source, elapsed); only the model backend is called from here.
+    When a shadow backend is configured and the screenshot's S3 ``key`` is
+    given, the shadow is queued once the primary is done, to extract the same
+    screenshot and compare its output and timing with the primary's. Returns
+    (content, source) as the backend does.
+    """
+    backend = get_backend(task_type)
+    if extracted is None:
+        extracted = timed_extract(backend, task_type, payload, None)
+    content, source, elapsed = extracted
+    logger.info(f"Extracted {task_type} with {backend.name} in {elapsed:.2f}s")
+
+    shadow_name = SHADOW_BACKENDS.get(task_type)
+    if shadow_name and shadow_name != backend.name and key:
+        # Imported here since the task module imports this one
+        from .tasks.shadow_extraction import shadow_extract
+        try:
+            shadow_extract.apply_async(
+                (task_type, shadow_name, payload, key, backend.name, content, elapsed),
+                queue=BACKENDS[shadow_name].queue,
+            )
+        except Exception as e:
+            logger.warning(f"Could not queue shadow {shadow_name} extraction for {task_type}: {e}")
+    return content, source
+
+def normalise(content):
+    try:
+        return json.dumps(json.loads(content.strip('```json').strip('```')), indent=2, sort_keys=True)
+    except json.JSONDecodeError:
+        return content
+
+def compare_shadow(task_type, primary_name, content, elapsed, shadow_name, shadow_content, shadow_elapsed):
+    primary_text, shadow_text = normalise(content), normalise(shadow_content)
+    matched = primary_text == shadow_text
+    if matched:
+        logger.info(f"Shadow {shadow_name} matched {primary_name} for {task_type} ({shadow_elapsed:.2f}s vs {elapsed:.2f}s)")
+    else:
+        diff = '\n'.join(difflib.unified_diff(
+            primary_text.splitlines(), shadow_text.splitlines(), primary_name, shadow_name, lineterm='',
+        ))
+        logger.info(f"Shadow {shadow_name} differed from {primary_name} for {task_type} ({shadow_elapsed:.2f}s vs {elapsed:.2f}s):\n{diff}")
+
+    key = f"extraction_shadow:{task_type}:{shadow_name}"
+    pipe = redis_client.pipeline()
+    pipe.hincrby(key, 'runs', 1)
+    pipe.hincrby(key, 'matches', int(matched))
+    pipe.hincrbyfloat(key, f'{primary_name}_seconds', elapsed)
+    pipe.hincrbyfloat(key, f'{shadow_name}_seconds', shadow_elapsed)
+    pipe.execute()
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import logging
+import redis
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+# How long a model extraction is kept for reuse by automatic retries
+CACHE_TTL = int(os.environ.get('EXTRACTION_CACHE_TTL', 86400))
+
+def content_hash(image_content):
+    """Identify an image that has already been downloaded by a hash of its bytes."""
+    return hashlib.sha256(image_content).hexdigest()[:32]
+
+def prompt_hash(payload):
+    """Hash everything in the request except the model and the image URLs.
+
+    Image URLs are presigned links or inlined data that would only duplicate
+    the image itself, which is identified separately by its content hash.
+    """
+    messages = []
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, list):
+            content = [
+                {'type': 'image_url', 'detail': part['image_url'].get('detail')} if part.get('type') == 'image_url' else part
+                for part in content
+            ]
+        messages.append({**message, 'content': content})
+    request = {k: v for k, v in payload.items() if k not in ('model', 'messages')}
+    serialized = json.dumps({'messages': messages, 'request': request}, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:16]
+
+def cache_key(image_hash, task_type, payload):
+    return f"extraction:{task_type}:{image_hash}:{payload['model']}:{prompt_hash(payload)}"
+
+def get_extraction(image_hash, task_type, payload):
+    """Return the stored (content, source) for this image and request, or (None, None).
+
+    ``source`` is the model or backend that produced the content, so a poll on
+    a reused extraction is still credited to it.
+    """
+    try:
+        content, source = redis_client.hmget(cache_key(image_hash, task_type, payload), 'content', 'source')
+    except redis.exceptions.ResponseError:
+        # Stored as a plain string before sources were kept
+        return None, None
+    if content is None:
+        return None, None
+    logger.info(f"Reusing cached {task_type} extraction for image {image_hash}")
+    return content.decode('utf-8'), source.decode('utf-8') if source else None
+
+def store_extraction_at(key, content, source=None):
+    pipe = redis_client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={'content': content, **({'source': source} if source else {})})
+    pipe.expire(key, CACHE_TTL)
+    pipe.execute()
+
+def store_extraction(image_hash, task_type, payload, content, source=None):
+    store_extraction_at(cache_key(image_hash, task_type, payload), content, source)
+
+def invalidate_extractions(image_hash, task_type):
+    """Forget every stored extraction of an image, e.g. when a contributor asks for a retry."""
+    for cached_key in redis_client.scan_iter(match=f"extraction:{task_type}:{image_hash}:*"):
+        redis_client.delete(cached_key)
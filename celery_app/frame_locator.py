@@ -0,0 +1,175 @@
+"""Find the costume frame on the costume screen.
+
+The frame's position depends on the device: notches and tablet aspect ratios
+move it away from the fixed ratios the costume task started with. The frame's
+border is matched against a template by normalised cross-correlation, computed
+with FFTs on a small grayscale copy of the screenshot at a few candidate frame
+sizes. The art inside the frame changes with every costume, so only the border
+ring of the template takes part in the match.
+
+Screenshots of the same resolution share a layout, so the geometry found for
+one is cached in Redis under its resolution and reused without decoding
+until it expires, so a game update that moves the frame is picked up.
+
+The template is cut from a screenshot the fixed ratios crop correctly, or from
+an explicit box in full resolution pixels:
+
+    python -m celery_app.frame_locator build-template screenshot.png [left,top,size]
+"""
+import os
+import sys
+import json
+import math
+import logging
+import numpy as np
+from PIL import Image
+from .decoding import open_reduced
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_PATH = os.environ.get('COSTUME_FRAME_TEMPLATE', os.path.join(os.path.dirname(__file__), 'templates', 'costume_frame.png'))
+
+# Seconds a resolution's frame geometry is reused before it's located again
+GEOMETRY_TTL = int(os.environ.get('COSTUME_FRAME_TTL', 7 * 86400))
+# Matches scoring below this fall back to the fixed ratios
+MIN_SCORE = float(os.environ.get('COSTUME_FRAME_MIN_SCORE', 0.6))
+
+# Screenshots are matched at this height
+LOCATE_HEIGHT = 360
+# Side of the stored template
+TEMPLATE_SIZE = 96
+# Width of the border ring that's matched, as a fraction of the frame's side
+BORDER = 0.12
+
+# The fixed ratios: frame side and top as fractions of the height, left as a
+# fraction of the width
+FRAME_SIDE = 0.32592
+FRAME_LEFT = 0.32308
+FRAME_TOP = 0.28241
+# Frame sides tried, relative to FRAME_SIDE
+SCALES = [float(scale) for scale in os.environ.get('COSTUME_FRAME_SCALES', '0.85,0.925,1.0,1.075').split(',')]
+
+_template = None
+
+def fixed_box(width, height):
+    """The costume frame at the fixed ratios, as (left, top, right, bottom)."""
+    crop_dimension = math.floor(height * FRAME_SIDE)
+    crop_left = math.floor(width * FRAME_LEFT)
+    crop_top = math.floor(height * FRAME_TOP)
+    return (crop_left, crop_top, crop_left + crop_dimension, crop_top + crop_dimension)
+
+def load_template(path=TEMPLATE_PATH):
+    global _template
+    if _template is None:
+        if not os.path.exists(path):
+            logger.warning(f"No costume frame template at {path}, using the fixed ratios")
+            return None
+        _template = np.array(Image.open(path).convert('L'), dtype=np.float64)
+    return _template
+
+def ring_mask(side):
+    border = max(1, round(side * BORDER))
+    mask = np.ones((side, side))
+    mask[border:side - border, border:side - border] = 0
+    return mask
+
+def correlate(a, b, shape):
+    """Valid-mode cross-correlation of b over a, by FFT."""
+    fft_shape = (a.shape[0] + b.shape[0] - 1, a.shape[1] + b.shape[1] - 1)
+    full = np.fft.irfft2(np.fft.rfft2(a, fft_shape) * np.fft.rfft2(b[::-1, ::-1], fft_shape), fft_shape)
+    return full[b.shape[0] - 1:b.shape[0] - 1 + shape[0], b.shape[1] - 1:b.shape[1] - 1 + shape[1]]
+
+def match_template(image, template, mask):
+    """Masked normalised cross-correlation of ``template`` at every position in ``image``.
+
+    Returns (score, (top, left)) for the best match.
+    """
+    shape = (image.shape[0] - template.shape[0] + 1, image.shape[1] - template.shape[1] + 1)
+    if shape[0] < 1 or shape[1] < 1:
+        return -1.0, (0, 0)
+    count = mask.sum()
+    centred = (template - (template * mask).sum() / count) * mask
+    numerator = correlate(image, centred, shape)
+    window_sum = correlate(image, mask, shape)
+    window_squares = correlate(image ** 2, mask, shape)
+    variance = np.maximum(window_squares - window_sum ** 2 / count, 0)
+    scores = numerator / (np.sqrt(variance * (centred ** 2).sum()) + 1e-6)
+    top, left = np.unravel_index(np.argmax(scores), scores.shape)
+    return float(scores[top, left]), (int(top), int(left))
+
+def locate_frame(image_content):
+    """Find the costume frame, returning (left, top, right, bottom) in full resolution pixels.
+
+    Returns None when there's no template or no match scores MIN_SCORE.
+    """
+    template = load_template()
+    if template is None:
+        return None
+    img, scale = open_reduced(image_content, (1, LOCATE_HEIGHT), mode='L')
+    full_width, full_height = round(img.width / scale), round(img.height / scale)
+    img = img.convert('L')
+    img = img.resize((max(1, round(img.width * LOCATE_HEIGHT / img.height)), LOCATE_HEIGHT), Image.BILINEAR)
+    image = np.asarray(img, dtype=np.float64)
+
+    best_score, best = -1.0, None
+    for frame_scale in SCALES:
+        side = round(LOCATE_HEIGHT * FRAME_SIDE * frame_scale)
+        scaled = np.asarray(Image.fromarray(template).resize((side, side), Image.BILINEAR), dtype=np.float64)
+        score, (top, left) = match_template(image, scaled, ring_mask(side))
+        if score > best_score:
+            best_score, best = score, (left, top, side)
+    if best_score < MIN_SCORE:
+        logger.info(f"Costume frame not found (best score {best_score:.2f})")
+        return None
+
+    left, top, side = best
+    factor = full_height / LOCATE_HEIGHT
+    crop_left, crop_top, crop_dimension = round(left * factor), round(top * factor), round(side * factor)
+    logger.info(f"Found costume frame at {crop_left},{crop_top} ({crop_dimension}px, score {best_score:.2f}) in {full_width}x{full_height}")
+    return (crop_left, crop_top, crop_left + crop_dimension, crop_top + crop_dimension)
+
+def geometry_key(width, height):
+    return f"costume_frame:{width}x{height}"
+
+def costume_frame_box(image_content, width, height, use_cache=True):
+    """The costume frame's box for a screenshot, from the cache for its resolution if possible.
+
+    Falls back to the fixed ratios when the frame can't be found.
+    """
+    key = geometry_key(width, height)
+    if use_cache:
+        cached = redis_client.get(key)
+        if cached:
+            return tuple(json.loads(cached))
+    try:
+        box = locate_frame(image_content)
+    except Exception as e:
+        logger.warning(f"Costume frame locator failed, using fixed ratios: {e}")
+        box = None
+    if box is None:
+        return fixed_box(width, height)
+    redis_client.set(key, json.dumps(box), ex=GEOMETRY_TTL)
+    return box
+
+def forget_geometry(width, height):
+    """Drop the cached geometry for a resolution, after a contributor rejects its crop."""
+    redis_client.delete(geometry_key(width, height))
+
+def build_template(screenshot_path, box=None, output_path=TEMPLATE_PATH):
+    img = Image.open(screenshot_path)
+    if box:
+        left, top, side = (int(value) for value in box.split(','))
+        box = (left, top, left + side, top + side)
+    else:
+        box = fixed_box(img.width, img.height)
+    template = img.crop(box).convert('L').resize((TEMPLATE_SIZE, TEMPLATE_SIZE), Image.LANCZOS)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    template.save(output_path)
+    print(f"Saved {TEMPLATE_SIZE}x{TEMPLATE_SIZE} template from {box} to {output_path}")
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != 'build-template':
+        print(__doc__)
+        sys.exit(1)
+    build_template(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None)
@@ -0,0 +1,73 @@
+"""A perceptual hash index of the art committed to WordPress.
+
+Contributors often resubmit a slightly different capture of art that's
+already been approved. Every image committed for a hero or item is indexed by
+its difference hash (dHash), and an upload within DUPLICATE_DISTANCE bits of
+one already committed for the same subject is dropped before it's cropped,
+polled or uploaded.
+"""
+import os
+import json
+import time
+import logging
+import numpy as np
+from PIL import Image
+from .decoding import open_reduced
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Hashes differing in at most this many of their 64 bits count as the same art
+DUPLICATE_DISTANCE = int(os.environ.get('IMAGE_DUPLICATE_DISTANCE', 6))
+
+HASH_SIZE = 8
+# Edges darker than this are black bars or letterboxing, not art
+DARK_EDGE = 50
+
+def index_key(folder, subject):
+    return f"image_index:{folder}:{subject}"
+
+def trim_dark_edges(arr):
+    """Drop the black rows and columns around a grayscale image."""
+    columns = np.flatnonzero(arr.max(axis=0) >= DARK_EDGE)
+    rows = np.flatnonzero(arr.max(axis=1) >= DARK_EDGE)
+    if not len(columns) or not len(rows):
+        return arr
+    return arr[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+
+def dhash(image_content):
+    """64 bit difference hash of an image, from a reduced decode with the black bars left out."""
+    img, _ = open_reduced(image_content, (HASH_SIZE * 16, HASH_SIZE * 16), mode='L')
+    arr = trim_dark_edges(np.asarray(img.convert('L')))
+    small = np.asarray(Image.fromarray(arr).resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    value = 0
+    for bit in (small[:, 1:] > small[:, :-1]).flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def find_duplicate(folder, subject, image_hash):
+    """The S3 key of committed art for this subject that the hash matches, or None."""
+    if DUPLICATE_DISTANCE < 0:
+        return None
+    try:
+        entries = redis_client.hgetall(index_key(folder, subject))
+    except Exception as e:
+        logger.warning(f"Could not read the image index for {folder} {subject}: {e}")
+        return None
+    for stored_hash, entry in entries.items():
+        distance = hamming(image_hash, int(stored_hash, 16))
+        if distance <= DUPLICATE_DISTANCE:
+            entry = json.loads(entry)
+            logger.info(f"Matched committed {folder} art for {subject} ({entry['key']}) at distance {distance}")
+            return entry['key']
+    return None
+
+def record_image(folder, subject, image_hash, key):
+    """Index art once it's been committed to WordPress."""
+    try:
+        redis_client.hset(index_key(folder, subject), f"{image_hash:016x}", json.dumps({'key': key, 'committed_at': int(time.time())}))
+    except Exception as e:
+        logger.warning(f"Could not index {key}: {e}")
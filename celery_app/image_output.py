@@ -0,0 +1,193 @@
+import io
+import os
+import base64
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'AVIF': 'image/avif'}
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'AVIF': 'avif'}
+
+def parse_settings(value):
+    """Parse 'name=value,name=value' encoder settings into ints."""
+    settings = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, setting = entry.partition('=')
+        settings[name.strip()] = int(setting)
+    return settings
+
+# JPEG encoder settings for each place an image goes. Subsampling is PIL's
+# 0 (4:4:4), 1 (4:2:2) or 2 (4:2:0). Discord polls use the WordPress settings
+# unless given their own, in which case the image is encoded once for each.
+# e.g. IMAGE_OUTPUT_DISCORD="quality=80,progressive=0,subsampling=2"
+WORDPRESS_JPEG = {'quality': 92, 'progressive': 1, 'optimize': 1, 'subsampling': 0}
+WORDPRESS_JPEG.update(parse_settings(os.environ.get('IMAGE_OUTPUT_WORDPRESS', '')))
+DISCORD_JPEG = {**WORDPRESS_JPEG, **parse_settings(os.environ.get('IMAGE_OUTPUT_DISCORD', ''))}
+
+OUTPUT_SETTINGS = {
+    'wordpress': WORDPRESS_JPEG,
+    'discord': DISCORD_JPEG,
+}
+
+# Pillow writes progressive and optimized JPEGs in one pass, into a buffer of
+# a byte per pixel (or ImageFile.MAXBLOCK, if larger). Busy art at high quality
+# can need more, and the encoder then stops with this error
+BUFFER_OVERRUN = 'broken data stream'
+
+def save_jpeg(img, fp, settings):
+    """Save as JPEG, falling back to a baseline encode if Pillow's buffer overruns."""
+    rgb = img.convert('RGB')
+    try:
+        rgb.save(fp, format='JPEG', **settings)
+    except OSError as e:
+        if not (settings.get('progressive') or settings.get('optimize')) or BUFFER_OVERRUN not in str(e):
+            raise
+        logger.info(f"{img.width}x{img.height} image overran the JPEG encoder's buffer, re-encoding as a baseline JPEG")
+        fp.seek(0)
+        fp.truncate()
+        rgb.save(fp, format='JPEG', **{**settings, 'progressive': 0, 'optimize': 0})
+
+# Modern formats uploaded alongside the original, and their encoder settings.
+# e.g. IMAGE_OUTPUT_FORMATS="WEBP,AVIF"
+MODERN_FORMATS = [name.strip().upper() for name in os.environ.get('IMAGE_OUTPUT_FORMATS', 'WEBP').split(',') if name.strip()]
+FORMAT_SETTINGS = {
+    'WEBP': {'quality': 85, 'method': 4, **parse_settings(os.environ.get('IMAGE_OUTPUT_WEBP', ''))},
+    'AVIF': {'quality': 60, 'speed': 6, **parse_settings(os.environ.get('IMAGE_OUTPUT_AVIF', ''))},
+}
+
+def parse_sizes(value):
+    """Parse 'name=WxH' sizes, with a trailing 'c' for a hard crop as WordPress does."""
+    sizes = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, size = entry.partition('=')
+        crop = size.endswith('c')
+        width, _, height = size.rstrip('c').partition('x')
+        sizes[name.strip()] = (int(width), int(height), crop)
+    return sizes
+
+# The WordPress image sizes the site uses, generated here so the WordPress
+# host doesn't have to. THUMBNAIL is what hero_query asks for.
+DERIVATIVE_SIZES = parse_sizes(os.environ.get('IMAGE_DERIVATIVE_SIZES', 'thumbnail=150x150c,medium=300x300'))
+
+class EncodedImage:
+    """An image encoded once and shared by everything that needs its bytes.
+
+    The base64 for the Discord poll, the WordPress upload stream and the
+    content hash all read the same buffer rather than saving the image again.
+    """
+
+    def __init__(self, data, image_format):
+        self.data = data
+        self.format = image_format
+        self._sha256 = None
+
+    @classmethod
+    def encode(cls, img, image_format='JPEG', destination='wordpress'):
+        buffer = io.BytesIO()
+        if image_format == 'JPEG':
+            save_jpeg(img, buffer, OUTPUT_SETTINGS[destination])
+        elif image_format in FORMAT_SETTINGS:
+            img.save(buffer, format=image_format, **FORMAT_SETTINGS[image_format])
+        else:
+            img.save(buffer, format=image_format)
+        return cls(buffer.getvalue(), image_format)
+
+    @classmethod
+    def encode_for(cls, img, image_format='JPEG'):
+        """Encode for WordPress and Discord, only twice if their settings differ."""
+        wordpress = cls.encode(img, image_format, 'wordpress')
+        if image_format != 'JPEG' or DISCORD_JPEG == WORDPRESS_JPEG:
+            return wordpress, wordpress
+        return wordpress, cls.encode(img, image_format, 'discord')
+
+    @classmethod
+    def from_upload(cls, img, image_content, image_format='PNG'):
+        """Reuse the uploaded bytes as they are when they're already in the wanted format."""
+        if img.format == image_format:
+            return cls(image_content, image_format)
+        logger.info(f"Re-encoding {img.format} upload as {image_format}")
+        return cls.encode(img, image_format)
+
+    def view(self):
+        return memoryview(self.data)
+
+    def base64(self):
+        return base64.b64encode(self.view()).decode('utf-8')
+
+    def stream(self):
+        # BytesIO shares the bytes until written to, so this doesn't copy them
+        return io.BytesIO(self.data)
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.view()).hexdigest()
+        return self._sha256
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.format]
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    def filename(self, name):
+        return f"{name}.{self.extension}"
+
+    def upload(self, name):
+        """A (filename, stream, mime type) tuple for a requests multipart upload."""
+        return (self.filename(name), self.stream(), self.mime_type)
+
+def available_formats():
+    """The configured modern formats this Pillow build can write."""
+    from PIL import features
+    formats = []
+    for image_format in MODERN_FORMATS:
+        try:
+            supported = features.check(image_format.lower())
+        except ValueError:
+            # Pillow before 11.2 doesn't know AVIF at all
+            supported = False
+        if supported:
+            formats.append(image_format)
+        else:
+            logger.warning(f"Pillow can't write {image_format}, skipping it")
+    return formats
+
+def resize_to(img, width, height, crop):
+    from PIL import Image, ImageOps
+    if crop:
+        return ImageOps.fit(img, (width, height), Image.LANCZOS)
+    resized = img.copy()
+    resized.thumbnail((width, height), Image.LANCZOS)
+    return resized
+
+def encode_derivatives(img, image_format):
+    """Modern format copies and the site's smaller sizes, all from the one decoded image.
+
+    Keys are the multipart field names WordPress receives them under, e.g.
+    'image_webp', 'thumbnail' and 'thumbnail_webp'. Sizes the image is
+    already smaller than are left out, as WordPress does.
+    """
+    formats = available_formats()
+    derivatives = {f"image_{name.lower()}": EncodedImage.encode(img, name) for name in formats}
+    for size_name, (width, height, crop) in DERIVATIVE_SIZES.items():
+        # A 0 leaves that side unconstrained, as in WordPress
+        width, height = width or img.width, height or img.height
+        if img.width <= width and img.height <= height:
+            continue
+        resized = resize_to(img, width, height, crop)
+        derivatives[size_name] = EncodedImage.encode(resized, image_format)
+        for name in formats:
+            derivatives[f"{size_name}_{name.lower()}"] = EncodedImage.encode(resized, name)
+    return derivatives
+
+def upload_files(encoded, derivatives, name):
+    """The multipart files for a WordPress update: the image itself and its derivatives."""
+    files = {'image': encoded.upload(name)}
+    for field, derivative in derivatives.items():
+        size_name = field.removesuffix(f"_{derivative.extension}")
+        files[field] = derivative.upload(name if size_name == 'image' else f"{name}-{size_name}")
+    return files
@@ -0,0 +1,476 @@
+import os
+import time
+import json
+import random
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import requests
+from requests.adapters import HTTPAdapter
+from config import OPENAI_API_KEY
+from . import rate_limiter, model_routing
+from .schema import validate, invalid_fields, sub_schema, response_format, parse_json
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+CHAT_COMPLETIONS_URL = OPENAI_BASE_URL + '/chat/completions'
+
+# Seconds to establish a connection, and the longest we wait for a response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+# Total time a task may spend on LLM calls, including retries and backoff
+DEFAULT_DEADLINE = 300
+TASK_DEADLINES = {
+    'hero-review': 180,
+}
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1
+BACKOFF_CAP = 30
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Longest wait for rate limit budget that is slept through inside the worker;
+# anything longer is handed back to Celery as a countdown
+MAX_INLINE_WAIT = 2
+
+# Follow-up calls made to fix fields that don't match the response schema
+MAX_REPAIR_ROUNDS = 2
+
+# Connections kept alive per pooled session
+POOL_SIZE = 4
+
+# Hedging: when a call is slower than its task type's recent p90 latency, send
+# a duplicate (to LLM_HEDGE_MODEL, or the same model) and take the first
+# acceptable answer. Off unless LLM_HEDGING is set.
+HEDGING_ENABLED = os.environ.get('LLM_HEDGING', '').lower() in ('1', 'true', 'yes')
+HEDGE_MODEL = os.environ.get('LLM_HEDGE_MODEL')
+# Recent latencies kept per task type, and how many are needed before hedging
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+# Never hedge sooner than this, however fast the task type usually is
+MIN_HEDGE_DELAY = 2
+# How long a worker reuses the p90 it read from Redis
+P90_REFRESH = 60
+# Duplicate requests a worker will have in flight at once; a call that's due
+# a hedge when they're all busy just waits for its original
+HEDGE_WORKERS = int(os.environ.get('LLM_HEDGE_WORKERS', 8))
+
+_sessions = queue.LifoQueue()
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+_p90_cache = {}
+
+class LLMError(Exception):
+    pass
+
+class LLMDeadlineExceeded(LLMError):
+    pass
+
+class RateLimited(LLMError):
+    """Raised when the shared budget has no room; retry the task after ``retry_after`` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class InvalidExtraction(LLMError):
+    """Raised when the model's output still doesn't match its schema after repair."""
+
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.errors = errors
+
+@dataclass
+class LLMResult:
+    content: str
+    model: str
+    task_type: str
+    latency: float
+    attempts: int
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    route_model: str = ''
+    raw: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+def new_session():
+    session = requests.Session()
+    # Retries are handled below so they can respect the task deadline
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {OPENAI_API_KEY}"
+    })
+    return session
+
+@contextmanager
+def pooled_session():
+    """Borrow a keep-alive session for one call, creating one if none are free.
+
+    A session isn't safe to share between concurrent calls, but a per-thread
+    session is lost with every task under the gevent pool, where each task
+    runs in a new greenlet. Pooled sessions keep their connections warm across
+    tasks with either pool.
+    """
+    try:
+        session = _sessions.get_nowait()
+    except queue.Empty:
+        session = new_session()
+    try:
+        yield session
+    finally:
+        _sessions.put(session)
+
+def task_deadline(task_type):
+    """Return the monotonic time by which all LLM calls for this task must finish."""
+    return time.monotonic() + TASK_DEADLINES.get(task_type, DEFAULT_DEADLINE)
+
+def parse_retry_after(headers):
+    """Read the server's requested delay in seconds, if it sent one."""
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return None
+
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        # Honour the server's delay, with a little jitter so workers don't retry in lockstep
+        return retry_after + random.uniform(0, 1)
+    # Full jitter exponential backoff
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def chat_completion(payload, task_type, deadline=None, accept=None):
+    """Send a chat completion request and return an LLMResult.
+
+    With hedging enabled the request may be sent twice; ``accept`` decides
+    whether an answer is good enough to win (see hedged_completion).
+    """
+    if deadline is None:
+        deadline = task_deadline(task_type)
+    if HEDGING_ENABLED:
+        return hedged_completion(payload, task_type, deadline, accept)
+    return send_with_retries(payload, task_type, deadline)
+
+def send_with_retries(payload, task_type, deadline, max_inline_wait=MAX_INLINE_WAIT):
+    """Send one chat completion request, retrying until it succeeds or the deadline passes.
+
+    Every attempt first takes its share of the cluster-wide rate limit budget;
+    when the budget is exhausted for longer than MAX_INLINE_WAIT, RateLimited is
+    raised so the task can be re-queued. Connection errors, timeouts and
+    retryable HTTP statuses are retried with jittered backoff for as long as the
+    deadline allows. Other HTTP errors are raised immediately.
+    """
+    model = payload['model']
+    estimated_tokens = rate_limiter.estimate_tokens(payload)
+    started = time.monotonic()
+    attempt = 0
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= CONNECT_TIMEOUT:
+            raise LLMDeadlineExceeded(f"No time left for {task_type} LLM call after {attempt} attempts")
+
+        wait = rate_limiter.acquire(model, estimated_tokens)
+        if wait > 0:
+            if wait > max_inline_wait or time.monotonic() + wait + CONNECT_TIMEOUT >= deadline:
+                raise RateLimited(f"No {model} budget for {task_type} for {wait:.1f}s", retry_after=wait)
+            time.sleep(wait)
+            continue
+
+        attempt += 1
+        retry_after = None
+        response = None
+        try:
+            # Held only for the request itself, not through backoff sleeps
+            with pooled_session() as session:
+                sent = time.monotonic()
+                response = session.post(
+                    CHAT_COMPLETIONS_URL,
+                    json=payload,
+                    timeout=(CONNECT_TIMEOUT, min(READ_TIMEOUT, remaining)),
+                )
+                # This request alone, without earlier attempts, backoff or rate limit waits
+                request_time = time.monotonic() - sent
+            if response.status_code not in RETRYABLE_STATUSES:
+                if not response.ok:
+                    logger.error(f"HTTP error occurred: {response.status_code}")
+                    logger.error(f"Response content: {response.text}")
+                response.raise_for_status()
+                result = build_result(response.json(), task_type, time.monotonic() - started, attempt)
+                rate_limiter.reconcile(model, estimated_tokens, result.total_tokens)
+                record_latency(task_type, request_time)
+                return result
+            retry_after = parse_retry_after(response.headers)
+            error = requests.exceptions.HTTPError(f"{response.status_code} from OpenAI", response=response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+
+        if attempt >= MAX_ATTEMPTS:
+            logger.error("Max retries exceeded")
+            raise error
+
+        delay = backoff_delay(attempt, retry_after)
+        if response is not None and response.status_code == 429:
+            # Hold back every worker, not just this one, until OpenAI has room again
+            rate_limiter.cool_down(model, delay)
+            if delay > max_inline_wait:
+                raise RateLimited(f"OpenAI rate limited {task_type} for {delay:.1f}s", retry_after=delay) from error
+        if time.monotonic() + delay + CONNECT_TIMEOUT >= deadline:
+            raise LLMDeadlineExceeded(f"Retrying {task_type} LLM call in {delay:.1f}s would exceed its deadline") from error
+
+        logger.warning(f"LLM call for {task_type} failed ({error}). Retrying in {delay:.1f} seconds.")
+        time.sleep(delay)
+
+def record_latency(task_type, latency):
+    key = f"llm_latency:{task_type}"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.lpush(key, round(latency, 3))
+        pipe.ltrim(key, 0, LATENCY_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record LLM latency for {task_type}: {e}")
+
+def latency_p90(task_type):
+    """The 90th percentile of recent call latencies for a task type, or None if too few are known or Redis can't be read."""
+    cached = _p90_cache.get(task_type)
+    if cached and time.monotonic() - cached[1] < P90_REFRESH:
+        return cached[0]
+    try:
+        samples = sorted(float(value) for value in redis_client.lrange(f"llm_latency:{task_type}", 0, -1))
+    except Exception as e:
+        logger.warning(f"Could not read LLM latencies for {task_type}: {e}")
+        samples = []
+    p90 = samples[int(len(samples) * 0.9)] if len(samples) >= MIN_LATENCY_SAMPLES else None
+    _p90_cache[task_type] = (p90, time.monotonic())
+    return p90
+
+def run_in_thread(fn, *args):
+    """Start ``fn`` on a thread of its own, returning a Future for its result."""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def hedged_completion(payload, task_type, deadline, accept=None):
+    """Send a request, and a duplicate if the first is slower than the task type's p90.
+
+    The first answer that ``accept`` approves wins; if neither is approved the
+    first to arrive is returned. The duplicate is only sent when rate limit
+    budget and a hedge slot are available right away. The slower request
+    can't be interrupted mid-read, so it is abandoned and its answer discarded.
+    """
+    p90 = latency_p90(task_type)
+    if p90 is None:
+        return send_with_retries(payload, task_type, deadline)
+
+    # The original starts at once on its own thread, so the hedge delay times
+    # the call itself and the calling thread is free to take whichever answer
+    # wins. Only duplicates go through the executor.
+    primary = run_in_thread(send_with_retries, payload, task_type, deadline)
+    done, _ = wait([primary], timeout=max(MIN_HEDGE_DELAY, p90))
+    if done:
+        return primary.result()
+    if not _hedge_slots.acquire(blocking=False):
+        logger.info(f"{task_type} call exceeded p90 of {p90:.1f}s, but every hedge slot is busy")
+        return primary.result()
+
+    hedge_payload = {**payload, 'model': HEDGE_MODEL or payload['model']}
+    logger.info(f"{task_type} call exceeded p90 of {p90:.1f}s, hedging with {hedge_payload['model']}")
+    hedge = _hedge_executor.submit(send_with_retries, hedge_payload, task_type, deadline, 0)
+    hedge.add_done_callback(lambda _: _hedge_slots.release())
+    redis_client.hincrby(f"llm_hedges:{task_type}", 'sent', 1)
+
+    pending = {primary, hedge}
+    fallback = None
+    errors = {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                if future is hedge and isinstance(e, RateLimited):
+                    # No budget for a duplicate, so it's down to the original
+                    logger.info(f"No budget to hedge {task_type}")
+                errors[future] = e
+                continue
+            if accept is None or accept(result):
+                if future is hedge:
+                    redis_client.hincrby(f"llm_hedges:{task_type}", 'won', 1)
+                return result
+            fallback = fallback or result
+    if fallback is not None:
+        return fallback
+    raise errors.get(primary) or errors[hedge]
+
+def build_result(response_json, task_type, latency, attempts):
+    usage = response_json.get('usage') or {}
+    prompt_details = usage.get('prompt_tokens_details') or {}
+    result = LLMResult(
+        content=response_json['choices'][0]['message']['content'],
+        model=response_json.get('model', ''),
+        task_type=task_type,
+        latency=latency,
+        attempts=attempts,
+        prompt_tokens=usage.get('prompt_tokens', 0),
+        completion_tokens=usage.get('completion_tokens', 0),
+        cached_tokens=prompt_details.get('cached_tokens', 0),
+        raw=response_json,
+    )
+    logger.info(
+        f"LLM call for {task_type} took {latency:.2f}s over {attempts} attempt(s): "
+        f"{result.prompt_tokens} prompt tokens ({result.cached_tokens} cached), {result.completion_tokens} completion tokens"
+    )
+    record_usage(result)
+    return result
+
+def record_usage(result):
+    """Accumulate token usage per task type, so the prompt cache hit rate can be tracked over time."""
+    key = f"llm_usage:{result.task_type}"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hincrby(key, 'calls', 1)
+        pipe.hincrby(key, 'prompt_tokens', result.prompt_tokens)
+        pipe.hincrby(key, 'cached_tokens', result.cached_tokens)
+        pipe.hincrby(key, 'completion_tokens', result.completion_tokens)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record LLM usage for {result.task_type}: {e}")
+
+def check_content(content, schema):
+    """Parse and validate model output, returning (data, errors)."""
+    try:
+        data = parse_json(content)
+    except json.JSONDecodeError as e:
+        return None, [('', f"not valid JSON: {e}")]
+    return data, validate(data, schema)
+
+def repair_payload(payload, content, errors, fields, schema):
+    """A follow-up request asking the model to resend only ``fields``."""
+    problems = '\n'.join(f"- {path or 'response'}: {message}" for path, message in errors)
+    name = payload.get('response_format', {}).get('json_schema', {}).get('name', 'extraction')
+    return {
+        **payload,
+        'messages': payload['messages'] + [
+            {'role': 'assistant', 'content': content},
+            {
+                'role': 'user',
+                'content': f"These parts of your response were missing or invalid:\n{problems}\n"
+                           f"Respond with corrected values for only these fields: {', '.join(fields)}.",
+            },
+        ],
+        'response_format': response_format(f"{name}_repair", sub_schema(schema, fields)),
+    }
+
+def repair_fields(payload, task_type, schema, content, deadline):
+    """Parse and validate ``content``, re-asking ``payload``'s model for any invalid fields.
+
+    Fields that are missing or don't match the schema are re-asked in small
+    follow-up calls and merged into the rest of the response, rather than
+    repeating the whole extraction. Raises InvalidExtraction if the output is
+    still invalid after MAX_REPAIR_ROUNDS.
+    """
+    data, errors = check_content(content, schema)
+
+    for repair_round in range(MAX_REPAIR_ROUNDS):
+        if not errors:
+            return data
+        fields = invalid_fields(errors) if isinstance(data, dict) else list(schema['properties'])
+        logger.warning(f"{task_type} response had invalid fields {fields}, asking again (round {repair_round + 1})")
+        repair = repair_payload(payload, content, errors, fields, schema)
+        content = chat_completion(repair, task_type, deadline).content
+        patch, _ = check_content(content, sub_schema(schema, fields))
+        if isinstance(patch, dict):
+            patch = {name: value for name, value in patch.items() if name in fields}
+            data = {**data, **patch} if isinstance(data, dict) else patch
+        errors = validate(data, schema) if data is not None else errors
+
+    if errors:
+        raise InvalidExtraction(f"{task_type} response still invalid after {MAX_REPAIR_ROUNDS} repair rounds", errors)
+    return data
+
+def structured_completion(payload, task_type, schema, content=None, deadline=None):
+    """Return the model's output for ``payload`` parsed and validated against ``schema``.
+
+    ``content`` is earlier output to check instead of making the first call,
+    such as a cached extraction. The request goes through the task type's
+    model route: invalid fields are first repaired on the same model, and if
+    that fails the whole extraction is promoted to the next model. Returns
+    (data, model), where model is None when ``content`` was valid as given.
+    """
+    if deadline is None:
+        deadline = task_deadline(task_type)
+    accept = lambda result: not check_content(result.content, schema)[1]
+    if content is not None:
+        data, errors = check_content(content, schema)
+        if not errors:
+            return data, None
+
+    models = model_routing.route_models(task_type)
+    for index, model in enumerate(models):
+        routed_payload = {**payload, 'model': model}
+        if content is None:
+            result = chat_completion(routed_payload, task_type, deadline, accept=accept)
+            model_routing.record_call(task_type, model, result, accept(result))
+            content = result.content
+        try:
+            return repair_fields(routed_payload, task_type, schema, content, deadline), model
+        except InvalidExtraction:
+            if index == len(models) - 1:
+                raise
+            logger.warning(f"{model} could not produce a valid {task_type} extraction, promoting to {models[index + 1]}")
+            content = None
+
+def routed_completion(payload, task_type, accept=None, deadline=None):
+    """Send a request through the task type's model route and return an LLMResult.
+
+    Starts on the route's cheapest model and promotes to the next one whenever
+    ``accept`` rejects the answer; the last model's answer is returned as is.
+    The result's ``route_model`` is the route model that produced it.
+    """
+    if deadline is None:
+        deadline = task_deadline(task_type)
+    models = model_routing.route_models(task_type)
+    for index, model in enumerate(models):
+        result = chat_completion({**payload, 'model': model}, task_type, deadline, accept=accept)
+        result.route_model = model
+        accepted = accept is None or accept(result)
+        model_routing.record_call(task_type, model, result, accepted)
+        if accepted or index == len(models) - 1:
+            return result
+        logger.warning(f"{model} answer for {task_type} failed validation, promoting to {models[index + 1]}")
+
+def is_json(result):
+    try:
+        parse_json(result.content)
+        return True
+    except json.JSONDecodeError:
+        return False
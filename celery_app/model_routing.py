@@ -0,0 +1,91 @@
+import os
+import json
+import logging
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Models for each task type. Calls start on 'fast' when a route has one, else
+# 'primary', and are promoted one step at a time to 'primary' and then
+# 'fallback' when the answer fails validation. Override with MODEL_ROUTES, a
+# JSON object of the same shape; task types it leaves out keep these.
+DEFAULT_ROUTE = {'fast': None, 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'}
+ROUTES = {
+    'hero-stats': {'fast': None, 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'},
+    'hero-bios': {'fast': 'gpt-4o-mini', 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'},
+    'hero-stories': {'fast': 'gpt-4o-mini', 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'},
+    'hero-illustrations': {'fast': None, 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'},
+    'hero-review': {'fast': 'gpt-4o-mini', 'primary': 'gpt-4o', 'fallback': None},
+    'weapon-information': {'fast': None, 'primary': 'gpt-4o', 'fallback': 'gpt-4.1'},
+}
+ROUTES.update(json.loads(os.environ.get('MODEL_ROUTES', '{}')))
+
+# USD per million input and output tokens, for cost tracking
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4.1': (2.00, 8.00),
+}
+
+def route_models(task_type):
+    """The models to try for a task type, cheapest first, without repeats."""
+    route = ROUTES.get(task_type, DEFAULT_ROUTE)
+    models = []
+    for tier in ('fast', 'primary', 'fallback'):
+        model = route.get(tier)
+        if model and model not in models:
+            models.append(model)
+    return models
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES['gpt-4o'])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def stats_key(task_type, model):
+    return f"model_route:{task_type}:{model}"
+
+def record_call(task_type, model, result, accepted):
+    """Add one call's latency, cost and validation outcome to its route's stats."""
+    key = stats_key(task_type, model)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hincrby(key, 'calls', 1)
+        pipe.hincrby(key, 'invalid', int(not accepted))
+        pipe.hincrbyfloat(key, 'latency_seconds', result.latency)
+        pipe.hincrby(key, 'prompt_tokens', result.prompt_tokens)
+        pipe.hincrby(key, 'completion_tokens', result.completion_tokens)
+        pipe.hincrbyfloat(key, 'cost_usd', call_cost(model, result.prompt_tokens, result.completion_tokens))
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record route stats for {task_type} on {model}: {e}")
+
+def record_poll_outcome(task_type, model, upvotes, downvotes, retry_count):
+    """Count how contributors voted on an extraction a route produced.
+
+    Cached extractions carry the model that produced them. A cache hit means
+    no poll on that extraction finished (a retry asked for by a contributor
+    drops it), so it's counted here for the first time. ``model`` is None only
+    when the source isn't known.
+    """
+    if not model:
+        return
+    if retry_count > 0:
+        outcome = 'polls_retried'
+    elif upvotes > downvotes:
+        outcome = 'polls_approved'
+    elif downvotes > upvotes:
+        outcome = 'polls_rejected'
+    else:
+        outcome = 'polls_unanswered'
+    try:
+        redis_client.hincrby(stats_key(task_type, model), outcome, 1)
+    except Exception as e:
+        logger.warning(f"Could not record poll outcome for {task_type} on {model}: {e}")
+
+def route_stats(task_type):
+    """Per-model stats for a task type's route, for tuning it."""
+    stats = {}
+    for model in route_models(task_type):
+        raw = redis_client.hgetall(stats_key(task_type, model))
+        stats[model] = {name.decode('utf-8'): float(value) for name, value in raw.items()}
+    return stats
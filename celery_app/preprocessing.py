@@ -0,0 +1,108 @@
+import io
+import math
+import base64
+import logging
+from PIL import Image
+from .utils import detect_black_bar_width
+from .decoding import open_reduced
+
+logger = logging.getLogger(__name__)
+
+# OpenAI fits high detail images inside 2048x2048 and then scales the short
+# side down to 768 before tiling, so anything larger is wasted upload
+HIGH_DETAIL_LONG_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+# Low detail images are a single 512x512 tile
+LOW_DETAIL_SIDE = 512
+# Black bars narrow a panel once they're trimmed, so reduced decodes keep this
+# much extra width in hand
+BAR_ALLOWANCE = 1.25
+
+JPEG_QUALITY = 90
+
+# Until a screen type's panel is measured against real screenshots its region
+# is the whole game area, so nothing the model needs is cropped away
+FULL_FRAME = (0.0, 0.0, 1.0, 1.0)
+
+# The panel each screen type's information sits in, as fractions
+# (left, top, right, bottom) of the game area once black bars are trimmed,
+# and the detail level needed to read it
+SCREEN_PROFILES = {
+    # Hero Information stats and the Co-op Expedition list
+    'hero-stats': {'region': FULL_FRAME, 'detail': 'high'},
+    # Story text panel
+    'hero-stories': {'region': FULL_FRAME, 'detail': 'high'},
+    # Profile panel with age, height, weight and the rest
+    'hero-bios': {'region': FULL_FRAME, 'detail': 'high'},
+    # Item details popup
+    'weapon-information': {'region': FULL_FRAME, 'detail': 'high'},
+}
+
+def trim_black_bars(img, image_content, scale=1.0):
+    """Remove the pillarbox bars letterboxed devices add at the sides of screenshots.
+
+    ``scale`` is the size ``img`` was decoded at relative to the original.
+    """
+    left, right = detect_black_bar_width(io.BytesIO(image_content))
+    left, right = round(left * scale), round(right * scale)
+    if left or right:
+        img = img.crop((left, 0, img.width - right, img.height))
+    return img
+
+def crop_region(img, region):
+    left, top, right, bottom = region
+    return img.crop((
+        round(img.width * left),
+        round(img.height * top),
+        round(img.width * right),
+        round(img.height * bottom),
+    ))
+
+def downscale(img, detail):
+    """Shrink an image to the largest size the model will actually look at."""
+    if detail == 'low':
+        img.thumbnail((LOW_DETAIL_SIDE, LOW_DETAIL_SIDE), Image.LANCZOS)
+        return img
+    scale = min(1.0, HIGH_DETAIL_LONG_SIDE / max(img.size), HIGH_DETAIL_SHORT_SIDE / min(img.size))
+    if scale < 1.0:
+        img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+    return img
+
+def to_data_url(img):
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, format='JPEG', quality=JPEG_QUALITY)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+def crop_panel(image_content, task_type, min_side=None):
+    """Decode a screenshot and crop it to its screen type's panel.
+
+    The panel is at full resolution unless ``min_side`` is given, in which
+    case the screenshot may be decoded smaller as long as both sides of the
+    panel stay at least that long.
+    """
+    region = SCREEN_PROFILES[task_type]['region']
+    left, top, right, bottom = region
+    size = (math.ceil(min_side * BAR_ALLOWANCE / (right - left)), math.ceil(min_side / (bottom - top))) if min_side else None
+    img, scale = open_reduced(image_content, size)
+    img = trim_black_bars(img, image_content, scale)
+    return crop_region(img, region)
+
+def prepare_image(image_content, task_type):
+    """Crop a screenshot to its screen type's panel and downscale it for a vision call.
+
+    Returns the ``image_url`` message part, with the image inlined as a data
+    URL and an explicit detail level.
+    """
+    profile = SCREEN_PROFILES[task_type]
+    # Nothing past what the detail level keeps needs decoding
+    min_side = LOW_DETAIL_SIDE if profile['detail'] == 'low' else HIGH_DETAIL_SHORT_SIDE
+    img = crop_panel(image_content, task_type, min_side)
+    img = downscale(img, profile['detail'])
+    logger.info(f"Prepared {task_type} image: {img.width}x{img.height} ({profile['detail']} detail)")
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": to_data_url(img),
+            "detail": profile['detail'],
+        },
+    }
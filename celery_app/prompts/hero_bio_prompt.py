@@ -2,7 +2,7 @@ bio_prompt = '''
 Please analyze this image and generate a JSON object containing values for 'height', 'weight', 'age', 'species', 'role', and 'element' from the 'Hero Information' section in the screenshot. 
 We also want the 'rarity' of the hero. The rarity is the number of stars under the right-most image under the "Evolution Stage" header.
 Respond with only valid JSON using the mentioned keys, and ignore any icons or other irrelevant information. 
-If the existing data for a particular key is more complete than what you find, use the pre-existing value in your JSON response. 
+If a value isn't shown in the screenshot, use an empty string, or 0 for the age. 
 
 Your response should be structured as shown below:
 
@@ -15,6 +15,17 @@ Your response should be structured as shown below:
     "element": string,
     "rarity": string // Either "1 Star", "2 Star", or "3 Star". Count the number of stars under the right-most image under the "Evolution Stage" header, and return the corresponding option exactly as shown in quotes.
 }
+'''
 
-Current data for this hero:  
-'''
\ No newline at end of file
+from ..schema import obj, enum
+
+# The response structure described in bio_prompt, as a strict JSON schema
+bio_schema = obj({
+    "age": {"type": "integer"},
+    "height": {"type": "string"},
+    "weight": {"type": "string"},
+    "species": {"type": "string"},
+    "role": {"type": "string"},
+    "element": {"type": "string"},
+    "rarity": enum(["1 Star", "2 Star", "3 Star"]),
+})
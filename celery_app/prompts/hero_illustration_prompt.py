@@ -17,4 +17,13 @@ Respond only with the JSON object in the following format:
 Do not include any additional text in your response. If for any reason you cannot do this, simply respond with x=0, y=0, width=500, height=500 as the JSON object.
 
 Determine the resolution of the image you're looking at, and multiply the values by how much the resolution has been downscaled in the version of the image you're looking at, given that the image's original resolution is:
-'''
\ No newline at end of file
+'''
+from ..schema import obj
+
+# The crop box illustration_prompt asks for, as a strict JSON schema
+illustration_schema = obj({
+    "x": {"type": "integer"},
+    "y": {"type": "integer"},
+    "width": {"type": "integer"},
+    "height": {"type": "integer"},
+})
@@ -80,4 +80,35 @@ Crit Hit Multiplier
 When a shield is present, damage dealt increases by x% while damage taken decreases by x%
 
 Respond with only valid JSON using the mentioned structure, and ignore any icons or other irrelevant information. 
-'''
\ No newline at end of file
+'''
+
+from ..schema import obj, array, enum, prompt_options
+
+EQUIPMENT_TYPES = [
+    'One-Handed Sword', 'Two-Handed Sword', 'Bow', 'Rifle', 'Staff', 'Basket', 'Gauntlet',
+    'Claw', 'Shield', 'Accessory', 'Merch', 'Relic', 'Cards',
+]
+
+STAT_OPTIONS = prompt_options(stat_prompt, "Possible values for 'stat' are below")
+
+# The response structure described in stat_prompt, as a strict JSON schema
+stat_schema = obj({
+    "atk": {"type": "integer"},
+    "def": {"type": "integer"},
+    "hp": {"type": "integer"},
+    "crit": {"type": "integer"},
+    "heal": {"type": "integer"},
+    "damage_reduction": {"type": "integer"},
+    "basic_resistance": {"type": "integer"},
+    "light_resistance": {"type": "integer"},
+    "dark_resistance": {"type": "integer"},
+    "fire_resistance": {"type": "integer"},
+    "earth_resistance": {"type": "integer"},
+    "water_resistance": {"type": "integer"},
+    "compatible_equipment": array(enum(EQUIPMENT_TYPES)),
+    "passives": array(obj({
+        "affects_party": {"type": "boolean"},
+        "stat": enum(STAT_OPTIONS),
+        "value": {"type": "integer"},
+    })),
+})
@@ -0,0 +1,69 @@
+import re
+import json
+from .assistant_prompt import system_prompt
+
+# Per-task system prompts built from the full field schema in assistant_prompt.
+# Each one only carries the fields its screenshot can fill in, and is built once
+# at import so the prefix sent to the model is byte-identical on every call,
+# which lets the provider's prompt caching apply.
+
+SCHEMA_HEADING = 'The field structure for the custom post type is below:'
+
+# Top-level field names, or 'group.sub_field' paths, relevant to each task
+TASK_FIELDS = {
+    'hero-stats': [
+        'stat_fields.atk',
+        'stat_fields.hp',
+        'stat_fields.def',
+        'stat_fields.crit',
+        'stat_fields.damage_reduction',
+        'stat_fields.heal',
+        'stat_fields.basic_resistance',
+        'stat_fields.light_resistance',
+        'stat_fields.dark_resistance',
+        'stat_fields.fire_resistance',
+        'stat_fields.earth_resistance',
+        'stat_fields.water_resistance',
+        'bio_fields.compatible_equipment',
+        'ability_fields.passive_buffs',
+    ],
+    'hero-bios': [
+        'bio_fields.age',
+        'bio_fields.height',
+        'bio_fields.weight',
+        'bio_fields.species',
+        'bio_fields.rarity',
+        'bio_fields.element',
+        'bio_fields.role',
+    ],
+    'hero-stories': [
+        'bio_fields.story',
+    ],
+}
+
+def load_field_schema():
+    """Parse the field structure out of the master system prompt."""
+    preamble, _, schema_text = system_prompt.partition(SCHEMA_HEADING)
+    # The schema is written like JSON but with trailing commas
+    schema_text = re.sub(r',(\s*[}\]])', r'\1', schema_text)
+    return preamble.strip(), json.loads(schema_text)
+
+def select_fields(field_groups, paths):
+    fields = {field['name']: field for group in field_groups for field in group['fields']}
+    selected = {}
+    for path in paths:
+        name, _, sub_name = path.partition('.')
+        field = fields[name]
+        if not sub_name:
+            selected[name] = field
+            continue
+        group = selected.setdefault(name, {**field, 'sub_fields': []})
+        group['sub_fields'].append(next(f for f in field['sub_fields'] if f['name'] == sub_name))
+    return list(selected.values())
+
+def build_system_prompt(task_type):
+    preamble, field_groups = load_field_schema()
+    fields = select_fields(field_groups, TASK_FIELDS[task_type])
+    return preamble + '\n\nThe fields relevant to this screenshot are below:\n\n' + json.dumps(fields, indent=2) + '\n'
+
+task_system_prompts = {task_type: build_system_prompt(task_type) for task_type in TASK_FIELDS}
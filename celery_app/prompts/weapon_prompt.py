@@ -119,4 +119,44 @@ Please note that the (Flat) or (%) version of each stat should be chosen accordi
 Respond with only valid JSON using the mentioned structure, and ignore any icons or other irrelevant information. 
 Remember, if you don't see any information in the screenshot for a particular field such as main_option, engraving_options or sub_option, use the existing information under the corresponding field below, or add any new lines if you see the what could be the end or beginning of the pre-recorded field values below where another screenshot may have cut off.
 Here is the current data we have so far for this item:
-'''
\ No newline at end of file
+'''
+
+from ..schema import obj, array, enum, prompt_options
+from .stat_prompt import EQUIPMENT_TYPES
+
+WEAPON_STAT_OPTIONS = prompt_options(weapon_prompt, "Possible values for 'stat' are below")
+
+weapon_option_schema = obj({
+    "stat": enum(WEAPON_STAT_OPTIONS),
+    "is_range": {"type": "boolean"},
+    "value": {"type": "integer"},
+    "minimum_value": {"type": "integer"},
+    "maximum_value": {"type": "integer"},
+})
+
+# The response structure described in weapon_prompt, as a strict JSON schema
+weapon_schema = obj({
+    "name": {"type": "string"},
+    "rarity": {"type": "string"},
+    "weapon_type": enum(EQUIPMENT_TYPES + [""]),
+    "exclusive": {"type": "boolean"},
+    "hero": {"type": "string"},
+    "exclusive_effects": {"type": "string"},
+    "min_dps": {"type": "integer"},
+    "max_dps": {"type": "integer"},
+    "weapon_skill_name": {"type": "string"},
+    "weapon_skill_atk": {"type": "integer"},
+    "weapon_skill_regen_time": {"type": "integer"},
+    "weapon_skill_description": {"type": "string"},
+    "weapon_skill_chain": enum(["Injured", "Downed", "Airborne", ""]),
+    "main_option": array(weapon_option_schema),
+    "max_lines": {"type": "integer"},
+    "sub_option": array(weapon_option_schema),
+    # Empty when the weapon has no limit break 5 line
+    "limit_break_5_option": enum(WEAPON_STAT_OPTIONS + [""]),
+    "limit_break_5_value": {"type": "integer"},
+    "engraving_options": array(obj({
+        "stat": enum(WEAPON_STAT_OPTIONS),
+        "value": {"type": "integer"},
+    })),
+})
@@ -0,0 +1,90 @@
+import os
+import math
+import logging
+from .utils import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Cluster-wide OpenAI budget shared by every worker, per model
+REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_RPM_LIMIT', 500))
+TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TPM_LIMIT', 30000))
+
+# Rough token cost of an image part, by detail level
+IMAGE_TOKENS = {'low': 85, 'high': 1105, 'auto': 1105}
+
+# Refills both buckets from the Redis clock, then takes the request and token
+# cost from both or from neither. Returns the seconds to wait as a string
+# (Lua numbers would be truncated to integers), or '0' once acquired.
+ACQUIRE_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local wait = 0
+local levels = {}
+
+local cooldown = redis.call('PTTL', KEYS[3])
+if cooldown > 0 then
+    wait = cooldown / 1000
+end
+
+for i = 1, 2 do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local cost = math.min(tonumber(ARGV[i * 2]), capacity)
+    local rate = capacity / 60
+    local state = redis.call('HMGET', KEYS[i], 'level', 'updated_at')
+    local level = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(0, now - updated_at) * rate)
+    if level < cost then
+        wait = math.max(wait, (cost - level) / rate)
+    end
+    levels[i] = level - cost
+end
+
+if wait > 0 then
+    return tostring(wait)
+end
+
+for i = 1, 2 do
+    redis.call('HSET', KEYS[i], 'level', tostring(levels[i]), 'updated_at', tostring(now))
+    redis.call('EXPIRE', KEYS[i], 120)
+end
+return '0'
+"""
+
+_acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+
+def bucket_keys(model):
+    return [f"rate_limit:{model}:requests", f"rate_limit:{model}:tokens", f"rate_limit:{model}:cooldown"]
+
+def estimate_tokens(payload):
+    """Estimate the tokens a chat completion request will count against the TPM limit."""
+    tokens = payload.get('max_tokens', 0)
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                tokens += len(part['text']) // 4
+            elif part.get('type') == 'image_url':
+                tokens += IMAGE_TOKENS.get(part['image_url'].get('detail', 'auto'), IMAGE_TOKENS['auto'])
+    return tokens
+
+def acquire(model, tokens):
+    """Take one request and ``tokens`` tokens from the model's buckets.
+
+    Returns 0 when the budget was acquired, otherwise the number of seconds
+    until it will be available. Nothing is taken when the caller has to wait.
+    """
+    return float(_acquire(keys=bucket_keys(model), args=[REQUESTS_PER_MINUTE, 1, TOKENS_PER_MINUTE, tokens]))
+
+def reconcile(model, estimated_tokens, actual_tokens):
+    """Return over-estimated tokens to the bucket, or take the shortfall."""
+    difference = estimated_tokens - actual_tokens
+    if difference:
+        redis_client.hincrbyfloat(bucket_keys(model)[1], 'level', difference)
+
+def cool_down(model, seconds):
+    """Pause every worker's calls to a model after OpenAI returns a 429."""
+    redis_client.set(bucket_keys(model)[2], 1, px=max(1, math.ceil(seconds * 1000)))
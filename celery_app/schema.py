@@ -0,0 +1,98 @@
+import json
+
+# A small JSON schema subset: the keywords used by the extraction schemas in
+# celery_app/prompts, which are also what OpenAI's strict structured outputs accept.
+
+TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'boolean': bool,
+    'integer': int,
+    'number': (int, float),
+}
+
+def obj(properties):
+    """Build a strict object schema: every property required, nothing else allowed."""
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False,
+    }
+
+def array(items):
+    return {'type': 'array', 'items': items}
+
+def enum(options, type='string'):
+    return {'type': type, 'enum': list(options)}
+
+def prompt_options(prompt, heading):
+    """Read the one-per-line option list that follows ``heading`` in a prompt."""
+    _, _, rest = prompt.partition(heading)
+    lines = rest.split('\n')[1:]
+    options = []
+    for line in lines:
+        if not line.strip():
+            if options:
+                break
+            continue
+        options.append(line.strip())
+    return options
+
+def response_format(name, schema):
+    """The chat completions ``response_format`` asking for output matching ``schema``."""
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': name, 'strict': True, 'schema': schema},
+    }
+
+def validate(data, schema, path=''):
+    """Return a list of (path, message) for every part of ``data`` not matching ``schema``."""
+    expected = schema.get('type')
+    python_type = TYPES.get(expected)
+    # bool is an int subclass, but true is not a valid integer
+    if python_type and (not isinstance(data, python_type) or (expected in ('integer', 'number') and isinstance(data, bool))):
+        return [(path, f"expected {expected}, got {type(data).__name__}")]
+    if 'enum' in schema and data not in schema['enum']:
+        return [(path, f"{data!r} is not one of the allowed values")]
+
+    errors = []
+    if expected == 'object':
+        properties = schema.get('properties', {})
+        for name in schema.get('required', []):
+            if name not in data:
+                errors.append((join(path, name), 'missing'))
+        for name, value in data.items():
+            if name in properties:
+                errors.extend(validate(value, properties[name], join(path, name)))
+            elif schema.get('additionalProperties') is False:
+                errors.append((join(path, name), 'unexpected field'))
+    elif expected == 'array' and 'items' in schema:
+        for index, item in enumerate(data):
+            errors.extend(validate(item, schema['items'], f"{path}[{index}]"))
+    return errors
+
+def join(path, name):
+    return f"{path}.{name}" if path else name
+
+def invalid_fields(errors):
+    """The top-level fields that contain at least one error, in the order they were found."""
+    fields = []
+    for path, _ in errors:
+        field = path.split('.')[0].split('[')[0]
+        if field and field not in fields:
+            fields.append(field)
+    return fields
+
+def sub_schema(schema, fields):
+    """Restrict an object schema to ``fields``, for re-asking only those."""
+    return obj({name: schema['properties'][name] for name in fields})
+
+def parse_json(content):
+    """Parse model output, tolerating a markdown code fence around it."""
+    cleaned = content.strip()
+    if cleaned.startswith('```'):
+        cleaned = cleaned.split('\n', 1)[1] if '\n' in cleaned else ''
+        cleaned = cleaned.rsplit('```', 1)[0]
+    return json.loads(cleaned)
@@ -0,0 +1,213 @@
+"""Read the numbers on the hero stats screen without asking the model for them.
+
+The screen layout is fixed, so each stat's value sits at a known position once
+the black bars are trimmed. Each value is sliced out, split into characters,
+and every character is matched against a glyph set cut from real screenshots.
+Only the numeric rows are read; the compatible equipment icons and the Co-op
+Expedition lines are still left to the model.
+
+The glyph set lives in GLYPH_DIR: a ``layout.json`` giving each stat's value
+box as fractions (left, top, right, bottom) of the game area under "rows", and
+one PNG per glyph sample named ``<char>_<anything>.png``. None ships with the
+repository, so the reader stays off until one is built. Measure layout.json by
+hand, then cut the glyphs from a screenshot whose values are known:
+
+    python -m celery_app.stat_reader build-glyphs screenshot.png values.json
+
+where values.json maps stat names to the text shown, e.g. {"atk": "1,234"}.
+"""
+import io
+import os
+import sys
+import json
+import hashlib
+import logging
+import numpy as np
+from PIL import Image
+from .utils import detect_black_bar_width
+
+logger = logging.getLogger(__name__)
+
+GLYPH_DIR = os.environ.get('STAT_GLYPH_DIR', os.path.join(os.path.dirname(__file__), 'glyphs', 'hero_stats'))
+
+# Reads scoring below this on any stat are handed to the LLM instead
+MIN_CONFIDENCE = float(os.environ.get('STAT_READER_MIN_CONFIDENCE', 0.85))
+
+# Value boxes are scaled to this height before they're split into characters
+ROW_HEIGHT = 48
+
+# The stats read from the screen; everything else in stat_schema is asked of the model
+NUMERIC_STATS = [
+    'atk', 'def', 'hp', 'crit', 'heal', 'damage_reduction', 'basic_resistance',
+    'light_resistance', 'dark_resistance', 'fire_resistance', 'earth_resistance', 'water_resistance',
+]
+
+# Characters that can appear in a value but don't change it
+SEPARATORS = {',', '.', '%'}
+# File names can't hold every character
+GLYPH_NAMES = {'comma': ',', 'dot': '.', 'percent': '%'}
+
+_glyph_set = None
+
+def load_glyph_set(glyph_dir=GLYPH_DIR):
+    """Return (layout, glyphs) with glyphs as a list of (char, array), or None if missing."""
+    layout_path = os.path.join(glyph_dir, 'layout.json')
+    if not os.path.exists(layout_path):
+        return None
+    with open(layout_path) as f:
+        layout = json.load(f)
+    glyphs = []
+    for name in sorted(os.listdir(glyph_dir)):
+        if not name.endswith('.png'):
+            continue
+        char = name.split('_')[0]
+        char = GLYPH_NAMES.get(char, char)
+        glyphs.append((char, np.array(Image.open(os.path.join(glyph_dir, name)).convert('L'), dtype=np.float32)))
+    if not glyphs:
+        return None
+    return layout, glyphs
+
+def get_glyph_set():
+    global _glyph_set
+    if _glyph_set is None:
+        _glyph_set = load_glyph_set() or False
+        if not _glyph_set:
+            logger.warning(f"No stat glyph set in {GLYPH_DIR}, so stats are read by the model")
+    return _glyph_set or None
+
+def game_area(image_content):
+    """Decode a screenshot as grayscale with the black bars trimmed off."""
+    img = Image.open(io.BytesIO(image_content)).convert('L')
+    left, right = detect_black_bar_width(io.BytesIO(image_content))
+    return img.crop((left, 0, img.width - right, img.height))
+
+def value_box(img, box):
+    left, top, right, bottom = box
+    cropped = img.crop((
+        round(img.width * left),
+        round(img.height * top),
+        round(img.width * right),
+        round(img.height * bottom),
+    ))
+    width = max(1, round(cropped.width * ROW_HEIGHT / max(1, cropped.height)))
+    return np.array(cropped.resize((width, ROW_HEIGHT), Image.BILINEAR), dtype=np.float32)
+
+def binarize(row):
+    """Separate text from background, returning a boolean mask with text as True."""
+    threshold = (row.min() + row.max()) / 2
+    mask = row > threshold
+    # Text covers less of the box than the background does
+    if mask.mean() > 0.5:
+        mask = ~mask
+    return mask
+
+def segment(row):
+    """Split a value box into character images, left to right.
+
+    The mask only finds the characters; they're cut from the grayscale row,
+    whose anti-aliased edges match far better than thresholded ones.
+    """
+    mask = binarize(row)
+    # Text as bright on dark, whichever way round the screen draws it
+    ink = row - row.min() if row[mask].mean() > row[~mask].mean() else row.max() - row
+    columns = mask.any(axis=0)
+    characters = []
+    start = None
+    for x, filled in enumerate(list(columns) + [False]):
+        if filled and start is None:
+            start = x
+        elif not filled and start is not None:
+            rows = np.flatnonzero(mask[:, start:x].any(axis=1))
+            characters.append(ink[rows[0]:rows[-1] + 1, start:x])
+            start = None
+    return characters
+
+def correlation(a, b):
+    a = a - a.mean()
+    b = b - b.mean()
+    denominator = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denominator) if denominator else 0.0
+
+def match_score(character, glyph):
+    """Normalised cross-correlation of a character against a glyph, from -1 to 1.
+
+    The best score over one pixel shifts each way is taken, since a character
+    can land a pixel off from where its glyph sample sat.
+    """
+    if character.shape != glyph.shape:
+        character = np.array(
+            Image.fromarray(character.astype(np.uint8)).resize((glyph.shape[1], glyph.shape[0]), Image.BILINEAR),
+            dtype=np.float32,
+        )
+    height, width = glyph.shape
+    padded = np.pad(character, 1)
+    return max(correlation(padded[y:y + height, x:x + width], glyph) for y in range(3) for x in range(3))
+
+def read_value(row, glyphs):
+    """Return (text, confidence) for one value box."""
+    text = ''
+    confidence = 1.0
+    for character in segment(row):
+        char, score = max(((char, match_score(character, glyph)) for char, glyph in glyphs), key=lambda match: match[1])
+        text += char
+        confidence = min(confidence, score)
+    if not text:
+        return '', 0.0
+    return text, confidence
+
+def read_stats(image_content):
+    """Read the numeric stats from a hero stats screenshot.
+
+    Returns (stats, confidence), where stats holds every stat in the layout
+    and confidence is the worst character match across them, or None when no
+    glyph set is installed.
+    """
+    glyph_set = get_glyph_set()
+    if glyph_set is None:
+        return None
+    layout, glyphs = glyph_set
+    rows = {name: box for name, box in layout['rows'].items() if name in NUMERIC_STATS}
+    if not rows:
+        return None
+    img = game_area(image_content)
+
+    stats = {}
+    confidence = 1.0
+    for name, box in rows.items():
+        text, score = read_value(value_box(img, box), glyphs)
+        digits = ''.join(char for char in text if char not in SEPARATORS)
+        stats[name] = int(digits) if digits.isdigit() else 0
+        confidence = min(confidence, score)
+    logger.info(f"Read stats locally with confidence {confidence:.2f}: {stats}")
+    return stats, confidence
+
+def build_glyphs(screenshot_path, values_path, glyph_dir=GLYPH_DIR):
+    """Cut glyph samples out of a screenshot whose displayed values are known."""
+    with open(os.path.join(glyph_dir, 'layout.json')) as f:
+        layout = json.load(f)
+    with open(values_path) as f:
+        values = json.load(f)
+    with open(screenshot_path, 'rb') as f:
+        img = game_area(f.read())
+
+    file_names = {char: name for name, char in GLYPH_NAMES.items()}
+    saved = 0
+    for name, text in values.items():
+        characters = segment(value_box(img, layout['rows'][name]))
+        text = str(text)
+        if len(characters) != len(text):
+            logger.warning(f"Skipping {name}: found {len(characters)} characters for {text!r}")
+            continue
+        for char, character in zip(text, characters):
+            digest = hashlib.sha1(character.tobytes()).hexdigest()[:8]
+            path = os.path.join(glyph_dir, f"{file_names.get(char, char)}_{digest}.png")
+            Image.fromarray(character.astype(np.uint8)).save(path)
+            saved += 1
+    logger.info(f"Saved {saved} glyphs to {glyph_dir}")
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'build-glyphs':
+        print(__doc__)
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    build_glyphs(sys.argv[2], sys.argv[3])
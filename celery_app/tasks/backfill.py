@@ -0,0 +1,180 @@
+"""Bulk re-extraction through the OpenAI Batch API.
+
+Screenshots uploaded under ``backfill/<folder>/`` (named like the normal
+uploads) are written into one JSONL batch of chat requests and submitted
+asynchronously. Once the batch completes, each result is stored in the
+extraction cache under the request the screenshot's own task builds, and the
+screenshot is handed to that task for the usual poll and WordPress update.
+Batch requests cost half as much and don't count against the synchronous
+rate limits, at the price of taking up to 24 hours.
+
+    python -m celery_app.tasks.backfill hero-stories
+
+Point OPENAI_BASE_URL at tests/openai_batch_stub.py to try it locally.
+"""
+import io
+import os
+import sys
+import json
+import logging
+from celery import shared_task
+from ..preprocessing import prepare_image
+from ..schema import parse_json, validate
+from ..utils import redis_client, get_s3_client
+from ..llm_client import OPENAI_BASE_URL, pooled_session
+from ..extraction_cache import content_hash, cache_key, store_extraction_at
+from .batch_extraction import BATCHED_FOLDERS
+from config import AWS_S3_BUCKET
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_PREFIX = 'backfill/'
+# Seconds between checks on a submitted batch
+POLL_INTERVAL = int(os.environ.get('BACKFILL_POLL_INTERVAL', 300))
+# Screenshots stay locked while their batch runs, so the folder scans leave them alone
+LOCK_TTL = 26 * 3600
+FINISHED_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def backfill_key(batch_id):
+    return f"backfill:{batch_id}"
+
+def list_backfill_images(s3_client, folder):
+    prefix = f"{BACKFILL_PREFIX}{folder}/"
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=AWS_S3_BUCKET, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []) if obj['Key'] != prefix)
+    return keys
+
+def upload_batch_file(lines):
+    with pooled_session() as session:
+        response = session.post(
+            f"{OPENAI_BASE_URL}/files",
+            files={'file': ('backfill.jsonl', io.BytesIO('\n'.join(lines).encode('utf-8')), 'application/jsonl')},
+            data={'purpose': 'batch'},
+            # The session's JSON content type would break the multipart body
+            headers={'Content-Type': None},
+            timeout=(5, 300),
+        )
+    response.raise_for_status()
+    return response.json()['id']
+
+def create_batch(input_file_id, folder):
+    with pooled_session() as session:
+        response = session.post(
+            f"{OPENAI_BASE_URL}/batches",
+            json={
+                'input_file_id': input_file_id,
+                'endpoint': '/v1/chat/completions',
+                'completion_window': '24h',
+                'metadata': {'folder': folder},
+            },
+            timeout=(5, 60),
+        )
+    response.raise_for_status()
+    return response.json()['id']
+
+@shared_task
+def start_backfill(folder):
+    """Write every screenshot waiting under backfill/<folder>/ into one batch and submit it."""
+    config = BATCHED_FOLDERS[folder]
+    hero_data = json.loads(redis_client.get('hero_data') or '[]')
+    s3_client = get_s3_client()
+
+    lines = []
+    requests_by_id = {}
+    for key in list_backfill_images(s3_client, folder):
+        if not redis_client.set('lock:' + key, 1, nx=True, ex=LOCK_TTL):
+            continue
+        hero_name = key.split('/')[-1].split('.')[0].split('_')[0]
+        hero = next((h for h in hero_data if h['slug'] == hero_name), None)
+        if hero is None:
+            logger.warning(f"Hero '{hero_name}' not found, skipping {key}")
+            redis_client.delete('lock:' + key)
+            continue
+        image_content = s3_client.get_object(Bucket=AWS_S3_BUCKET, Key=key)['Body'].read()
+        # The same request the screenshot's own task will build, so the result lands in its cache entry
+        payload = config['module'].build_payload(hero, prepare_image(image_content, folder))
+        custom_id = f"{len(lines)}"
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': payload}))
+        requests_by_id[custom_id] = json.dumps({
+            'key': key,
+            'hero_name': hero_name,
+            'cache_key': cache_key(content_hash(image_content), folder, payload),
+            'model': payload['model'],
+        })
+
+    if not lines:
+        logger.info(f"No screenshots waiting under {BACKFILL_PREFIX}{folder}/")
+        return
+
+    batch_id = create_batch(upload_batch_file(lines), folder)
+    redis_client.hset(backfill_key(batch_id), mapping={'folder': folder, **requests_by_id})
+    redis_client.expire(backfill_key(batch_id), LOCK_TTL)
+    logger.info(f"Submitted backfill batch {batch_id} with {len(lines)} '{folder}' screenshots")
+    poll_backfill.apply_async((batch_id,), countdown=POLL_INTERVAL)
+
+def read_results(output_file_id):
+    with pooled_session() as session:
+        response = session.get(f"{OPENAI_BASE_URL}/files/{output_file_id}/content", timeout=(5, 300))
+    response.raise_for_status()
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+def result_content(result, schema):
+    """The model output in one line of a batch's output file, or None if the request failed or doesn't match ``schema``."""
+    # Requests that errored have no response at all
+    response = result.get('response') or {}
+    if response.get('status_code') != 200:
+        return None
+    try:
+        content = response['body']['choices'][0]['message']['content']
+        if validate(parse_json(content), schema):
+            return None
+    except (KeyError, IndexError, TypeError, AttributeError, json.JSONDecodeError):
+        return None
+    return content
+
+@shared_task
+def poll_backfill(batch_id):
+    """Check on a backfill batch, and once it's done hand its screenshots to their tasks."""
+    with pooled_session() as session:
+        response = session.get(f"{OPENAI_BASE_URL}/batches/{batch_id}", timeout=(5, 60))
+    response.raise_for_status()
+    batch = response.json()
+    if batch['status'] not in FINISHED_STATUSES:
+        counts = batch.get('request_counts') or {}
+        logger.info(f"Backfill batch {batch_id} is {batch['status']} ({counts.get('completed', 0)}/{counts.get('total', 0)} done)")
+        poll_backfill.apply_async((batch_id,), countdown=POLL_INTERVAL)
+        return
+
+    stored = {name.decode('utf-8'): value.decode('utf-8') for name, value in redis_client.hgetall(backfill_key(batch_id)).items()}
+    folder = stored.pop('folder')
+    config = BATCHED_FOLDERS[folder]
+    results = read_results(batch['output_file_id']) if batch.get('output_file_id') else []
+
+    extracted = set()
+    for result in results:
+        request = stored.get(result['custom_id'])
+        content = result_content(result, config['schema'])
+        if request is None or content is None:
+            continue
+        request = json.loads(request)
+        store_extraction_at(request['cache_key'], content, request['model'])
+        extracted.add(result['custom_id'])
+
+    logger.info(f"Backfill batch {batch_id} {batch['status']}: {len(extracted)} of {len(stored)} screenshots extracted")
+    for custom_id, request in stored.items():
+        request = json.loads(request)
+        if custom_id in extracted:
+            # The task finds its extraction cached and goes straight to the poll
+            config['task'].delay(request['key'], folder, request['hero_name'])
+        else:
+            # Leave it for the next backfill run
+            redis_client.delete('lock:' + request['key'])
+    redis_client.delete(backfill_key(batch_id))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in BATCHED_FOLDERS:
+        print(__doc__)
+        sys.exit(1)
+    from celery_app.app import celery
+    celery.send_task('celery_app.tasks.backfill.start_backfill', args=[sys.argv[1]])
@@ -0,0 +1,233 @@
+import os
+import json
+import logging
+from celery import shared_task, chord
+from ..prompts.task_system_prompts import task_system_prompts
+from ..prompts.stat_prompt import stat_prompt, stat_schema
+from ..prompts.hero_bio_prompt import bio_prompt, bio_schema
+from ..prompts.hero_story_prompt import story_prompt, story_schema
+from ..schema import obj, array, response_format, validate, parse_json
+from ..utils import redis_client
+from ..llm_client import routed_completion, chat_completion, is_json, task_deadline, LLMError, MAX_REPAIR_ROUNDS
+from ..model_routing import route_models
+from ..extraction_backends import get_backend
+from ..extraction_cache import get_extraction, store_extraction
+from . import process_hero_stats, process_hero_bio, process_hero_story
+from .image_ops import prepare_extraction, load_image_part, discard_outputs
+
+logger = logging.getLogger(__name__)
+
+# Most screenshots sent to the model in one request
+BATCH_SIZE = int(os.environ.get('EXTRACTION_BATCH_SIZE', 5))
+# Seconds to wait for more screenshots of the same type after the first arrives
+BATCH_WINDOW = int(os.environ.get('EXTRACTION_BATCH_WINDOW', 20))
+
+# Folders whose screenshots are gathered into batches, and how to extract them
+BATCHED_FOLDERS = {
+    'hero-stats': {
+        'prompt': stat_prompt,
+        'schema': stat_schema,
+        'module': process_hero_stats,
+        'task': process_hero_stats.process_hero_stats_task,
+        'finish': process_hero_stats.finish_hero_stats_task,
+    },
+    'hero-bios': {
+        'prompt': bio_prompt,
+        'schema': bio_schema,
+        'module': process_hero_bio,
+        'task': process_hero_bio.process_hero_bio_task,
+        'finish': process_hero_bio.finish_hero_bio_task,
+    },
+    'hero-stories': {
+        'prompt': story_prompt,
+        'schema': story_schema,
+        'module': process_hero_story,
+        'task': process_hero_story.process_hero_story_task,
+        'finish': process_hero_story.finish_hero_story_task,
+    },
+}
+
+BATCH_INSTRUCTIONS = '''
+You will receive {count} screenshots, each introduced by its image number and the hero it belongs to.
+Apply the instructions above to each screenshot separately, and respond with one entry in 'results' per screenshot, in order, with 'image' set to its image number.
+'''
+
+def queue_for_batch(folder, key, hero_name):
+    """Hold a screenshot back briefly so it can share a model request with others of its type."""
+    length = redis_client.rpush(f"batch_pending:{folder}", json.dumps({'key': key, 'hero_name': hero_name}))
+    if length >= BATCH_SIZE:
+        flush_extraction_batch.delay(folder)
+    elif redis_client.set(f"batch_window:{folder}", 1, nx=True, ex=BATCH_WINDOW * 2):
+        # First screenshot of a new batch: flush whatever has gathered when the window closes
+        flush_extraction_batch.apply_async((folder,), countdown=BATCH_WINDOW)
+
+# Takes up to a batch of pending screenshots and, in the same step, opens a
+# new window if any are left over or closes the window if none are, so a
+# screenshot queued meanwhile either lands in this batch or starts its own
+# window. Returns {entries, remaining}.
+TAKE_PENDING_SCRIPT = """
+local entries = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+redis.call('LTRIM', KEYS[1], tonumber(ARGV[1]), -1)
+local remaining = redis.call('LLEN', KEYS[1])
+if remaining > 0 then
+    redis.call('SET', KEYS[2], 1, 'EX', tonumber(ARGV[2]))
+else
+    redis.call('DEL', KEYS[2])
+end
+return {entries, remaining}
+"""
+
+_take_pending = redis_client.register_script(TAKE_PENDING_SCRIPT)
+
+def take_pending(folder):
+    entries, remaining = _take_pending(keys=[f"batch_pending:{folder}", f"batch_window:{folder}"], args=[BATCH_SIZE, BATCH_WINDOW * 2])
+    return [json.loads(entry) for entry in entries], remaining
+
+def batch_schema(schema):
+    return obj({'results': array(obj({'image': {'type': 'integer'}, **schema['properties']}))})
+
+def build_batch_payload(folder, items):
+    config = BATCHED_FOLDERS[folder]
+    content = [{"type": "text", "text": config['prompt'] + BATCH_INSTRUCTIONS.format(count=len(items))}]
+    for number, item in enumerate(items, start=1):
+        content.append({"type": "text", "text": f"Image {number}: {item['hero']['title']}"})
+        content.append(item['image_part'])
+    return {
+        "model": route_models(folder)[0],
+        "messages": [
+            {"role": "system", "content": task_system_prompts[folder]},
+            {"role": "user", "content": content},
+        ],
+        "max_tokens": 1000 * len(items),
+        "response_format": response_format(f"{folder.replace('-', '_')}_batch", batch_schema(config['schema'])),
+    }
+
+def split_results(content, numbers, schema):
+    """Sort a batch response into ({number: data} valid, {number: errors} failed) for the images in ``numbers``."""
+    try:
+        results = parse_json(content).get('results')
+    except (json.JSONDecodeError, AttributeError) as e:
+        return {}, {number: [('', f"not valid JSON: {e}")] for number in numbers}
+    valid = {}
+    failed = {number: [('', 'no entry for this image')] for number in numbers}
+    for result in results if isinstance(results, list) else []:
+        number = result.pop('image', None) if isinstance(result, dict) else None
+        if number not in failed:
+            continue
+        errors = validate(result, schema)
+        if errors:
+            failed[number] = errors
+        else:
+            valid[number] = result
+            del failed[number]
+    return valid, failed
+
+def repair_batch_payload(payload, content, failed):
+    """A follow-up request asking the model to resend only the entries for the images in ``failed``."""
+    problems = '\n'.join(
+        f"- Image {number}: " + '; '.join(f"{path or 'entry'}: {message}" for path, message in errors)
+        for number, errors in sorted(failed.items())
+    )
+    return {
+        **payload,
+        'messages': payload['messages'] + [
+            {'role': 'assistant', 'content': content},
+            {
+                'role': 'user',
+                'content': f"These entries were missing or invalid:\n{problems}\n"
+                           f"Respond with 'results' holding corrected entries for only images {', '.join(str(number) for number in sorted(failed))}.",
+            },
+        ],
+    }
+
+def extract_batch(folder, screenshots):
+    """Extract a batch of screenshots in one request and cache each result for its own task.
+
+    ``screenshots`` are (hero, prepared) pairs, prepared by prepare_extraction.
+    """
+    config = BATCHED_FOLDERS[folder]
+    items = []
+    for hero, prepared in screenshots:
+        image_part = load_image_part(prepared)
+        item = {
+            'hero': hero,
+            'image_part': image_part,
+            'image_hash': prepared['hash'],
+            # The request the image's own task will build, which keys its cached extraction
+            'payload': config['module'].build_payload(hero, image_part),
+        }
+        if get_extraction(item['image_hash'], folder, item['payload'])[0] is None:
+            items.append(item)
+    if len(items) < 2:
+        return
+
+    payload = build_batch_payload(folder, items)
+    deadline = task_deadline(folder)
+    result = routed_completion(payload, folder, accept=is_json, deadline=deadline)
+    model = result.route_model
+    payload = {**payload, 'model': model}
+    content = result.content
+    valid, failed = split_results(content, range(1, len(items) + 1), config['schema'])
+    # Re-ask for just the entries that came back invalid; any still failing
+    # are left to their own tasks
+    for repair_round in range(MAX_REPAIR_ROUNDS):
+        if not failed:
+            break
+        logger.warning(f"Batched '{folder}' response had invalid entries for images {sorted(failed)}, asking again (round {repair_round + 1})")
+        content = chat_completion(repair_batch_payload(payload, content, failed), folder, deadline).content
+        repaired, failed = split_results(content, failed, config['schema'])
+        valid.update(repaired)
+
+    for number, data in valid.items():
+        item = items[number - 1]
+        store_extraction(item['image_hash'], folder, item['payload'], json.dumps(data), model)
+    logger.info(f"Extracted {len(valid)} of {len(items)} '{folder}' screenshots in one request")
+
+@shared_task
+def flush_extraction_batch(folder):
+    entries, remaining = take_pending(folder)
+    if remaining:
+        # More arrived than fit in this batch; take_pending opened a window for the rest
+        flush_extraction_batch.apply_async((folder,), countdown=BATCH_WINDOW)
+    if not entries:
+        return
+
+    # The model backend is the only one that benefits from sharing a request
+    if len(entries) > 1 and get_backend(folder).name == 'openai':
+        # Prepare every screenshot on the images queue, then extract them together
+        chord(prepare_extraction.s(entry['key'], folder) for entry in entries)(
+            extract_prepared_batch.s(folder, entries).on_error(batch_preparation_failed.s(folder, entries))
+        )
+        return
+    for entry in entries:
+        BATCHED_FOLDERS[folder]['task'].delay(entry['key'], folder, entry['hero_name'])
+
+@shared_task
+def extract_prepared_batch(prepared, folder, entries):
+    """Extract a prepared batch, then hand each screenshot to its own task with its prepared panel."""
+    config = BATCHED_FOLDERS[folder]
+    hero_data = json.loads(redis_client.get('hero_data') or '[]')
+    heroes = [next((h for h in hero_data if h['slug'] == entry['hero_name']), None) for entry in entries]
+    try:
+        extract_batch(folder, [(hero, prepared_image) for hero, prepared_image in zip(heroes, prepared) if hero])
+    except LLMError as e:
+        logger.warning(f"Batched '{folder}' extraction failed, extracting individually: {e}")
+    except Exception:
+        logger.exception(f"Batched '{folder}' extraction failed, extracting individually")
+
+    # Each screenshot still gets its own task and poll; batched ones find their extraction cached
+    for entry, hero, prepared_image in zip(entries, heroes, prepared):
+        if hero is None:
+            # The task reports the missing hero as it would for any screenshot
+            discard_outputs(prepared_image)
+            config['task'].delay(entry['key'], folder, entry['hero_name'])
+        else:
+            config['finish'].delay(prepared_image, entry['key'], folder, hero)
+
+@shared_task
+def batch_preparation_failed(request, exc, traceback, folder, entries):
+    """Fall back to a task per screenshot when any of a batch's screenshots couldn't be prepared."""
+    # Panels that were prepared expire from Redis on their own
+    logger.warning(f"Preparing a '{folder}' batch failed, extracting individually: {exc}")
+    for entry in entries:
+        BATCHED_FOLDERS[folder]['task'].delay(entry['key'], folder, entry['hero_name'])
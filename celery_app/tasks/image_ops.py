@@ -0,0 +1,215 @@
+"""CPU-bound image work, run on the 'images' queue.
+
+The processing tasks spend most of their time waiting on S3, the model, the
+Discord poll and WordPress, so they run on a high-concurrency I/O worker. The
+decoding, cropping and encoding they need is handed to these tasks instead,
+which a prefork worker sized to the pod's cores serves. Nothing waits on
+them: each is chained to a task on the default queue that carries on with
+its result. Encoded outputs are too big to pass along the chain, so they're
+left in Redis for that task to pick up.
+"""
+import io
+import os
+import json
+import uuid
+import logging
+from celery import shared_task
+from PIL import Image
+from ..decoding import decode_region
+from ..preprocessing import prepare_image
+from ..extraction_backends import get_backend, timed_extract
+from ..extraction_cache import content_hash
+from ..stat_reader import read_stats
+from ..face_detection import detect_face_crop
+from ..frame_locator import costume_frame_box, fixed_box
+from ..image_index import dhash, find_duplicate
+from ..image_output import EncodedImage, encode_derivatives
+from ..utils import detect_black_bar_width, redis_client, get_s3_client
+from config import AWS_S3_BUCKET
+
+logger = logging.getLogger(__name__)
+
+# Encoded outputs outlive the longest poll, then expire if nobody collects them
+OUTPUT_TTL = 3600
+
+# Costume crops from very high resolution screenshots may be decoded smaller,
+# down to this many pixels a side
+COSTUME_MIN_SIZE = int(os.environ.get('COSTUME_MIN_SIZE', 512))
+
+def run_image_op(prepare, then, key):
+    """Run the ``prepare`` signature on the 'images' queue, then ``then`` with its result.
+
+    ``then`` is the default queue task that carries on, taking the prepared
+    result as its first argument. If either task fails outright, the failure
+    counts as an attempt at the screenshot at ``key``.
+    """
+    (prepare | then).apply_async(link_error=image_op_failed.s(key))
+
+@shared_task
+def image_op_failed(request, exc, traceback, key):
+    """Count a failed chain as a failed attempt, leaving the screenshot for the next folder scan."""
+    attempt_count = redis_client.incr('attempts:' + key)
+    if attempt_count >= 3:
+        logger.error(f"Error processing image {key}: {exc}. Max attempts reached. Deleting image.")
+        get_s3_client().delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        redis_client.delete('attempts:' + key)
+    else:
+        logger.error(f"Error processing image {key}: {exc}. Leaving it for the next scan.")
+    redis_client.delete('lock:' + key)
+
+def store_outputs(encoded, poll_image, derivatives):
+    """Put encoded images in Redis, returning where each one went."""
+    prefix = f"image_ops:{uuid.uuid4().hex}"
+    outputs = {'image': encoded, 'poll': poll_image, **derivatives}
+    pipe = redis_client.pipeline()
+    stored = {}
+    keys = {}
+    for field, output in outputs.items():
+        # The poll usually shares the upload's encode, and then its bytes too
+        if id(output) not in keys:
+            keys[id(output)] = f"{prefix}:{field}"
+            pipe.set(keys[id(output)], output.data, ex=OUTPUT_TTL)
+        stored[field] = {'key': keys[id(output)], 'format': output.format}
+    pipe.execute()
+    return stored
+
+def load_outputs(prepared):
+    """The (encoded, poll_image, derivatives) an image task left in Redis."""
+    pipe = redis_client.pipeline()
+    for output in prepared['outputs'].values():
+        pipe.get(output['key'])
+    loaded = {}
+    for (field, output), data in zip(prepared['outputs'].items(), pipe.execute()):
+        if data is None:
+            raise RuntimeError(f"Encoded {field} image expired before it was used")
+        loaded[field] = EncodedImage(data, output['format'])
+    encoded, poll_image = loaded.pop('image'), loaded.pop('poll')
+    return encoded, poll_image, loaded
+
+def load_image_part(prepared):
+    """The model's image part that prepare_extraction left in Redis."""
+    data = redis_client.get(prepared['outputs']['part']['key'])
+    if data is None:
+        raise RuntimeError("Prepared image part expired before it was used")
+    return json.loads(data)
+
+def discard_outputs(prepared):
+    # Duplicates are dropped before anything is encoded
+    keys = {output['key'] for output in prepared.get('outputs', {}).values()}
+    if keys:
+        redis_client.delete(*keys)
+
+def read_image(key):
+    s3_client = get_s3_client()
+    return s3_client.get_object(Bucket=AWS_S3_BUCKET, Key=key)['Body'].read()
+
+def check_duplicate(image_content, folder, subject):
+    """dHash the upload and look for art already committed for the subject."""
+    art_hash = dhash(image_content)
+    return art_hash, find_duplicate(folder, subject, art_hash)
+
+def prepared_result(art_hash, size, outputs, **extra):
+    width, height = size
+    return {'duplicate': None, 'hash': art_hash, 'width': width, 'height': height, 'outputs': outputs, **extra}
+
+@shared_task
+def prepare_portrait(key, folder, subject):
+    """Trim the black bars off a portrait screenshot, stand it upright and encode it."""
+    image_content = read_image(key)
+    art_hash, duplicate = check_duplicate(image_content, folder, subject)
+    if duplicate:
+        return {'duplicate': duplicate}
+
+    left_bar, right_bar = detect_black_bar_width(io.BytesIO(image_content))
+    logger.info(f"Detected black bar width: Left - {left_bar}px, Right - {right_bar}px")
+    img = Image.open(io.BytesIO(image_content))
+    cropped_img = img.crop((left_bar, 0, img.width - right_bar, img.height))
+    # Rotate the image if cropped width is longer than height
+    if cropped_img.width > cropped_img.height:
+        cropped_img = cropped_img.rotate(-90, expand=True)
+
+    encoded, poll_image = EncodedImage.encode_for(cropped_img)
+    outputs = store_outputs(encoded, poll_image, encode_derivatives(cropped_img, encoded.format))
+    return prepared_result(art_hash, img.size, outputs)
+
+@shared_task
+def prepare_costume(key, folder, subject, use_fixed_ratios=False):
+    """Find and crop the costume frame, decoding only that region, and encode it."""
+    image_content = read_image(key)
+    art_hash, duplicate = check_duplicate(image_content, folder, subject)
+    if duplicate:
+        return {'duplicate': duplicate}
+
+    img = Image.open(io.BytesIO(image_content))
+    if use_fixed_ratios:
+        crop_box = fixed_box(img.width, img.height)
+    else:
+        crop_box = costume_frame_box(image_content, img.width, img.height)
+    # The region decode may shrink img, so note the screenshot's own size first
+    size = img.size
+    cropped_img = decode_region(img, crop_box, COSTUME_MIN_SIZE)
+
+    encoded, poll_image = EncodedImage.encode_for(cropped_img)
+    outputs = store_outputs(encoded, poll_image, encode_derivatives(cropped_img, encoded.format))
+    return prepared_result(art_hash, size, outputs, crop_box=list(crop_box))
+
+@shared_task
+def prepare_illustration(key, folder, subject):
+    """Encode an illustration as PNG and look for the hero's face.
+
+    'image_hash' identifies the upload's bytes, for the extraction cache;
+    'hash' stays the dHash that near-duplicates are matched on.
+    """
+    image_content = read_image(key)
+    art_hash, duplicate = check_duplicate(image_content, folder, subject)
+    if duplicate:
+        return {'duplicate': duplicate}
+
+    image_hash = content_hash(image_content)
+    img = Image.open(io.BytesIO(image_content))
+    face_crop = None
+    # Leave the crop to the model once a contributor has rejected the detector's
+    if not redis_client.exists(f"face_detection_rejected:{image_hash}"):
+        face_crop = detect_face_crop(img)
+    # PNG uploads are sent on as they are; anything else is encoded once
+    encoded = EncodedImage.from_upload(img, image_content)
+    outputs = store_outputs(encoded, encoded, encode_derivatives(img, encoded.format))
+    return prepared_result(art_hash, img.size, outputs, image_hash=image_hash, face_crop=face_crop)
+
+@shared_task
+def prepare_costume_illustration(key, folder, subject):
+    """Make the derivatives of a super costume illustration, which is otherwise sent as uploaded."""
+    image_content = read_image(key)
+    art_hash, duplicate = check_duplicate(image_content, folder, subject)
+    if duplicate:
+        return {'duplicate': duplicate}
+
+    img = Image.open(io.BytesIO(image_content))
+    encoded = EncodedImage(image_content, 'PNG')
+    outputs = store_outputs(encoded, encoded, encode_derivatives(img, encoded.format))
+    return prepared_result(art_hash, img.size, outputs)
+
+@shared_task
+def prepare_extraction(key, folder):
+    """Cut a screenshot down to the panel the model reads, for the extraction tasks.
+
+    A backend that runs locally on this queue, like Tesseract, extracts the
+    screenshot here too, and its (content, source, elapsed) is returned as
+    'extracted'. Hero stats screenshots also get their numbers read here, as
+    'stat_read', unless a poll has already rejected that read.
+    """
+    image_content = read_image(key)
+    image_part = prepare_image(image_content, folder)
+    part_key = f"image_ops:{uuid.uuid4().hex}:part"
+    redis_client.set(part_key, json.dumps(image_part), ex=OUTPUT_TTL)
+
+    extracted = None
+    backend = get_backend(folder)
+    if backend.queue == 'images':
+        extracted = timed_extract(backend, folder, None, image_content)
+
+    image_hash = content_hash(image_content)
+    stat_read = None
+    if folder == 'hero-stats' and not redis_client.exists(f"stat_reader_rejected:{image_hash}"):
+        stat_read = read_stats(image_content)
+    return {'hash': image_hash, 'outputs': {'part': {'key': part_key}}, 'extracted': extracted, 'stat_read': stat_read}
@@ -1,17 +1,16 @@
 import logging
-import math
 import time
 import json
 import requests
-import io
-import tempfile
-import boto3
 import os
 from celery import shared_task
-from PIL import Image
 
 from celery_app.tasks import fetch_item_data
-from ..utils import encode_image_to_base64, redis_client, boto3_config
+from ..utils import redis_client, get_s3_client
+from ..image_index import record_image
+from ..image_output import upload_files
+from ..frame_locator import fixed_box, forget_geometry
+from .image_ops import prepare_costume, run_image_op, load_outputs, discard_outputs
 from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 logger = logging.getLogger(__name__)
@@ -38,7 +37,7 @@ item_types = [
 @shared_task(bind=True)
 def process_costume_task(self, key, folder, item_name, hero_name, item_type):
     if key == "costumes/": return
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -69,131 +68,140 @@ def process_costume_task(self, key, folder, item_name, hero_name, item_type):
         if hero is None:
             logger.info(f"Hero '{hero_name}' not found.")
 
-        equipment_costume_type = next((i for i in item_types if i['value'] == item_type), None)
-
-        # Initialize S3 client using app.config variables
-        s3_client = boto3.client('s3', **boto3_config)
-
-        # Retrieve and process the image from S3
-        response = s3_client.get_object(
-            Bucket=AWS_S3_BUCKET,
-            Key=key
+        # Find, crop and encode the costume frame on the images queue, dropping
+        # near-duplicates of art already committed for this item, then carry on
+        # in finish_costume_task. If a contributor rejected the located crop
+        # for this upload, use the fixed ratios.
+        use_fixed_ratios = bool(redis_client.exists('costume_frame_rejected:' + key))
+        run_image_op(
+            prepare_costume.s(key, folder, item_name, use_fixed_ratios),
+            finish_costume_task.s(key, folder, item_name, hero_name, item_type, hero, item),
+            key,
         )
-        image_content = response['Body'].read()
-
-        # Create a temporary directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save the image in the temporary directory
-            image_path = os.path.join(temp_dir, "image.jpg")
-            with open(image_path, 'wb') as f:
-                f.write(image_content)
-
-            # After determining the bar widths, you can crop the image accordingly:
-            img = Image.open(image_path)
-            crop_dimension = math.floor(img.height * 0.32592)
-            crop_left = math.floor(img.width * 0.32308)
-            crop_top = math.floor(img.height * 0.28241)
-            cropped_img = img.crop((crop_left, crop_top, crop_left + crop_dimension, crop_top + crop_dimension))
-            #logger.info(f"Crop coordinates: {crop_left}, {crop_top}, {crop_left + crop_dimension}, {crop_top + crop_dimension}")
-            # Save the cropped image to separate BytesIO objects
-            img_byte_arr_base64 = io.BytesIO()
-            cropped_img.save(img_byte_arr_base64, format='JPEG')
-            image_bytes = img_byte_arr_base64.getvalue()
-
-            img_byte_arr = io.BytesIO()
-            cropped_img.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)        
-
-            # Prepare and send the poll to Discord
-            embed_data = {
-                "title": f"Costume - {item_name}",
-                "description": "I did my best!",
-                "color": 3447003,  # Example blue color
-                "fields": [
-                    {"name": "Hero", "value": hero['title'], "inline": True} if hero else {"name": "Type", "value": equipment_costume_type['label'], "inline": True},
-                ],
-                "footer": {"text": "Does this look correct?"}
-            }
-
-            # Remove any None fields (in case some stats are not present)
-            embed_data["fields"] = [field for field in embed_data["fields"] if field]
-
-            # Convert the image to Base64
-            base64_image = encode_image_to_base64(image_bytes)
-            
-            # Send poll request to Discord through Redis
-            poll_data = {
-                'channel_id': DISCORD_CHANNEL_ID, 
-                'is_embed': True,
-                'embed': embed_data,
-                'image': base64_image,
-                'filename': item_name + '.jpg',
-                'task_id': process_costume_task.request.id
-            }
-            redis_client.rpush('discord_message_queue', json.dumps(poll_data))
-            logger.info(f"Sent poll to Discord for costume: {item_name}")
-            
-            # Wait for poll result (e.g., 120 seconds)
-            result_key = f"discord_poll_result:{process_costume_task.request.id}"
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            upvotes, downvotes, retry_count = 0, 0, 0
-
-            for _ in range(100):  # Check every second, up to 120 seconds
-                poll_result = redis_client.get(result_key)
-                if poll_result:
-                    poll_result_data = json.loads(poll_result)
-                    upvotes = poll_result_data.get('upvotes', 0)
-                    downvotes = poll_result_data.get('downvotes', 0)
-                    retry_count = poll_result_data.get('retry', 0)
-                    redis_client.delete(result_key)
-                    break
-                time.sleep(1)
-
-            logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            if retry_count > 0:
-                logger.info(f"Retrying processing for costume {item_name}")
-                # Reset attempt count
-                redis_client.set('attempts:' + key, 0)
-                redis_client.delete('lock:' + key)
-                return
-
-            # Prepare the files and payload
-            img_byte_arr.seek(0)
-            files = {
-                'image': (item_name + '.jpg', img_byte_arr, 'image/jpeg')
-            }
-            payload = {
-                'hero_id': str(hero.get('databaseId','')) if hero else '',
-                'item_id': str(item.get('databaseId','')) if item else '',
-                'item_name': item_name,
-                'item_type': equipment_costume_type['label'] if equipment_costume_type else '',
-                'confirmed': '1' if upvotes > downvotes else '0'
-            }
-
-            # Log the data being sent
-            logger.info(f"Sending data: {payload}")
-            logger.info(f"Sending files: {files}")
-
-            # Send the POST request
-            try:
-                update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-costume'
-                response = requests.post(update_url, files=files, data=payload)
-                response.raise_for_status()
-                logger.info("Costume updated successfully")
-            except requests.exceptions.HTTPError as e:
-                logger.error(f"HTTP error occurred: {e}")
-                logger.error(f"Response content: {response.text}")
-                raise
-
-            # Delete the image after processing
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
             s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
             redis_client.delete('attempts:' + key)
             redis_client.delete('lock:' + key)
-            logger.info(f"{key} processed successfully, deleting from S3 bucket.") 
-    except Exception as e:
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            fetch_item_data.delay()  
+            raise self.retry(exc=e, countdown=180)
+
+@shared_task
+def finish_costume_task(prepared, key, folder, item_name, hero_name, item_type, hero, item):
+    """Poll on and commit a costume once the images queue has cropped it."""
+    s3_client = get_s3_client()
+    try:
+        equipment_costume_type = next((i for i in item_types if i['value'] == item_type), None)
+        if prepared['duplicate']:
+            logger.info(f"{key} matches already committed {prepared['duplicate']}. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+            return
+        encoded, poll_image, derivatives = load_outputs(prepared)
+
+        # Prepare and send the poll to Discord
+        embed_data = {
+            "title": f"Costume - {item_name}",
+            "description": "I did my best!",
+            "color": 3447003,  # Example blue color
+            "fields": [
+                {"name": "Hero", "value": hero['title'], "inline": True} if hero else {"name": "Type", "value": equipment_costume_type['label'], "inline": True},
+            ],
+            "footer": {"text": "Does this look correct?"}
+        }
+
+        # Remove any None fields (in case some stats are not present)
+        embed_data["fields"] = [field for field in embed_data["fields"] if field]
+
+        # Send poll request to Discord through Redis
+        poll_data = {
+            'channel_id': DISCORD_CHANNEL_ID, 
+            'is_embed': True,
+            'embed': embed_data,
+            'image': poll_image.base64(),
+            'filename': poll_image.filename(item_name),
+            'task_id': finish_costume_task.request.id
+        }
+        redis_client.rpush('discord_message_queue', json.dumps(poll_data))
+        logger.info(f"Sent poll to Discord for costume: {item_name}")
+        
+        # Wait for poll result (e.g., 120 seconds)
+        result_key = f"discord_poll_result:{finish_costume_task.request.id}"
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        upvotes, downvotes, retry_count = 0, 0, 0
+
+        for _ in range(100):  # Check every second, up to 120 seconds
+            poll_result = redis_client.get(result_key)
+            if poll_result:
+                poll_result_data = json.loads(poll_result)
+                upvotes = poll_result_data.get('upvotes', 0)
+                downvotes = poll_result_data.get('downvotes', 0)
+                retry_count = poll_result_data.get('retry', 0)
+                redis_client.delete(result_key)
+                break
+            time.sleep(1)
+
+        logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        if retry_count > 0:
+            logger.info(f"Retrying processing for costume {item_name}")
+            discard_outputs(prepared)
+            if tuple(prepared['crop_box']) != fixed_box(prepared['width'], prepared['height']):
+                # Locate afresh for this resolution, and use the fixed ratios for this upload
+                forget_geometry(prepared['width'], prepared['height'])
+                redis_client.set('costume_frame_rejected:' + key, 1, ex=86400)
+            # Reset attempt count
+            redis_client.set('attempts:' + key, 0)
+            redis_client.delete('lock:' + key)
+            return
+
+        # Prepare the files and payload
+        # WebP copies and thumbnails, so WordPress doesn't have to make its own
+        files = upload_files(encoded, derivatives, item_name)
+        payload = {
+            'hero_id': str(hero.get('databaseId','')) if hero else '',
+            'item_id': str(item.get('databaseId','')) if item else '',
+            'item_name': item_name,
+            'item_type': equipment_costume_type['label'] if equipment_costume_type else '',
+            'confirmed': '1' if upvotes > downvotes else '0'
+        }
+
+        # Log the data being sent
+        logger.info(f"Sending data: {payload}")
+        logger.info(f"Sending files: {files}")
+
+        # Send the POST request
+        try:
+            update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-costume'
+            response = requests.post(update_url, files=files, data=payload)
+            response.raise_for_status()
+            logger.info("Costume updated successfully")
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"HTTP error occurred: {e}")
+            logger.error(f"Response content: {response.text}")
+            raise
+
+        if upvotes > downvotes:
+            record_image(folder, item_name, prepared['hash'], key)
+
+        # Delete the image after processing
+        s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        redis_client.delete('attempts:' + key)
+        redis_client.delete('lock:' + key)
+        discard_outputs(prepared)
+        logger.info(f"{key} processed successfully, deleting from S3 bucket.") 
+    except Exception:
+        # Nothing will collect the encoded outputs now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -205,4 +213,5 @@ def process_costume_task(self, key, folder, item_name, hero_name, item_type):
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
             fetch_item_data.delay()  
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared outputs are gone
+            process_costume_task.apply_async((key, folder, item_name, hero_name, item_type), countdown=180)
\ No newline at end of file
@@ -2,17 +2,19 @@ import logging
 import time
 import json
 import requests
-import io
-import os
-import tempfile
-import boto3
 from celery import shared_task
-from PIL import Image
 from ..prompts.assistant_prompt import system_prompt
-from ..prompts.hero_illustration_prompt import illustration_prompt
-from ..utils import make_api_call_with_backoff, encode_image_to_base64, redis_client, boto3_config
+from ..prompts.hero_illustration_prompt import illustration_prompt, illustration_schema
+from ..utils import redis_client, get_s3_client
+from ..image_index import record_image
+from ..image_output import upload_files
+from ..llm_client import structured_completion, RateLimited
+from ..schema import response_format
+from ..model_routing import route_models, record_poll_outcome
+from ..extraction_cache import CACHE_TTL, get_extraction, store_extraction, invalidate_extractions
 from .fetch_hero_data import fetch_hero_data
-from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
+from .image_ops import prepare_illustration, run_image_op, load_outputs, discard_outputs
+from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 
 
@@ -21,7 +23,7 @@ logger = logging.getLogger(__name__)
 @shared_task(bind=True)
 def process_hero_illustration_task(self, key, folder, hero_name, region):
     if key == "hero-illustrations/": return
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -45,195 +47,206 @@ def process_hero_illustration_task(self, key, folder, hero_name, region):
             logger.warning(f"Hero '{hero_name}' not found.")
             return
 
-        # Initialize S3 client using app.config variables
-        s3_client = boto3.client('s3', **boto3_config)
+        # Encode the image and find the face locally on the images queue, unless a
+        # contributor already rejected that crop, dropping near-duplicates of art
+        # already committed for this hero and region, then carry on in
+        # finish_hero_illustration_task
+        run_image_op(
+            prepare_illustration.s(key, folder, f"{hero_name}:{region}"),
+            finish_hero_illustration_task.s(key, folder, hero, region),
+            key,
+        )
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
 
+@shared_task(bind=True)
+def finish_hero_illustration_task(self, prepared, key, folder, hero, region):
+    """Extract, poll on and commit an illustration once the images queue has prepared it."""
+    s3_client = get_s3_client()
+    hero_name = hero['slug']
+    try:
         # Generate a pre-signed URL for the image
-        
         pre_signed_url = s3_client.generate_presigned_url(
             'get_object',
             Params={'Bucket': AWS_S3_BUCKET, 'Key': key},
             ExpiresIn=3600  
         )
 
-        # Retrieve and process the image from S3
-        s3_response = s3_client.get_object(
-            Bucket=AWS_S3_BUCKET,
-            Key=key
-        )
-        image_content = s3_response['Body'].read()
-
-        # Save image to a temporary location
-        with tempfile.TemporaryDirectory() as temp_dir:
-            image_path = os.path.join(temp_dir, "image.png")
-            with open(image_path, 'wb') as f:
-                f.write(image_content)
-            original_img = Image.open(image_path)
-
-            # Prepare the messages
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are responsible for looking at screenshots you will be provided with of the popular mobile game, Guardian Tales. Your goal will be to help document information about the heroes in the game on a WordPress database. The heroes are stored as a custom post type called Heroes, with various custom fields representing details about the hero that may be present in these screenshots.",
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": illustration_prompt +  f"{original_img.size[0]}x{original_img.size[1]} pixels.", 
+        if prepared['duplicate']:
+            logger.info(f"{key} matches already committed {prepared['duplicate']}. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+            return
+        image_hash = prepared['image_hash']
+        encoded, _, derivatives = load_outputs(prepared)
+        face_crop = prepared['face_crop']
+
+        # Prepare the messages
+        messages = [
+            {
+                "role": "system",
+                "content": "You are responsible for looking at screenshots you will be provided with of the popular mobile game, Guardian Tales. Your goal will be to help document information about the heroes in the game on a WordPress database. The heroes are stored as a custom post type called Heroes, with various custom fields representing details about the hero that may be present in these screenshots.",
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": illustration_prompt +  f"{prepared['width']}x{prepared['height']} pixels.", 
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": pre_signed_url
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": pre_signed_url
-                            },
-                        }
-                    ],
-                },
-            ]
-
-            # Prepare the data payload (as JSON)
-            payload = {
-                "model": "gpt-4o",
-                "messages": messages,
-                "max_tokens": 1000,
-            }
-
-            # Set up headers
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {OPENAI_API_KEY}"
-            }
-
-            # Make the API call
-            response = make_api_call_with_backoff(
-                "https://api.openai.com/v1/chat/completions",
-                headers,
-                payload
-            )
-
-            # Parse the JSON content
+                    }
+                ],
+            },
+        ]
+
+        # Prepare the data payload (as JSON)
+        payload = {
+            "model": route_models('hero-illustrations')[0],
+            "messages": messages,
+            "max_tokens": 1000,
+            "response_format": response_format('hero_illustration', illustration_schema),
+        }
+
+        if face_crop is not None:
+            crop_data = face_crop
+            extraction_source = 'face-detector'
+        else:
+            # Reuse the extraction from an earlier attempt at this image if there is one
+            extracted_data, cached_source = get_extraction(image_hash, 'hero-illustrations', payload)
+            # Make the API call, re-asking for any fields that don't match the schema;
+            # a crop that can't be repaired raises and counts as a failed attempt
+            crop_data, extraction_source = structured_completion(payload, 'hero-illustrations', illustration_schema, content=extracted_data)
+            extraction_source = extraction_source or cached_source
+            store_extraction(image_hash, 'hero-illustrations', payload, json.dumps(crop_data), extraction_source)
+
+        # Log the crop box
+        logger.info(crop_data)
+
+        # Prepare and send the poll to Discord
+        embed_data = {
+            "title": f"Hero Illustration - {hero['title']}",
+            "description": "Here's what you gave me:",
+            "color": 3447003,  # Example blue color
+            "fields": [
+                {"name": "Region", "value": region, "inline": True} if region else None,
+                {"name": "Found By", "value": "Face detector" if face_crop is not None else extraction_source or "Earlier extraction", "inline": True},
+                {"name": "Crop Data", "value": f"x: {crop_data['x']}, y: {crop_data['y']}, width: {crop_data['width']}, height: {crop_data['height']}", "inline": False},
+            ],
+            "footer": {"text": "Does this look correct?"}
+        }
+
+        # Remove any None fields
+        embed_data["fields"] = [field for field in embed_data["fields"] if field]
+
+        # Send poll request to Discord through Redis
+        poll_data = {
+            'channel_id': DISCORD_CHANNEL_ID,
+            'is_embed': True,
+            'embed': embed_data,
+            'image': encoded.base64(),
+            'filename': encoded.filename(hero_name),
+            'task_id': finish_hero_illustration_task.request.id
+        }
+        redis_client.rpush('discord_message_queue', json.dumps(poll_data))
+        logger.info(f"Sent poll to Discord for hero: {hero['title']}")
+        
+        # Wait for poll result
+        result_key = f"discord_poll_result:{finish_hero_illustration_task.request.id}"
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        upvotes, downvotes, retry_count = 0, 0, 0
+
+        for _ in range(100):  # Check every second, up to 120 seconds
+            poll_result = redis_client.get(result_key)
+            if poll_result:
+                poll_result_data = json.loads(poll_result)
+                upvotes = poll_result_data.get('upvotes', 0)
+                downvotes = poll_result_data.get('downvotes', 0)
+                retry_count = poll_result_data.get('retry', 0)
+                redis_client.delete(result_key)
+                break
+            time.sleep(1)
+
+        logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        record_poll_outcome('hero-illustrations', extraction_source, upvotes, downvotes, retry_count)
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        if retry_count > 0:
+            logger.info(f"Retrying processing for {hero['title']} stats")
+            # The contributor wants a fresh extraction, not the stored one
+            invalidate_extractions(image_hash, 'hero-illustrations')
+            if face_crop is not None:
+                # Ask the model next time rather than repeating the same local crop
+                redis_client.set(f"face_detection_rejected:{image_hash}", 1, ex=CACHE_TTL)
+            discard_outputs(prepared)
+            # Reset attempt count
+            redis_client.set('attempts:' + key, 0)
+            redis_client.delete('lock:' + key)
+            return
+        
+        # Prepare the files and payload
+        # WebP copies and thumbnails, so WordPress doesn't have to make its own
+        files = upload_files(encoded, derivatives, hero_name)
+        payload = {
+            'hero_id': str(hero['databaseId']),
+            'region': str(region),
+            'x': str(crop_data.get('x', 0)),
+            'y': str(crop_data.get('y', 0)),
+            'width': str(crop_data.get('width', 0)),
+            'height': str(crop_data.get('height', 0)),
+            'confirmed': '1' if upvotes > downvotes else '0'
+        }
+
+        # Log the data being sent
+        logger.info(f"Sending data: {payload}")
+        logger.info(f"Sending files: {files}")
+
+        # Send the POST request with form-data
+        try:
+            update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-illustration'
+            response = requests.post(update_url, files=files, data=payload)
             response.raise_for_status()
-            response_json = response.json()            
-
-            # Access the 'choices' data
-            extracted_data = response_json['choices'][0]['message']['content']
-            cleaned_data = extracted_data.strip('```json').strip('```')
-
-            # Log the response JSON
-            logger.info(cleaned_data)
-            
-            # Save the image to separate BytesIO objects
-            img_byte_arr_base64 = io.BytesIO()
-            original_img.save(img_byte_arr_base64, format='PNG')
-            image_bytes = img_byte_arr_base64.getvalue()
-
-            img_byte_arr = io.BytesIO()
-            original_img.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            
-            # Attempt to parse the extracted data as JSON
-            try:  
-                crop_data = json.loads(cleaned_data)
-
-                # Prepare and send the poll to Discord
-                embed_data = {
-                    "title": f"Hero Illustration - {hero['title']}",
-                    "description": "Here's what you gave me:",
-                    "color": 3447003,  # Example blue color
-                    "fields": [
-                        {"name": "Region", "value": region, "inline": True} if region else None,
-                        {"name": "Crop Data", "value": f"x: {crop_data['x']}, y: {crop_data['y']}, width: {crop_data['width']}, height: {crop_data['height']}", "inline": False},
-                    ],
-                    "footer": {"text": "Does this look correct?"}
-                }
-
-                # Remove any None fields
-                embed_data["fields"] = [field for field in embed_data["fields"] if field]
-
-                # Convert the image to Base64
-                base64_image = encode_image_to_base64(image_bytes)
-
-                # Send poll request to Discord through Redis
-                poll_data = {
-                    'channel_id': DISCORD_CHANNEL_ID,
-                    'is_embed': True,
-                    'embed': embed_data,
-                    'image': base64_image,
-                    'filename': hero_name + '.png',
-                    'task_id': process_hero_illustration_task.request.id
-                }
-                redis_client.rpush('discord_message_queue', json.dumps(poll_data))
-                logger.info(f"Sent poll to Discord for hero: {hero['title']}")
-                
-                # Wait for poll result
-                result_key = f"discord_poll_result:{process_hero_illustration_task.request.id}"
-                
-                # If upvotes are higher than downvotes, post the data to WordPress
-                upvotes, downvotes, retry_count = 0, 0, 0
-
-                for _ in range(100):  # Check every second, up to 120 seconds
-                    poll_result = redis_client.get(result_key)
-                    if poll_result:
-                        poll_result_data = json.loads(poll_result)
-                        upvotes = poll_result_data.get('upvotes', 0)
-                        downvotes = poll_result_data.get('downvotes', 0)
-                        retry_count = poll_result_data.get('retry', 0)
-                        redis_client.delete(result_key)
-                        break
-                    time.sleep(1)
-
-                logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
-                
-                # If upvotes are higher than downvotes, post the data to WordPress
-                if retry_count > 0:
-                    logger.info(f"Retrying processing for {hero['title']} stats")
-                    # Reset attempt count
-                    redis_client.set('attempts:' + key, 0)
-                    redis_client.delete('lock:' + key)
-                    return
-                
-                # Prepare the files and payload
-                img_byte_arr.seek(0)
-                files = {
-                    'image': (hero_name + '.png', img_byte_arr, 'image/png')
-                }
-                payload = {
-                    'hero_id': str(hero['databaseId']),
-                    'region': str(region),
-                    'x': str(crop_data.get('x', 0)),
-                    'y': str(crop_data.get('y', 0)),
-                    'width': str(crop_data.get('width', 0)),
-                    'height': str(crop_data.get('height', 0)),
-                    'confirmed': '1' if upvotes > downvotes else '0'
-                }
-
-                # Log the data being sent
-                logger.info(f"Sending data: {payload}")
-                logger.info(f"Sending files: {files}")
-
-                # Send the POST request with form-data
-                try:
-                    update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-illustration'
-                    response = requests.post(update_url, files=files, data=payload)
-                    response.raise_for_status()
-                    logger.info("Hero illustration/thumbnail updated successfully")
-                except requests.exceptions.HTTPError as e:
-                    logger.error(f"HTTP error occurred: {e}")
-                    logger.error(f"Response content: {response.text}")
-                    raise
-                
-                # Delete the image after processing
-                s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
-                redis_client.delete('attempts:' + key)
-                redis_client.delete('lock:' + key)
-                logger.info(f"{key} processed successfully, deleting from S3 bucket.")
-                fetch_hero_data.delay()    
-            except json.JSONDecodeError as e:
-                logger.error("Failed to parse JSON from AI response")
-                logger.error(e)
-    except Exception as e:
+            logger.info("Hero illustration/thumbnail updated successfully")
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"HTTP error occurred: {e}")
+            logger.error(f"Response content: {response.text}")
+            raise
+        
+        if upvotes > downvotes:
+            record_image(folder, f"{hero_name}:{region}", prepared['hash'], key)
+
+        # Delete the image after processing
+        s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        redis_client.delete('attempts:' + key)
+        redis_client.delete('lock:' + key)
+        discard_outputs(prepared)
+        logger.info(f"{key} processed successfully, deleting from S3 bucket.")
+        fetch_hero_data.delay()    
+    except RateLimited as e:
+        # Out of shared API budget: re-queue without counting a failed attempt,
+        # keeping the lock so the folder scan doesn't pick the image up again
+        logger.info(f"Rate limited while processing image {key}. Retrying after {e.retry_after:.0f} seconds.")
+        redis_client.expire('lock:' + key, int(e.retry_after) + 600)
+        raise self.retry(exc=e, countdown=e.retry_after, max_retries=None)
+    except Exception:
+        # Nothing will collect the encoded outputs now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -244,4 +257,5 @@ def process_hero_illustration_task(self, key, folder, hero_name, region):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared outputs are gone
+            process_hero_illustration_task.apply_async((key, folder, hero_name, region), countdown=180)
\ No newline at end of file
@@ -2,13 +2,11 @@ import logging
 import time
 import json
 import requests
-import io
-import tempfile
-import boto3
-import os
 from celery import shared_task
-from PIL import Image
-from ..utils import encode_image_to_base64, detect_black_bar_width, redis_client, boto3_config
+from ..utils import redis_client, get_s3_client
+from ..image_index import record_image
+from ..image_output import upload_files
+from .image_ops import prepare_portrait, run_image_op, load_outputs, discard_outputs
 from .fetch_hero_data import fetch_hero_data
 from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
@@ -19,7 +17,7 @@ logger = logging.getLogger(__name__)
 @shared_task(bind=True)
 def process_hero_portrait_task(self, key, folder, hero_name, region):
     if key == "hero-portraits/": return
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -43,133 +41,132 @@ def process_hero_portrait_task(self, key, folder, hero_name, region):
             logger.warning(f"Hero '{hero_name}' not found.")
             return
 
-        # Initialize S3 client using app.config variables
-        s3_client = boto3.client('s3', **boto3_config)
-
-        # Retrieve and process the image from S3
-        response = s3_client.get_object(
-            Bucket=AWS_S3_BUCKET,
-            Key=key
+        # Crop and encode on the images queue, dropping near-duplicates of art
+        # already committed for this hero and region, then carry on in
+        # finish_hero_portrait_task
+        run_image_op(
+            prepare_portrait.s(key, folder, f"{hero_name}:{region}"),
+            finish_hero_portrait_task.s(key, folder, hero, region),
+            key,
         )
-        image_content = response['Body'].read()
-
-        # Create a temporary directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save the image in the temporary directory
-            image_path = os.path.join(temp_dir, "image.jpg")
-            with open(image_path, 'wb') as f:
-                f.write(image_content)
-
-            # Detect the black bar width
-            left_bar, right_bar = detect_black_bar_width(image_path)
-            print(f"Detected black bar width: Left - {left_bar}px, Right - {right_bar}px")
-
-            # After determining the bar widths, you can crop the image accordingly:
-            img = Image.open(image_path)
-            cropped_img = img.crop((left_bar, 0, img.width - right_bar, img.height))
-
-            # Rotate the image if cropped width is longer than height
-            if cropped_img.width > cropped_img.height:
-                cropped_img = cropped_img.rotate(-90, expand=True)
-
-            # Save the cropped image to separate BytesIO objects
-            img_byte_arr_base64 = io.BytesIO()
-            cropped_img.save(img_byte_arr_base64, format='JPEG')
-            image_bytes = img_byte_arr_base64.getvalue()
-
-            img_byte_arr = io.BytesIO()
-            cropped_img.save(img_byte_arr, format='JPEG')
-            img_byte_arr.seek(0)
-
-            # Prepare and send the poll to Discord
-            embed_data = {
-                "title": f"Hero Portrait - {hero['title']}",
-                "description": "I did my best!",
-                "color": 3447003,  # Example blue color
-                "fields": [
-                    {"name": "Region", "value": region, "inline": True} if region else None,                        
-                ],
-                "footer": {"text": "Does this look correct?"}
-            }
-
-            # Remove any None fields (in case some stats are not present)
-            embed_data["fields"] = [field for field in embed_data["fields"] if field]
-
-            # Convert the image to Base64
-            base64_image = encode_image_to_base64(image_bytes)
-            
-            # Send poll request to Discord through Redis
-            poll_data = {
-                'channel_id': DISCORD_CHANNEL_ID, 
-                'is_embed': True,
-                'embed': embed_data,
-                'image': base64_image,
-                'filename': hero_name + '.jpg',
-                'task_id': process_hero_portrait_task.request.id
-            }
-            redis_client.rpush('discord_message_queue', json.dumps(poll_data))
-            logger.info(f"Sent poll to Discord for hero: {hero['title']}")
-            
-            # Wait for poll result (e.g., 120 seconds)
-            result_key = f"discord_poll_result:{process_hero_portrait_task.request.id}"
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            upvotes, downvotes, retry_count = 0, 0, 0
-
-            for _ in range(100):  # Check every second, up to 120 seconds
-                poll_result = redis_client.get(result_key)
-                if poll_result:
-                    poll_result_data = json.loads(poll_result)
-                    upvotes = poll_result_data.get('upvotes', 0)
-                    downvotes = poll_result_data.get('downvotes', 0)
-                    retry_count = poll_result_data.get('retry', 0)
-                    redis_client.delete(result_key)
-                    break
-                time.sleep(1)
-
-            logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            if retry_count > 0:
-                logger.info(f"Retrying processing for {hero['title']} stats")
-                # Reset attempt count
-                redis_client.set('attempts:' + key, 0)
-                redis_client.delete('lock:' + key)
-                return
-
-            # Prepare the files and payload
-            img_byte_arr.seek(0)
-            files = {
-                'image': (hero_name + '.jpg', img_byte_arr, 'image/jpeg')
-            }
-            payload = {
-                'hero_id': str(hero['databaseId']),
-                'region': str(region),
-                'confirmed': '1' if upvotes > downvotes else '0'
-            }
-
-            # Log the data being sent
-            logger.info(f"Sending data: {payload}")
-            logger.info(f"Sending files: {files}")
-
-            # Send the POST request
-            try:
-                update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-portrait'
-                response = requests.post(update_url, files=files, data=payload)
-                response.raise_for_status()
-                logger.info("Hero portrait updated successfully")
-            except requests.exceptions.HTTPError as e:
-                logger.error(f"HTTP error occurred: {e}")
-                logger.error(f"Response content: {response.text}")
-                raise
-
-            # Delete the image after processing
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
             s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
             redis_client.delete('attempts:' + key)
             redis_client.delete('lock:' + key)
-            logger.info(f"{key} processed successfully, deleting from S3 bucket.")
-            fetch_hero_data.delay()    
-    except Exception as e:
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
+
+@shared_task
+def finish_hero_portrait_task(prepared, key, folder, hero, region):
+    """Poll on and commit a portrait once the images queue has prepared it."""
+    s3_client = get_s3_client()
+    hero_name = hero['slug']
+    try:
+        if prepared['duplicate']:
+            logger.info(f"{key} matches already committed {prepared['duplicate']}. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+            return
+        encoded, poll_image, derivatives = load_outputs(prepared)
+
+        # Prepare and send the poll to Discord
+        embed_data = {
+            "title": f"Hero Portrait - {hero['title']}",
+            "description": "I did my best!",
+            "color": 3447003,  # Example blue color
+            "fields": [
+                {"name": "Region", "value": region, "inline": True} if region else None,                        
+            ],
+            "footer": {"text": "Does this look correct?"}
+        }
+
+        # Remove any None fields (in case some stats are not present)
+        embed_data["fields"] = [field for field in embed_data["fields"] if field]
+
+        # Send poll request to Discord through Redis
+        poll_data = {
+            'channel_id': DISCORD_CHANNEL_ID, 
+            'is_embed': True,
+            'embed': embed_data,
+            'image': poll_image.base64(),
+            'filename': poll_image.filename(hero_name),
+            'task_id': finish_hero_portrait_task.request.id
+        }
+        redis_client.rpush('discord_message_queue', json.dumps(poll_data))
+        logger.info(f"Sent poll to Discord for hero: {hero['title']}")
+        
+        # Wait for poll result (e.g., 120 seconds)
+        result_key = f"discord_poll_result:{finish_hero_portrait_task.request.id}"
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        upvotes, downvotes, retry_count = 0, 0, 0
+
+        for _ in range(100):  # Check every second, up to 120 seconds
+            poll_result = redis_client.get(result_key)
+            if poll_result:
+                poll_result_data = json.loads(poll_result)
+                upvotes = poll_result_data.get('upvotes', 0)
+                downvotes = poll_result_data.get('downvotes', 0)
+                retry_count = poll_result_data.get('retry', 0)
+                redis_client.delete(result_key)
+                break
+            time.sleep(1)
+
+        logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        if retry_count > 0:
+            logger.info(f"Retrying processing for {hero['title']} stats")
+            discard_outputs(prepared)
+            # Reset attempt count
+            redis_client.set('attempts:' + key, 0)
+            redis_client.delete('lock:' + key)
+            return
+
+        # Prepare the files and payload
+        # WebP copies and thumbnails, so WordPress doesn't have to make its own
+        files = upload_files(encoded, derivatives, hero_name)
+        payload = {
+            'hero_id': str(hero['databaseId']),
+            'region': str(region),
+            'confirmed': '1' if upvotes > downvotes else '0'
+        }
+
+        # Log the data being sent
+        logger.info(f"Sending data: {payload}")
+        logger.info(f"Sending files: {files}")
+
+        # Send the POST request
+        try:
+            update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-portrait'
+            response = requests.post(update_url, files=files, data=payload)
+            response.raise_for_status()
+            logger.info("Hero portrait updated successfully")
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"HTTP error occurred: {e}")
+            logger.error(f"Response content: {response.text}")
+            raise
+
+        if upvotes > downvotes:
+            record_image(folder, f"{hero_name}:{region}", prepared['hash'], key)
+
+        # Delete the image after processing
+        s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        redis_client.delete('attempts:' + key)
+        redis_client.delete('lock:' + key)
+        discard_outputs(prepared)
+        logger.info(f"{key} processed successfully, deleting from S3 bucket.")
+        fetch_hero_data.delay()    
+    except Exception:
+        # Nothing will collect the encoded outputs now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -180,4 +177,5 @@ def process_hero_portrait_task(self, key, folder, hero_name, region):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared outputs are gone
+            process_hero_portrait_task.apply_async((key, folder, hero_name, region), countdown=180)
\ No newline at end of file
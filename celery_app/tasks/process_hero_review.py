@@ -5,9 +5,11 @@ import requests
 from celery import shared_task
 from ..prompts.proofreader_system_prompt import proofreader_system
 from ..prompts.hero_story_prompt import story_prompt
-from ..utils import make_api_call_with_backoff, redis_client
+from ..utils import redis_client
+from ..llm_client import routed_completion, RateLimited
+from ..model_routing import route_models
 from .fetch_hero_data import fetch_hero_data
-from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
+from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 
 
@@ -15,7 +17,6 @@ logger = logging.getLogger(__name__)
 
 @shared_task(bind=True)
 def process_hero_review_task(self, hero, channel_id, content):
-    global redis_client, OPENAI_API_KEY
     # Retrieve cached data
     cached_data = redis_client.get('hero_data')
     if cached_data is None:
@@ -48,30 +49,18 @@ def process_hero_review_task(self, hero, channel_id, content):
 
     # Prepare the data payload (as JSON)
     payload = {
-        "model": "gpt-4o",
+        "model": route_models('hero-review')[0],
         "messages": messages,
         "max_tokens": 2000,
     }
 
-    # Set up headers
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
-
-    # Make the API call
-    response = make_api_call_with_backoff(
-        "https://api.openai.com/v1/chat/completions",
-        headers,
-        payload
-    )
-
-    # Parse the JSON content
-    response.raise_for_status()
-    response_json = response.json()            
-
-    # Access the 'choices' data
-    updated_review = response_json['choices'][0]['message']['content']
+    # Make the API call, coming back later if the shared API budget is used up
+    try:
+        result = routed_completion(payload, 'hero-review', accept=lambda result: bool(result.content.strip()))
+    except RateLimited as e:
+        logger.info(f"Rate limited while reviewing {hero['title']}. Retrying after {e.retry_after:.0f} seconds.")
+        raise self.retry(exc=e, countdown=e.retry_after, max_retries=None)
+    updated_review = result.content
 
     logger.info("updated_review: " + updated_review)
 
@@ -2,22 +2,59 @@ import logging
 import time
 import json
 import requests
-import boto3
 from celery import shared_task
-from ..prompts.assistant_prompt import system_prompt
-from ..prompts.stat_prompt import stat_prompt
-from ..utils import make_api_call_with_backoff, redis_client, boto3_config
+from ..prompts.task_system_prompts import task_system_prompts
+from ..prompts.stat_prompt import stat_prompt, stat_schema
+from ..utils import redis_client, get_s3_client
+from ..llm_client import structured_completion, RateLimited, InvalidExtraction
+from ..schema import response_format, sub_schema
+from ..model_routing import route_models, record_poll_outcome
+from ..stat_reader import MIN_CONFIDENCE
+from ..extraction_cache import CACHE_TTL, get_extraction, store_extraction, invalidate_extractions
+from .image_ops import prepare_extraction, run_image_op, load_image_part, discard_outputs
 from .fetch_hero_data import fetch_hero_data
-from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
+from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 
 
 logger = logging.getLogger(__name__)
 
+def build_payload(hero, image_part, schema=stat_schema):
+    """The chat request for one hero stats screenshot, also used to key batched extractions.
+
+    A narrower ``schema`` asks only for those fields, when the rest were read
+    from the screen.
+    """
+    prompt = stat_prompt
+    if schema is not stat_schema:
+        prompt += f"\nThe stat values have already been read. Only report these fields: {', '.join(schema['properties'])}."
+    messages = [
+        {
+            "role": "system",
+            "content": task_system_prompts['hero-stats'],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt,
+                },
+                image_part,
+            ],
+        },
+    ]
+    return {
+        "model": route_models('hero-stats')[0],
+        "messages": messages,
+        "max_tokens": 1000,
+        "response_format": response_format('hero_stats', schema),
+    }
+
 @shared_task(bind=True)
 def process_hero_stats_task(self, key, folder, hero_name):
     if key == "hero-stats/": return    
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -41,69 +78,68 @@ def process_hero_stats_task(self, key, folder, hero_name):
             logger.warning(f"Hero '{hero_name}' not found.")
             return
 
-        s3_client = boto3.client('s3', **boto3_config)
-
-        # Generate a pre-signed URL for the image    
-        pre_signed_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': AWS_S3_BUCKET, 'Key': key},
-            ExpiresIn=3600
+        # Cut the screenshot down to the panel the model needs on the images
+        # queue, then carry on in finish_hero_stats_task
+        run_image_op(
+            prepare_extraction.s(key, 'hero-stats'),
+            finish_hero_stats_task.s(key, folder, hero),
+            key,
         )
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
 
-        # AI processing: Preparing the AI payload
-        messages = [
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": stat_prompt,
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": pre_signed_url
-                        },
-                    }
-                ],
-            },
-        ]
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": messages,
-            "max_tokens": 1000,
-        }
+@shared_task
+def finish_hero_stats_task(prepared, key, folder, hero):
+    """Extract, poll on and commit a stats screenshot once the images queue has prepared it."""
+    s3_client = get_s3_client()
+    try:
+        hero_name = hero['slug']
+        image_hash = prepared['hash']
+        image_part = load_image_part(prepared)
+        # Only the request needs the panel from here on
+        discard_outputs(prepared)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
-        }
+        payload = build_payload(hero, image_part)
+        schema = stat_schema
 
-        # Make the API call to OpenAI
-        response = make_api_call_with_backoff(
-            "https://api.openai.com/v1/chat/completions",
-            headers,
-            payload
-        )
-        response.raise_for_status()
-        response_json = response.json()
+        # Reuse the extraction from an earlier attempt at this image if there is one
+        extracted_data, cached_source = get_extraction(image_hash, 'hero-stats', payload)
 
-        # Process the AI response
-        extracted_data = response_json['choices'][0]['message']['content']
-        cleaned_data = extracted_data.strip('```json').strip('```')
+        # Take the numbers read on the images queue when every character matched
+        # well, and ask the model only for the equipment and Co-op Expedition lines
+        local_stats = None
+        stat_read = prepared.get('stat_read')
+        if stat_read and extracted_data is None:
+            if stat_read[1] >= MIN_CONFIDENCE:
+                local_stats = stat_read[0]
+                schema = sub_schema(stat_schema, [name for name in stat_schema['properties'] if name not in local_stats])
+                payload = build_payload(hero, image_part, schema)
+                extracted_data, cached_source = get_extraction(image_hash, 'hero-stats', payload)
+            else:
+                logger.info(f"Local stat read confidence {stat_read[1]:.2f} is too low, asking the model")
 
-        # Attempt to parse the extracted data as JSON
+        # Make the API call, re-asking for any fields that don't match the schema
         try:
-            hero_stats = json.loads(cleaned_data)
+            hero_stats, extraction_source = structured_completion(payload, 'hero-stats', schema, content=extracted_data)
+            extraction_source = extraction_source or cached_source
             logger.info("Successfully processed JSON from AI response")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON: {e}")
-            return
+            store_extraction(image_hash, 'hero-stats', payload, json.dumps(hero_stats), extraction_source)
+            if local_stats:
+                hero_stats = {**local_stats, **hero_stats}
+        except InvalidExtraction as e:
+            logger.error(f"Failed to extract valid JSON: {e} {e.errors}")
+            # Counted as a failed attempt below, which also releases the lock
+            raise
 
         # Example payload for hero stats from AI response
         payload = {
@@ -163,13 +199,13 @@ def process_hero_stats_task(self, key, folder, hero_name):
             'channel_id': DISCORD_CHANNEL_ID, 
             'is_embed': True,
             'embed': embed_data,
-            'task_id': process_hero_stats_task.request.id
+            'task_id': finish_hero_stats_task.request.id
         }
         redis_client.rpush('discord_message_queue', json.dumps(poll_data))
         logger.info(f"Sent poll to Discord for hero: {hero['title']}")
 
         # Wait for poll result (e.g., 60 seconds)
-        result_key = f"discord_poll_result:{process_hero_stats_task.request.id}"
+        result_key = f"discord_poll_result:{finish_hero_stats_task.request.id}"
         
         # If upvotes are higher than downvotes, post the data to WordPress
         upvotes, downvotes, retry_count = 0, 0, 0
@@ -186,12 +222,18 @@ def process_hero_stats_task(self, key, folder, hero_name):
             time.sleep(1)
 
         logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        record_poll_outcome('hero-stats', extraction_source, upvotes, downvotes, retry_count)
         
         update_url = f"{WORDPRESS_SITE}/wp-json/heavenhold/v1/update-stats"
         
         # If upvotes are higher than downvotes, post the data to WordPress
         if retry_count > 0:
             logger.info(f"Retrying processing for {hero['title']} stats")
+            # The contributor wants a fresh extraction, not the stored one
+            invalidate_extractions(image_hash, 'hero-stats')
+            if local_stats:
+                # Ask the model for the numbers next time rather than repeating the same read
+                redis_client.set(f"stat_reader_rejected:{image_hash}", 1, ex=CACHE_TTL)
             # Reset attempt count
             redis_client.set('attempts:' + key, 0)
             redis_client.delete('lock:' + key)
@@ -246,7 +288,15 @@ def process_hero_stats_task(self, key, folder, hero_name):
         redis_client.delete('lock:' + key)
         logger.info(f"{key} processed successfully, deleting from S3 bucket.")
         fetch_hero_data.delay()    
-    except Exception as e:
+    except RateLimited as e:
+        # Out of shared API budget: re-queue without counting a failed attempt,
+        # keeping the lock so the folder scan doesn't pick the image up again
+        logger.info(f"Rate limited while processing image {key}. Retrying after {e.retry_after:.0f} seconds.")
+        redis_client.expire('lock:' + key, int(e.retry_after) + 600)
+        process_hero_stats_task.apply_async((key, folder, hero_name), countdown=e.retry_after)
+    except Exception:
+        # Nothing will collect the prepared panel now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -257,4 +307,5 @@ def process_hero_stats_task(self, key, folder, hero_name):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared panel is gone
+            process_hero_stats_task.apply_async((key, folder, hero_name), countdown=180)
\ No newline at end of file
@@ -2,22 +2,94 @@ import logging
 import time
 import json
 import requests
-import boto3
 from celery import shared_task
-from ..prompts.assistant_prompt import system_prompt
-from ..prompts.hero_story_prompt import story_prompt
-from ..utils import make_api_call_with_backoff, redis_client, boto3_config
+from ..prompts.task_system_prompts import task_system_prompts
+from ..prompts.hero_story_prompt import story_prompt, story_schema
+from ..utils import redis_client, get_s3_client
+from ..llm_client import structured_completion, RateLimited
+from ..schema import response_format
+from ..extraction_backends import extract
+from ..model_routing import route_models, record_poll_outcome
+from ..extraction_cache import get_extraction, store_extraction, invalidate_extractions
+from .image_ops import prepare_extraction, run_image_op, load_image_part, discard_outputs
 from .fetch_hero_data import fetch_hero_data
-from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
+from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 
 
 logger = logging.getLogger(__name__)
 
+# How long a committed story is trusted over hero_data, which is refreshed
+# in the background after each update
+STORY_TTL = 3600
+
+def merge_story(existing, new):
+    """Add a newly read part of a story to what's recorded."""
+    if not new or new in existing:
+        return existing
+    if not existing or existing in new:
+        return new
+    # Join on the longest overlap between the end of one part and the start of the other
+    for size in range(min(len(existing), len(new)), 20, -1):
+        if existing.endswith(new[:size]):
+            return existing + new[size:]
+        if new.endswith(existing[:size]):
+            return new + existing[size:]
+    return existing + '<br /><br />' + new
+
+def recorded_story(hero):
+    """The hero's story as last committed, which hero_data may not show yet."""
+    committed = redis_client.get(f"hero_story:{hero['slug']}")
+    if committed is not None:
+        return committed.decode('utf-8')
+    return hero['heroInformation']['bioFields'].get('story') or ''
+
+def commit_story(hero, fragment, update_url, confirmed):
+    """Merge a story part into the latest recorded story and post it.
+
+    Merging happens here rather than at extraction, under a per-hero lock, so
+    screenshots of the same story committed close together each add to the
+    others' parts instead of overwriting them.
+    """
+    with redis_client.lock(f"story_lock:{hero['slug']}", timeout=60, blocking_timeout=60):
+        story = merge_story(recorded_story(hero), fragment)
+        response = requests.post(update_url, json={
+            'hero_id': hero['databaseId'],
+            'story': story,
+            'confirmed': confirmed
+        })
+        response.raise_for_status()
+        redis_client.set(f"hero_story:{hero['slug']}", story, ex=STORY_TTL)
+
+def build_payload(hero, image_part):
+    """The chat request for one hero story screenshot, also used to key batched extractions."""
+    messages = [
+        {
+            "role": "system",
+            "content": task_system_prompts['hero-stories'],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": story_prompt,
+                },
+                image_part,
+            ],
+        },
+    ]
+    return {
+        "model": route_models('hero-stories')[0],
+        "messages": messages,
+        "max_tokens": 1000,
+        "response_format": response_format('hero_story', story_schema),
+    }
+
 @shared_task(bind=True)
 def process_hero_story_task(self, key, folder, hero_name):
     if key == "hero-stories/": return
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -40,152 +112,134 @@ def process_hero_story_task(self, key, folder, hero_name):
         if hero is None:
             logger.warning(f"Hero '{hero_name}' not found.")
             return
-        
-        s3_client = boto3.client('s3', **boto3_config)
 
-        # Generate a pre-signed URL for the image       
-        pre_signed_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': AWS_S3_BUCKET, 'Key': key},
-            ExpiresIn=3600  
+        # Cut the screenshot down to the panel the model needs on the images
+        # queue, then carry on in finish_hero_story_task
+        run_image_op(
+            prepare_extraction.s(key, 'hero-stories'),
+            finish_hero_story_task.s(key, folder, hero),
+            key,
         )
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
 
-        # Prepare the messages
-        messages = [
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": story_prompt + json.dumps(hero['heroInformation']['bioFields']),
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": pre_signed_url
-                        },
-                    }
-                ],
-            },
-        ]
-
-        # Prepare the data payload (as JSON)
+@shared_task
+def finish_hero_story_task(prepared, key, folder, hero):
+    """Extract, poll on and commit a story screenshot once the images queue has prepared it."""
+    s3_client = get_s3_client()
+    try:
+        hero_name = hero['slug']
+        image_hash = prepared['hash']
+        image_part = load_image_part(prepared)
+        # Only the request needs the panel from here on
+        discard_outputs(prepared)
+
+        payload = build_payload(hero, image_part)
+
+        # Reuse the extraction from an earlier attempt at this image if there is one
+        extracted_data, extraction_source = get_extraction(image_hash, 'hero-stories', payload)
+        if extracted_data is None:
+            # Extract with the backend configured for this screen
+            extracted_data, extraction_source = extract('hero-stories', payload, key, prepared['extracted'])
+
+        # Check the extraction against the schema, re-asking the model for any
+        # fields that don't match; an extraction that can't be repaired raises
+        # and counts as a failed attempt
+        hero_story, repair_model = structured_completion(payload, 'hero-stories', story_schema, content=extracted_data)
+        extraction_source = repair_model or extraction_source
+        logger.info("Successfully processed JSON from AI response")
+        store_extraction(image_hash, 'hero-stories', payload, json.dumps(hero_story), extraction_source)
+
+        # The part of the story on this screenshot
+        fragment = hero_story.get('story') or ''
         payload = {
-            "model": "gpt-4o",
-            "messages": messages,
-            "max_tokens": 1000,
+            'hero_id': hero.get('databaseId', 0),
+            'story': merge_story(recorded_story(hero), fragment),
         }
 
-        # Set up headers
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
+        # Prepare and send the poll to Discord
+        embed_data = {
+            "title": f"Hero Story - {hero['title']}",
+            "description": "Here's what I found in your image:\n\n" + (payload['story'] + "").replace("<br />", "\n"),
+            "color": 3447003,                
+            "footer": {"text": "Does this look correct?"}
         }
-
-        # Make the API call
-        response = make_api_call_with_backoff(
-            "https://api.openai.com/v1/chat/completions",
-            headers,
-            payload
-        )
-
-        # Parse the JSON content
-        response.raise_for_status()
-        response_json = response.json()            
-
-        # Access the 'choices' data
-        extracted_data = response_json['choices'][0]['message']['content']
-        cleaned_data = extracted_data.strip('```json').strip('```')
-
-        # Attempt to parse the extracted data as JSON
-        try:                
-            hero_story = json.loads(cleaned_data)
-            logger.info("Successfully processed JSON from AI response")
-
-            payload = {
-                'hero_id': hero.get('databaseId', 0),
-                'story': hero_story.get('story', 0),
-            }
-
-            # Prepare and send the poll to Discord
-            embed_data = {
-                "title": f"Hero Story - {hero['title']}",
-                "description": "Here's what I found in your image:\n\n" + (payload['story'] + "").replace("<br />", "\n"),
-                "color": 3447003,                
-                "footer": {"text": "Does this look correct?"}
-            }
-            
-            # Send poll request to Discord through Redis
-            poll_data = {
-                'channel_id': DISCORD_CHANNEL_ID, 
-                'is_embed': True,
-                'embed': embed_data,
-                'task_id': process_hero_story_task.request.id
-            }
-            redis_client.rpush('discord_message_queue', json.dumps(poll_data))
-            logger.info(f"Sent poll to Discord for hero: {hero['title']}")
-            
-            # Wait for poll result (e.g., 60 seconds)
-            result_key = f"discord_poll_result:{process_hero_story_task.request.id}"
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            upvotes, downvotes, retry_count = 0, 0, 0
-
-            for _ in range(100):  # Check every second, up to 120 seconds
-                poll_result = redis_client.get(result_key)
-                if poll_result:
-                    poll_result_data = json.loads(poll_result)
-                    upvotes = poll_result_data.get('upvotes', 0)
-                    downvotes = poll_result_data.get('downvotes', 0)
-                    retry_count = poll_result_data.get('retry', 0)
-                    redis_client.delete(result_key)
-                    break
-                time.sleep(1)
-
-            logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
-            
-            update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-story'
-            
-            # If upvotes are higher than downvotes, post the data to WordPress
-            if retry_count > 0:
-                logger.info(f"Retrying processing for {hero['title']} stats")
-                # Reset attempt count
-                redis_client.set('attempts:' + key, 0)
-                redis_client.delete('lock:' + key)
-                return
-            elif upvotes > downvotes:
-                response = requests.post(update_url, json={
-                    'hero_id': hero['databaseId'],
-                    'story': payload['story'],
-                    'confirmed': True
-                })
-                response.raise_for_status()
-                logger.info("Hero story updated successfully")
-            elif upvotes == 0 and downvotes == 0:
-                response = requests.post(update_url, json={
-                    'hero_id': hero['databaseId'],
-                    'story': payload['story'],
-                    'confirmed': True
-                })
-                response.raise_for_status()
-                logger.info("Hero story updated successfully")
-            else:
-                logger.info(f"Aborting story update for {hero['title']}")
-
-            # Delete the image after processing (if desired)
-            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
-            redis_client.delete('attempts:' + key)
+        
+        # Send poll request to Discord through Redis
+        poll_data = {
+            'channel_id': DISCORD_CHANNEL_ID, 
+            'is_embed': True,
+            'embed': embed_data,
+            'task_id': finish_hero_story_task.request.id
+        }
+        redis_client.rpush('discord_message_queue', json.dumps(poll_data))
+        logger.info(f"Sent poll to Discord for hero: {hero['title']}")
+        
+        # Wait for poll result (e.g., 60 seconds)
+        result_key = f"discord_poll_result:{finish_hero_story_task.request.id}"
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        upvotes, downvotes, retry_count = 0, 0, 0
+
+        for _ in range(100):  # Check every second, up to 120 seconds
+            poll_result = redis_client.get(result_key)
+            if poll_result:
+                poll_result_data = json.loads(poll_result)
+                upvotes = poll_result_data.get('upvotes', 0)
+                downvotes = poll_result_data.get('downvotes', 0)
+                retry_count = poll_result_data.get('retry', 0)
+                redis_client.delete(result_key)
+                break
+            time.sleep(1)
+
+        logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        record_poll_outcome('hero-stories', extraction_source, upvotes, downvotes, retry_count)
+        
+        update_url = WORDPRESS_SITE + '/wp-json/heavenhold/v1/update-story'
+        
+        # If upvotes are higher than downvotes, post the data to WordPress
+        if retry_count > 0:
+            logger.info(f"Retrying processing for {hero['title']} stats")
+            # The contributor wants a fresh extraction, not the stored one
+            invalidate_extractions(image_hash, 'hero-stories')
+            # Reset attempt count
+            redis_client.set('attempts:' + key, 0)
             redis_client.delete('lock:' + key)
-            logger.info(f"{key} processed successfully, deleting from S3 bucket.")
-            fetch_hero_data.delay()    
-        except json.JSONDecodeError as e:
-            logger.error("Failed to parse JSON from AI response")
-            logger.error(e)
-    except Exception as e:
+            return
+        elif upvotes > downvotes:
+            commit_story(hero, fragment, update_url, True)
+            logger.info("Hero story updated successfully")
+        elif upvotes == 0 and downvotes == 0:
+            commit_story(hero, fragment, update_url, True)
+            logger.info("Hero story updated successfully")
+        else:
+            logger.info(f"Aborting story update for {hero['title']}")
+
+        # Delete the image after processing (if desired)
+        s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+        redis_client.delete('attempts:' + key)
+        redis_client.delete('lock:' + key)
+        logger.info(f"{key} processed successfully, deleting from S3 bucket.")
+        fetch_hero_data.delay()    
+    except RateLimited as e:
+        # Out of shared API budget: re-queue without counting a failed attempt,
+        # keeping the lock so the folder scan doesn't pick the image up again
+        logger.info(f"Rate limited while processing image {key}. Retrying after {e.retry_after:.0f} seconds.")
+        redis_client.expire('lock:' + key, int(e.retry_after) + 600)
+        process_hero_story_task.apply_async((key, folder, hero_name), countdown=e.retry_after)
+    except Exception:
+        # Nothing will collect the prepared panel now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -196,4 +250,5 @@ def process_hero_story_task(self, key, folder, hero_name):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared panel is gone
+            process_hero_story_task.apply_async((key, folder, hero_name), countdown=180)
\ No newline at end of file
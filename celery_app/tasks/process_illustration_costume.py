@@ -1,14 +1,15 @@
-import io
 import logging
 import time
 import json
 import requests
-import boto3
 from celery import shared_task
 from ..prompts.item_system_prompt import item_system
 from ..prompts.weapon_prompt import weapon_prompt
-from ..utils import encode_image_to_base64, redis_client, boto3_config
+from ..utils import redis_client, get_s3_client
+from ..image_index import record_image
+from ..image_output import upload_files
 from .fetch_item_data import fetch_item_data
+from .image_ops import prepare_costume_illustration, run_image_op, load_outputs, discard_outputs
 from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
 
 logger = logging.getLogger(__name__)
@@ -16,7 +17,7 @@ logger = logging.getLogger(__name__)
 @shared_task(bind=True)
 def process_costume_illustration_task(self, key, folder, item_name, hero_name):
     if key == "costume-illustrations/": return    
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -45,8 +46,6 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
         if item is None:                        
             raise Exception(f"Item '{item_name}' not found.")
 
-        # Initialize S3 client using app.config variables
-        s3_client = boto3.client('s3', **boto3_config)
 
         # Generate a pre-signed URL for the image
         
@@ -56,21 +55,39 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
             ExpiresIn=3600  
         )
 
-        # Retrieve and process the image from S3
-        s3_response = s3_client.get_object(
-            Bucket=AWS_S3_BUCKET,
-            Key=key
+        # Make the derivatives on the images queue, dropping near-duplicates of
+        # art already committed for this item, then carry on in
+        # finish_costume_illustration_task. The upload itself is sent on as it is.
+        run_image_op(
+            prepare_costume_illustration.s(key, folder, item_name),
+            finish_costume_illustration_task.s(key, folder, item_name, hero_name, hero, item),
+            key,
         )
-        image_content = s3_response['Body'].read()
-
-        # Save the image to separate BytesIO objects
-        img_byte_arr_base64 = io.BytesIO()
-        img_byte_arr_base64.write(image_content)
-        image_bytes = img_byte_arr_base64.getvalue()
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
 
-        img_byte_arr = io.BytesIO()
-        img_byte_arr.write(image_content)
-        img_byte_arr.seek(0)
+@shared_task
+def finish_costume_illustration_task(prepared, key, folder, item_name, hero_name, hero, item):
+    """Poll on and commit a super costume illustration once its derivatives are made."""
+    s3_client = get_s3_client()
+    try:
+        if prepared['duplicate']:
+            logger.info(f"{key} matches already committed {prepared['duplicate']}. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+            return
+        encoded, _, derivatives = load_outputs(prepared)
 
         # Prepare and send the poll to Discord
         embed_data = {
@@ -88,23 +105,20 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
         # Remove any None fields (in case some stats are not present)
         embed_data["fields"] = [field for field in embed_data["fields"] if field]
 
-        # Convert the image to Base64
-        base64_image = encode_image_to_base64(image_bytes)
-        
         # Send poll request to Discord through Redis
         poll_data = {
             'channel_id': DISCORD_CHANNEL_ID, 
             'is_embed': True,
             'embed': embed_data,
-            'image': base64_image,
-            'filename': item_name + '.png',
-            'task_id': process_costume_illustration_task.request.id
+            'image': encoded.base64(),
+            'filename': encoded.filename(item_name),
+            'task_id': finish_costume_illustration_task.request.id
         }
         redis_client.rpush('discord_message_queue', json.dumps(poll_data))
         logger.info(f"Sent poll to Discord for costume: {item['title']}")
         
         # Wait for poll result (e.g., 120 seconds)
-        result_key = f"discord_poll_result:{process_costume_illustration_task.request.id}"
+        result_key = f"discord_poll_result:{finish_costume_illustration_task.request.id}"
         
         # If upvotes are higher than downvotes, post the data to WordPress
         upvotes, downvotes, retry_count = 0, 0, 0
@@ -125,16 +139,15 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
         # If upvotes are higher than downvotes, post the data to WordPress
         if retry_count > 0:
             logger.info(f"Retrying processing for {item['title']} stats")
+            discard_outputs(prepared)
             # Reset attempt count
             redis_client.set('attempts:' + key, 0)
             redis_client.delete('lock:' + key)
             return
 
         # Prepare the files and payload
-        img_byte_arr.seek(0)
-        files = {
-            'image': (item_name + '.png', img_byte_arr, 'image/png')
-        }
+        # WebP copies and thumbnails, so WordPress doesn't have to make its own
+        files = upload_files(encoded, derivatives, item_name)
         payload = {
             'item_id': str(item['databaseId']),
             'confirmed': '1' if upvotes > downvotes else '0'
@@ -155,12 +168,18 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
             logger.error(f"Response content: {response.text}")
             raise
 
+        if upvotes > downvotes:
+            record_image(folder, item_name, prepared['hash'], key)
+
         # Delete the image after processing
         s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
         redis_client.delete('attempts:' + key)
         redis_client.delete('lock:' + key)
+        discard_outputs(prepared)
         logger.info(f"{key} processed successfully, deleting from S3 bucket.") 
-    except Exception as e:
+    except Exception:
+        # Nothing will collect the encoded outputs now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -171,4 +190,5 @@ def process_costume_illustration_task(self, key, folder, item_name, hero_name):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared outputs are gone
+            process_costume_illustration_task.apply_async((key, folder, item_name, hero_name), countdown=180)
\ No newline at end of file
@@ -2,13 +2,17 @@ import logging
 import time
 import json
 import requests
-import boto3
 from celery import shared_task
 from ..prompts.item_system_prompt import item_system
-from ..prompts.weapon_prompt import weapon_prompt
-from ..utils import make_api_call_with_backoff, format_option, format_engraving, redis_client, boto3_config
+from ..prompts.weapon_prompt import weapon_prompt, weapon_schema
+from ..utils import format_option, format_engraving, redis_client, get_s3_client
+from ..llm_client import structured_completion, RateLimited, InvalidExtraction
+from ..schema import response_format
+from ..model_routing import route_models, record_poll_outcome
+from ..extraction_cache import get_extraction, store_extraction, invalidate_extractions
+from .image_ops import prepare_extraction, run_image_op, load_image_part, discard_outputs
 from .fetch_item_data import fetch_item_data
-from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET, OPENAI_API_KEY
+from config import DISCORD_CHANNEL_ID, WORDPRESS_SITE, AWS_S3_BUCKET
 
 
 
@@ -17,7 +21,7 @@ logger = logging.getLogger(__name__)
 @shared_task(bind=True)
 def process_weapon_information_task(self, key, folder, item_name):
     if key == "weapon-information/": return    
-    global redis_client, AWS_S3_BUCKET, boto3_config, OPENAI_API_KEY
+    s3_client = get_s3_client()
     attempt_count = int(redis_client.get('attempts:' + key) or 0)
     # Check the attempt count    
     if attempt_count >= 3:
@@ -41,15 +45,36 @@ def process_weapon_information_task(self, key, folder, item_name):
             logger.warning(f"Item '{item_name}' not found, creating a new item.")
             new_item = True
 
-
-        s3_client = boto3.client('s3', **boto3_config)
-
-        # Generate a pre-signed URL for the image    
-        pre_signed_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': AWS_S3_BUCKET, 'Key': key},
-            ExpiresIn=3600
+        # Cut the screenshot down to the panel the model needs on the images
+        # queue, then carry on in finish_weapon_information_task
+        run_image_op(
+            prepare_extraction.s(key, 'weapon-information'),
+            finish_weapon_information_task.s(key, folder, item_name, item),
+            key,
         )
+    except Exception as e:
+        # Increment the attempt count
+        attempt_count = redis_client.incr('attempts:' + key)
+        if attempt_count >= 3:
+            logger.exception(f"Error processing image {key}. Max attempts reached. Deleting image.")
+            s3_client.delete_object(Bucket=AWS_S3_BUCKET, Key=key)
+            redis_client.delete('attempts:' + key)
+            redis_client.delete('lock:' + key)
+        else:
+            logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
+            redis_client.delete('lock:' + key)
+            raise self.retry(exc=e, countdown=180)
+
+@shared_task
+def finish_weapon_information_task(prepared, key, folder, item_name, item):
+    """Extract, poll on and commit weapon information once the images queue has prepared it."""
+    s3_client = get_s3_client()
+    try:
+        new_item = item is None
+        image_hash = prepared['hash']
+        image_part = load_image_part(prepared)
+        # Only the request needs the panel from here on
+        discard_outputs(prepared)
 
         # AI processing: Preparing the AI payload
         messages = [
@@ -64,47 +89,31 @@ def process_weapon_information_task(self, key, folder, item_name):
                         "type": "text",
                     "text": weapon_prompt + json.dumps(item),
                     },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": pre_signed_url
-                        },
-                    }
+                    image_part,
                 ],
             },
         ]
         
         payload = {
-            "model": "gpt-4o",
+            "model": route_models('weapon-information')[0],
             "messages": messages,
             "max_tokens": 1000,
+            "response_format": response_format('weapon_information', weapon_schema),
         }
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
-        }
-
-        # Make the API call to OpenAI
-        response = make_api_call_with_backoff(
-            "https://api.openai.com/v1/chat/completions",
-            headers,
-            payload
-        )
-        response.raise_for_status()
-        response_json = response.json()
-
-        # Process the AI response
-        extracted_data = response_json['choices'][0]['message']['content']
-        cleaned_data = extracted_data.strip('```json').strip('```')
+        # Reuse the extraction from an earlier attempt at this image if there is one
+        extracted_data, cached_source = get_extraction(image_hash, 'weapon-information', payload)
 
-        # Attempt to parse the extracted data as JSON
+        # Make the API call, re-asking for any fields that don't match the schema
         try:
-            item_info = json.loads(cleaned_data)
+            item_info, extraction_source = structured_completion(payload, 'weapon-information', weapon_schema, content=extracted_data)
+            extraction_source = extraction_source or cached_source
             logger.info("Successfully processed JSON from AI response")
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON: {e}")
-            return
+            store_extraction(image_hash, 'weapon-information', payload, json.dumps(item_info), extraction_source)
+        except InvalidExtraction as e:
+            logger.error(f"Failed to extract valid JSON: {e} {e.errors}")
+            # Counted as a failed attempt below, which also releases the lock
+            raise
         
         # Ensure 'main_option' is always a list
         main_option = item_info.get("main_option", [])
@@ -184,13 +193,13 @@ def process_weapon_information_task(self, key, folder, item_name):
             'channel_id': DISCORD_CHANNEL_ID, 
             'is_embed': True,
             'embed': embed_data,
-            'task_id': process_weapon_information_task.request.id
+            'task_id': finish_weapon_information_task.request.id
         }
         redis_client.rpush('discord_message_queue', json.dumps(poll_data))
         logger.info(f"Sent poll to Discord for item: {item['title']}")
 
         # Wait for poll result (e.g., 60 seconds)
-        result_key = f"discord_poll_result:{process_weapon_information_task.request.id}"
+        result_key = f"discord_poll_result:{finish_weapon_information_task.request.id}"
         upvotes, downvotes, retry_count = 0, 0, 0
 
         for _ in range(100):  # Check every second, up to 120 seconds
@@ -205,12 +214,15 @@ def process_weapon_information_task(self, key, folder, item_name):
             time.sleep(1)
 
         logger.info("Checking poll results: Upvotes - %d, Downvotes - %d", upvotes, downvotes)
+        record_poll_outcome('weapon-information', extraction_source, upvotes, downvotes, retry_count)
         
         update_url = f"{WORDPRESS_SITE}/wp-json/heavenhold/v1/update-weapon"
         
         # If upvotes are higher than downvotes, post the data to WordPress
         if retry_count > 0:
             logger.info(f"Retrying processing for weapon {item['title']}")
+            # The contributor wants a fresh extraction, not the stored one
+            invalidate_extractions(image_hash, 'weapon-information')
             # Reset attempt count
             redis_client.set('attempts:' + key, 0)
             redis_client.delete('lock:' + key)
@@ -275,7 +287,15 @@ def process_weapon_information_task(self, key, folder, item_name):
         redis_client.delete('lock:' + key)
         logger.info(f"{key} processed successfully, deleting from S3 bucket.")
         fetch_item_data.delay()
-    except Exception as e:
+    except RateLimited as e:
+        # Out of shared API budget: re-queue without counting a failed attempt,
+        # keeping the lock so the folder scan doesn't pick the image up again
+        logger.info(f"Rate limited while processing image {key}. Retrying after {e.retry_after:.0f} seconds.")
+        redis_client.expire('lock:' + key, int(e.retry_after) + 600)
+        process_weapon_information_task.apply_async((key, folder, item_name), countdown=e.retry_after)
+    except Exception:
+        # Nothing will collect the prepared panel now
+        discard_outputs(prepared)
         # Increment the attempt count
         attempt_count = redis_client.incr('attempts:' + key)
         if attempt_count >= 3:
@@ -286,4 +306,5 @@ def process_weapon_information_task(self, key, folder, item_name):
         else:
             logger.exception(f"Error processing image {key}. Retrying after 180 seconds.")
             redis_client.delete('lock:' + key)
-            raise self.retry(exc=e, countdown=180)
\ No newline at end of file
+            # Start over, since the prepared panel is gone
+            process_weapon_information_task.apply_async((key, folder, item_name), countdown=180)
\ No newline at end of file
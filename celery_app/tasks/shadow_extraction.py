@@ -0,0 +1,23 @@
+import logging
+from celery import shared_task
+from ..extraction_backends import BACKENDS, timed_extract, compare_shadow
+from ..utils import get_s3_client
+from config import AWS_S3_BUCKET
+
+logger = logging.getLogger(__name__)
+
+@shared_task(ignore_result=True)
+def shadow_extract(task_type, shadow_name, payload, key, primary_name, content, elapsed):
+    """Extract a screenshot with a shadow backend and compare it with the primary's output."""
+    try:
+        image_content = get_s3_client().get_object(Bucket=AWS_S3_BUCKET, Key=key)['Body'].read()
+    except Exception as e:
+        # The task commits and deletes the screenshot once its poll is over
+        logger.info(f"Skipping shadow {shadow_name} extraction of {key}: {e}")
+        return
+    try:
+        shadow_content, _, shadow_elapsed = timed_extract(BACKENDS[shadow_name], task_type, payload, image_content)
+    except Exception as e:
+        logger.warning(f"Shadow {shadow_name} extraction for {task_type} failed: {e}")
+        return
+    compare_shadow(task_type, primary_name, content, elapsed, shadow_name, shadow_content, shadow_elapsed)
@@ -1,14 +1,27 @@
+import os
 import redis
+import boto3
 import logging
 import base64
-import requests
-from PIL import Image
+import threading
 import numpy as np
+from botocore.config import Config
+from .decoding import open_reduced
 from config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION
 
 logger = logging.getLogger(__name__)
 
-redis_client = redis.Redis(host='redis-service', port=6379, db=0)
+# Connections shared by every task in the process. Under the gevent pool
+# hundreds of tasks share them, so they wait for a free connection (up to
+# REDIS_POOL_TIMEOUT seconds) rather than opening one each
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 100))
+REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 20))
+S3_MAX_CONNECTIONS = int(os.environ.get('S3_MAX_CONNECTIONS', 50))
+
+redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    host='redis-service', port=6379, db=0,
+    max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+))
 
 # Store boto3 config as a variable to re-use
 boto3_config = {
@@ -17,6 +30,23 @@ boto3_config = {
     'region_name': AWS_REGION
 }
 
+_s3_client = None
+_s3_lock = threading.Lock()
+
+def get_s3_client():
+    """The process's S3 client, created on first use.
+
+    Clients are safe to share between threads and greenlets, but creating one
+    from boto3's default session isn't, so it's made once from its own session.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                session = boto3.session.Session(**boto3_config)
+                _s3_client = session.client('s3', config=Config(max_pool_connections=S3_MAX_CONNECTIONS))
+    return _s3_client
+
 def format_option(option):
     """Format each option for display."""
     if option["is_range"]:
@@ -28,10 +58,16 @@ def format_engraving(option):
     """Format each option for display."""
     return f"{option['stat']} {option['value']}"
 
+# Bars only need measuring to within a few pixels, so large JPEGs are
+# decoded at reduced scale down to about this width
+BAR_DETECTION_WIDTH = 1024
+
 def detect_black_bar_width(image_path, threshold=10, black_threshold=50):
-    # Open image and convert to grayscale
-    img = Image.open(image_path).convert('L')  # Convert to grayscale ('L' mode)
+    # Open image and convert to grayscale, decoding only the luma of JPEGs
+    img, scale = open_reduced(image_path, (BAR_DETECTION_WIDTH, 1), mode='L')
+    img = img.convert('L')  # Convert to grayscale ('L' mode)
     img_array = np.array(img)
+    threshold = max(1, round(threshold * scale))
 
     height, width = img_array.shape
 
@@ -59,7 +95,8 @@ def detect_black_bar_width(image_path, threshold=10, black_threshold=50):
     left_black_bar_width = detect_black_bar_from_edge(left_edge)
     right_black_bar_width = detect_black_bar_from_edge(np.fliplr(right_edge))  # Flip for right side detection
 
-    return left_black_bar_width, right_black_bar_width
+    # Back to full resolution pixels
+    return round(left_black_bar_width / scale), round(right_black_bar_width / scale)
 
 def encode_image_to_base64(image_content):
     return base64.b64encode(image_content).decode('utf-8')
@@ -79,36 +116,3 @@ def handle_expired_keys():
 
 def on_key_expired(key):
     logger.info(f"Key {key} has expired after 180 seconds.")
-
-def make_api_call_with_backoff(url, headers, payload, max_retries=10, backoff_factor=1, max_delay=600):
-    delay = backoff_factor
-    last_exception = None
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            return response
-        except requests.exceptions.HTTPError as e:
-            last_exception = e
-            response = e.response
-            if response.status_code == 429:
-                # Rate limit exceeded
-                # Get the 'Retry-After' header if present
-                retry_after = response.headers.get('Retry-After')
-                if retry_after:
-                    delay = int(retry_after)
-                else:
-                    delay = min(delay * 8, max_delay)  # Exponential backoff
-                logger.warning(f"Rate limit exceeded. Retrying in {delay} seconds.")
-                time.sleep(delay)
-            else:
-                # Other HTTP errors
-                logger.error(f"HTTP error occurred: {e}")
-                logger.error(f"Response content: {response.text}")
-                raise
-        except requests.exceptions.RequestException as e:
-            # Network errors
-            logger.error(f"Network error occurred: {e}")
-            raise
-    logger.error("Max retries exceeded")
-    raise last_exception if last_exception else Exception("Max retries exceeded")
\ No newline at end of file
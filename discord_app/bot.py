@@ -1,11 +1,14 @@
 import asyncio
+import hashlib
 import logging
 import sys
 import io
 from io import BytesIO
 import os
+import time
 from typing import Literal
 import uuid
+import zipfile
 import discord
 import boto3
 import base64
@@ -30,12 +33,11 @@ if parent_dir not in sys.path:
     sys.path.insert(0, parent_dir)
 
 from config import DISCORD_TOKEN, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION, AWS_S3_BUCKET, GUILD_ID, WORDPRESS_SITE, DISCORD_CHANNEL_ID
+from discord_app.gateway import gateway_options, lean_mode_enabled
+from discord_app.outbound import OutboundQueue, INTERACTIVE
 
-intents = discord.Intents.default()
-intents.members = True
-intents.guilds = True
-intents.reactions = True
-intents.message_content = True
+# Set DISCORD_LEAN_MODE=1 to skip member chunking and guild-wide caches
+LEAN_MODE = lean_mode_enabled()
 
 # Initialize Redis client
 redis_client = redis.Redis(host='redis-service', port=6379, db=0)
@@ -44,7 +46,24 @@ dropdown_options = []
 item_options = []
 hero_name_mapping = {}
 item_name_mapping = {}
-waiting_polls = {}
+
+# Polls awaiting a reaction are kept in a Redis hash keyed by message ID so
+# they survive bot restarts and don't depend on the client's message cache
+POLL_STATE_KEY = 'discord_polls'
+POLL_TIMEOUT = 60
+
+# Hash of the last synced command tree, so restarts only sync when commands change
+COMMAND_TREE_HASH_KEY = 'discord_command_tree_hash'
+# Set DISCORD_SYNC_TO_GUILD=1 in development to sync instantly to GUILD_ID only
+SYNC_TO_GUILD = os.environ.get('DISCORD_SYNC_TO_GUILD', '0').lower() in ('1', 'true', 'yes')
+
+# All outbound Discord requests go through one paced, prioritised queue
+outbound = OutboundQueue()
+OUTBOUND_METRICS_KEY = 'discord_outbound_metrics'
+# Number of queued Celery messages picked up per check
+MESSAGES_PER_CHECK = 10
+# Keep references to background sends so they aren't garbage collected
+pending_sends = set()
 
 def decode_base64_to_image(base64_string):
     return io.BytesIO(base64.b64decode(base64_string))
@@ -106,58 +125,105 @@ dropdown_options, hero_name_mapping = fetch_hero_data()
 
 class Lahn(commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)
+        super().__init__(command_prefix="!", **gateway_options(LEAN_MODE))
     
     async def setup_hook(self):
-        guild = discord.Object(id=GUILD_ID)        
-        # Sync commands for the specific guild
-        self.tree.add_command(submit_hero_review)
-        self.tree.add_command(submit_hero_illustration)
-        self.tree.add_command(submit_hero_bio)
-        self.tree.add_command(submit_hero_portrait)
-        self.tree.add_command(submit_hero_story)
-        self.tree.add_command(submit_hero_stats)
-        self.tree.add_command(submit_weapon_information)
-        self.tree.add_command(submit_merch_information)
-        self.tree.add_command(submit_card_information)
-        self.tree.add_command(submit_relic_information)
-        self.tree.add_command(submit_accessory_information)        
-        self.tree.add_command(submit_costume)
-        self.tree.add_command(add_new_hero)
-        self.tree.add_command(add_new_item)        
-        await self.tree.sync()
-        logger.info("Bot started successfully.")
+        outbound.start()
+        for command in slash_commands:
+            self.tree.add_command(command)
+        guild = discord.Object(id=GUILD_ID) if SYNC_TO_GUILD else None
+        await sync_command_tree(self.tree, guild=guild)
+        logger.info(f"Bot started successfully (lean mode: {LEAN_MODE}).")
+
+def command_tree_hash(tree: app_commands.CommandTree, guild: discord.abc.Snowflake = None):
+    commands_payload = []
+    for command in tree.get_commands(guild=guild):
+        try:
+            commands_payload.append(command.to_dict(tree))
+        except TypeError:
+            # Older discord.py versions don't take the tree argument
+            commands_payload.append(command.to_dict())
+    serialized = json.dumps(commands_payload, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+async def sync_command_tree(tree: app_commands.CommandTree, guild: discord.abc.Snowflake = None, force: bool = False):
+    if guild is not None:
+        tree.copy_global_to(guild=guild)
+    scope = f"guild:{guild.id}" if guild is not None else "global"
+    hash_key = f"{COMMAND_TREE_HASH_KEY}:{tree.client.application_id}:{scope}"
+    tree_hash = command_tree_hash(tree, guild=guild)
+
+    cached_hash = redis_client.get(hash_key)
+    if not force and cached_hash is not None and cached_hash.decode('utf-8') == tree_hash:
+        logger.info(f"Command tree unchanged ({scope}), skipping sync.")
+        return False
+
+    logger.info(f"Syncing command tree ({scope})...")
+    await tree.sync(guild=guild)
+    redis_client.set(hash_key, tree_hash)
+    logger.info(f"Command tree synced ({scope}).")
+    return True
 
 bot = Lahn()
 
 @bot.event
 async def on_ready():
     logger.info(f'Logged in as {bot.user}')
-    check_redis_for_messages.start()
+    # on_ready fires again after a reconnect, so only start the loops once
+    if not check_redis_for_messages.is_running():
+        check_redis_for_messages.start()
+    if not refresh_cached_data.is_running():
+        refresh_cached_data.start()
+    if not expire_polls.is_running():
+        expire_polls.start()
+    if not publish_outbound_metrics.is_running():
+        publish_outbound_metrics.start()
 
 @tasks.loop(seconds=10)
 async def check_redis_for_messages():
     try:
-        message = redis_client.lpop('discord_message_queue')  # Fetch message from Redis queue
-        if message:
+        for _ in range(MESSAGES_PER_CHECK):
+            message = redis_client.lpop('discord_message_queue')  # Fetch message from Redis queue
+            if not message:
+                break
             message_data = json.loads(message)
-            channel_id = int(message_data['channel_id'])                        
-            
+            channel_id = int(message_data['channel_id'])
+
             # Check if it's an embed
             if message_data.get('is_embed', False):
                 embed_data = message_data['embed']
                 task_id = message_data['task_id']  # Task ID for tracking poll result
                 image = message_data.get('image', None)
                 filename = message_data.get('filename', None)
-                await send_embed_to_channel(channel_id, embed_data, task_id, image=image, filename=filename)
+                send = send_embed_to_channel(channel_id, embed_data, task_id, image=image, filename=filename)
             else:
                 content = message_data['message']
-                await send_message_to_channel(channel_id, content)
+                send = send_message_to_channel(channel_id, content)
+
+            # The outbound queue paces the sends, so don't wait on each one here
+            send_task = asyncio.create_task(send)
+            pending_sends.add(send_task)
+            send_task.add_done_callback(pending_sends.discard)
     except Exception as e:
         logger.error(f"Error while checking Redis: {e}")
 
+@tasks.loop(seconds=30)
+async def publish_outbound_metrics():
+    metrics = outbound.metrics()
+    redis_client.hset(OUTBOUND_METRICS_KEY, mapping=metrics)
+    if metrics['queue_depth'] or metrics['rate_limited']:
+        logger.info(f"Outbound queue: {metrics}")
+
+async def send_followup(interaction: discord.Interaction, *args, **kwargs):
+    # Interaction follow-ups jump ahead of queued poll traffic
+    return await outbound.submit(
+        ('interaction', interaction.id),
+        lambda: interaction.followup.send(*args, **kwargs),
+        priority=INTERACTIVE,
+    )
+
 @tasks.loop(seconds=120)
-async def check_redis_for_messages():
+async def refresh_cached_data():
     global item_options, item_name_mapping, dropdown_options, hero_name_mapping
     item_options, item_name_mapping = fetch_item_data()
     dropdown_options, hero_name_mapping = fetch_hero_data()
@@ -166,36 +232,89 @@ async def check_redis_for_messages():
 async def send_message_to_channel(channel_id: int, message: str):
     channel = bot.get_channel(channel_id)
     if channel:
-        await channel.send(message)
+        await outbound.submit(('messages', channel_id), lambda: channel.send(message))
         logger.info(f"Message sent to channel {channel_id}: {message}")
     else:
         logger.error(f"Channel {channel_id} not found")
 
-# Global variables to store upvotes and downvotes for specific tasks
-vote_counts = {}
-
 @bot.event
-async def on_reaction_add(reaction, user):
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     # Ignore the bot's own reactions
-    if user == bot.user:
+    if payload.user_id == bot.user.id:
+        return
+
+    cached_poll = redis_client.hget(POLL_STATE_KEY, payload.message_id)
+    if cached_poll is None:
+        return
+
+    poll_info = json.loads(cached_poll)
+    emoji = str(payload.emoji)
+    if emoji == '✅':
+        poll_info['upvotes'] += 1
+    elif emoji == '❌':
+        poll_info['downvotes'] += 1
+    elif emoji == '🔄':
+        poll_info['retry'] += 1
+    else:
         return
 
-    message_id = reaction.message.id
+    logger.info(f"Reaction added: {emoji} by {payload.user_id}, updated votes: ✅ {poll_info['upvotes']}, ❌ {poll_info['downvotes']}, 🔄 {poll_info['retry']}")
 
-    if message_id in waiting_polls:
-        poll_info = waiting_polls[message_id]
-        if reaction.emoji == '✅':
-            poll_info['upvotes'] += 1
-        elif reaction.emoji == '❌':
-            poll_info['downvotes'] += 1
-        elif reaction.emoji == '🔄':
-            poll_info['retry'] += 1
+    # A single reaction is enough to settle the poll
+    await finalize_poll(payload.message_id, poll_info)
 
-        logger.info(f"Reaction added: {reaction.emoji} by {user.name}, updated votes: ✅ {poll_info['upvotes']}, ❌ {poll_info['downvotes']}, 🔄 {poll_info.get('retry', 0)}")
+@tasks.loop(seconds=5)
+async def expire_polls():
+    try:
+        now = time.time()
+        for message_id, cached_poll in redis_client.hgetall(POLL_STATE_KEY).items():
+            poll_info = json.loads(cached_poll)
+            if poll_info['deadline'] <= now:
+                logger.info(f"Reaction timeout reached for message ID {int(message_id)}")
+                await finalize_poll(int(message_id), poll_info)
+    except Exception as e:
+        logger.error(f"Error while expiring polls: {e}")
 
-        # If at least one reaction received, set the future result to proceed
-        if not poll_info['future'].done():
-            poll_info['future'].set_result(None)
+async def finalize_poll(message_id: int, poll_info: dict):
+    # Whoever removes the poll from the hash gets to report its result
+    if not redis_client.hdel(POLL_STATE_KEY, message_id):
+        return
+
+    upvotes = poll_info['upvotes']
+    downvotes = poll_info['downvotes']
+    retry_count = poll_info['retry']
+    task_id = poll_info['task_id']
+
+    poll_result = {
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'retry': retry_count
+    }
+    redis_client.set(f"discord_poll_result:{task_id}", json.dumps(poll_result))
+    redis_client.expire(f"discord_poll_result:{task_id}", 60)
+
+    # Update the embed based on poll results
+    embed = discord.Embed.from_dict(poll_info['embed'])
+    if retry_count > 0:
+        embed.color = discord.Color.dark_grey()
+        embed.set_footer(text="Okay, I'll try again!")
+    elif upvotes > downvotes:
+        embed.color = discord.Color.green()
+        embed.set_footer(text="Thanks for confirming! I'll update the site now.")
+    elif downvotes > upvotes:
+        embed.color = discord.Color.red()
+        embed.set_footer(text="Okay, I won't update the site then.")
+    else:
+        embed.color = discord.Color.orange()
+        embed.set_footer(text="No confirmation received, I'll create a revision.")
+
+    # A partial message works even when the original isn't in the client cache
+    channel = bot.get_partial_messageable(poll_info['channel_id'])
+    try:
+        poll_message = channel.get_partial_message(message_id)
+        await outbound.submit(('messages', channel.id), lambda: poll_message.edit(embed=embed))
+    except Exception as e:
+        logger.error(f"Failed to update poll message {message_id}: {e}")
 
 async def send_embed_to_channel(channel_id: int, embed_data: dict, task_id: str, image: str = None, filename: str = None):
     channel = bot.get_channel(channel_id)
@@ -265,7 +384,7 @@ async def send_embed_to_channel(channel_id: int, embed_data: dict, task_id: str,
 
                 if compressed_image_size > 8000000:
                     logger.error("Compressed image still exceeds 8 MB after resizing and compression.")
-                    await channel.send("The image is too large to send, even after compression. Please use a smaller image.")
+                    await outbound.submit(('messages', channel_id), lambda: channel.send("The image is too large to send, even after compression. Please use a smaller image."))
                     return
 
                 image_bytes = compressed_image
@@ -277,108 +396,49 @@ async def send_embed_to_channel(channel_id: int, embed_data: dict, task_id: str,
             logger.error(f"Failed to decode or process base64 image: {e}")
             return
 
-        # Create the Discord file and set the image in the embed
-        discord_file = discord.File(fp=image_bytes, filename=filename)
+        # Set the image in the embed; the Discord file is created when the message is sent
         embed.set_image(url=f"attachment://{filename}")
         logger.debug(f"Embed image URL set to: attachment://{filename}")
 
         # Send the message with the embed and the file
         try:
-            poll_message = await channel.send(embed=embed, file=discord_file)
+            poll_message = await outbound.submit(
+                ('messages', channel_id),
+                lambda: channel.send(embed=embed, file=discord.File(fp=image_bytes, filename=filename)),
+            )
             logger.debug("Message sent successfully with embed and image.")
         except Exception as e:
             logger.error(f"Failed to send message: {e}")
             return
     else:
         try:
-            poll_message = await channel.send(embed=embed)
+            poll_message = await outbound.submit(('messages', channel_id), lambda: channel.send(embed=embed))
             logger.debug("Message sent successfully with embed only.")
         except Exception as e:
             logger.error(f"Failed to send message: {e}")
             return
 
-    await poll_message.add_reaction('✅')
-    await poll_message.add_reaction('❌')
-    await poll_message.add_reaction('🔄')
-
-    # Create a future to wait for reactions
-    future = asyncio.Future()
-    # Store the future and counts in waiting_polls
-    waiting_polls[poll_message.id] = {'future': future, 'upvotes': 0, 'downvotes': 0, 'retry': 0, 'task_id': task_id}
-
-    try:
-        # Wait for the future to be set
-        await asyncio.wait_for(future, timeout=60.0)
-    except asyncio.TimeoutError:
-        logger.info(f"Reaction timeout reached for message ID {poll_message.id}")
-    finally:
-        # Retrieve vote counts
-        poll_info = waiting_polls.pop(poll_message.id, None)
-        if poll_info:
-            upvotes = poll_info['upvotes']
-            downvotes = poll_info['downvotes']
-            retry_count = poll_info.get('retry', 0)
-        else:
-            upvotes = downvotes = 0
+    # Store the poll before adding reactions so early votes are not missed
+    poll_info = {
+        'task_id': task_id,
+        'channel_id': channel_id,
+        'embed': embed.to_dict(),
+        'upvotes': 0,
+        'downvotes': 0,
+        'retry': 0,
+        'deadline': time.time() + POLL_TIMEOUT,
+    }
+    redis_client.hset(POLL_STATE_KEY, poll_message.id, json.dumps(poll_info))
 
-        poll_result = {
-            'upvotes': upvotes,
-            'downvotes': downvotes,
-            'retry': retry_count
-        }
-        redis_client.set(f"discord_poll_result:{task_id}", json.dumps(poll_result))
-        redis_client.expire(f"discord_poll_result:{task_id}", 60)
-
-        # Update the embed based on poll results
-        if retry_count > 0:
-            embed.color = discord.Color.dark_grey()
-            embed.set_footer(text="Okay, I'll try again!")
-        elif upvotes > downvotes:
-            embed.color = discord.Color.green()
-            embed.set_footer(text="Thanks for confirming! I'll update the site now.")
-        elif downvotes > upvotes:
-            embed.color = discord.Color.red()
-            embed.set_footer(text="Okay, I won't update the site then.")
-        else:
-            embed.color = discord.Color.orange()
-            embed.set_footer(text="No confirmation received, I'll create a revision.")
-
-        await poll_message.edit(embed=embed)
+    await outbound.add_reactions(poll_message, ['✅', '❌', '🔄'])
 
 @bot.command(name="manual_sync_commands", hidden=True)
 @commands.is_owner()
-async def manual_sync_commands(ctx):
+async def manual_sync_commands(ctx, scope: str = 'global'):
     try:
-        logger.info("Syncing commands...")       
-        ctx.bot.tree.remove_command(submit_hero_review)  
-        ctx.bot.tree.remove_command(submit_hero_story)
-        ctx.bot.tree.remove_command(submit_hero_portrait)
-        ctx.bot.tree.remove_command(submit_hero_illustration)
-        ctx.bot.tree.remove_command(submit_hero_bio)
-        ctx.bot.tree.remove_command(submit_hero_stats)
-        ctx.bot.tree.remove_command(submit_merch_information)
-        ctx.bot.tree.remove_command(submit_card_information)
-        ctx.bot.tree.remove_command(submit_relic_information)
-        ctx.bot.tree.remove_command(submit_accessory_information)        
-        ctx.bot.tree.remove_command(submit_costume)
-        ctx.bot.tree.remove_command(add_new_hero)
-        ctx.bot.tree.remove_command(add_new_item)
-        ctx.bot.tree.add_command(add_new_item)
-        ctx.bot.tree.add_command(add_new_hero)
-        ctx.bot.tree.add_command(submit_costume)
-        ctx.bot.tree.add_command(submit_accessory_information)
-        ctx.bot.tree.add_command(submit_relic_information)        
-        ctx.bot.tree.add_command(submit_card_information)        
-        ctx.bot.tree.add_command(submit_merch_information)        
-        ctx.bot.tree.add_command(submit_hero_stats)
-        ctx.bot.tree.add_command(submit_hero_illustration)
-        ctx.bot.tree.add_command(submit_hero_bio)
-        ctx.bot.tree.add_command(submit_hero_portrait)
-        ctx.bot.tree.add_command(submit_hero_story)
-        ctx.bot.tree.add_command(submit_hero_review)
-        await ctx.bot.tree.sync()
+        guild = discord.Object(id=GUILD_ID) if scope == 'guild' else None
+        await sync_command_tree(ctx.bot.tree, guild=guild, force=True)
         await ctx.send("Commands synced successfully.")
-        logger.info("Commands synced successfully!")
     except Exception as e:
         logger.error(f"Error syncing commands: {e}")
         await ctx.send("Error syncing commands.")
@@ -405,7 +465,7 @@ async def submit_hero_story(interaction: discord.Interaction, hero: str, image:
     if dropdown_options is None:
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
-        await interaction.followup.send("No hero data found. Please try again later.")
+        await send_followup(interaction, "No hero data found. Please try again later.")
         return
     # Get the hero title from the slug
     hero_title = hero_name_mapping.get(hero, "Unknown Hero")
@@ -450,7 +510,7 @@ async def submit_hero_story(interaction: discord.Interaction, hero: str, image:
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_hero_story.autocomplete('hero')
@@ -460,7 +520,7 @@ async def story_hero_name_autocomplete(interaction: discord.Interaction, current
         logger.info("No hero data found, trying to reload...")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("There was a problem getting the list of heroes. Please try again later.")
+            await send_followup(interaction, "There was a problem getting the list of heroes. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -518,7 +578,7 @@ async def submit_hero_portrait(interaction: discord.Interaction, hero: str, imag
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_hero_portrait.autocomplete('hero')
@@ -528,7 +588,7 @@ async def portrait_hero_name_autocomplete(interaction: discord.Interaction, curr
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -586,7 +646,7 @@ async def submit_hero_bio(interaction: discord.Interaction, hero: str, image: di
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_hero_bio.autocomplete('hero')
@@ -596,7 +656,7 @@ async def bio_hero_name_autocomplete(interaction: discord.Interaction, current:
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -653,7 +713,7 @@ async def submit_hero_stats(interaction: discord.Interaction, hero: str, image:
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_hero_stats.autocomplete('hero')
@@ -663,7 +723,7 @@ async def stats_hero_name_autocomplete(interaction: discord.Interaction, current
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -721,7 +781,7 @@ async def submit_hero_illustration(interaction: discord.Interaction, hero: str,
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_hero_illustration.autocomplete('hero')
@@ -731,7 +791,7 @@ async def illustration_hero_name_autocomplete(interaction: discord.Interaction,
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -789,7 +849,7 @@ async def submit_weapon_information(interaction: discord.Interaction, name: str,
         embed.set_image(url=f"attachment://{filename}")
 
         # Send the embed with the attached image
-        await interaction.followup.send(embed=embed, file=discord_file)
+        await send_followup(interaction, embed=embed, file=discord_file)
 
 # Autocomplete function for hero
 @submit_weapon_information.autocomplete('name')
@@ -799,7 +859,7 @@ async def weapon_information_autocomplete(interaction: discord.Interaction, curr
         logger.info("No item data found, trying to reload...")
         item_options, item_name_mapping = fetch_item_data()
         if item_options is None: 
-            await interaction.followup.send("There was a problem getting the list of items. Please try again later.")
+            await send_followup(interaction, "There was a problem getting the list of items. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -829,9 +889,9 @@ async def add_new_hero(interaction: discord.Interaction, title: str, name: str):
         # Raise an exception if the response contains an error
         response.raise_for_status()
         # Send a confirmation message
-        await interaction.followup.send(f"**Hero:** {name} created! Please allow 2-3 minutes for lists to update.")
+        await send_followup(interaction, f"**Hero:** {name} created! Please allow 2-3 minutes for lists to update.")
     else:
-        await interaction.followup.send(f"**Hero:** {name}\nHero already exists.")
+        await send_followup(interaction, f"**Hero:** {name}\nHero already exists.")
 
 # Define the slash command
 @app_commands.command(name="add_new_item", description="Add a new blank item to the site.")
@@ -851,9 +911,9 @@ async def add_new_item(interaction: discord.Interaction, name: str):
         # Raise an exception if the response contains an error
         response.raise_for_status()
         # Send a confirmation message
-        await interaction.followup.send(f"**Item:** {name} created! Please allow 2-3 minutes for lists to update.")
+        await send_followup(interaction, f"**Item:** {name} created! Please allow 2-3 minutes for lists to update.")
     else:
-        await interaction.followup.send(f"**Item:** {name}\nItem already exists.")
+        await send_followup(interaction, f"**Item:** {name}\nItem already exists.")
 
 @app_commands.command(name="submit_hero_review", description="Update a hero's review on the site.")
 @app_commands.describe(hero="Select a hero", message="Provide a Discord message ID to learn from")
@@ -873,7 +933,7 @@ async def submit_hero_review(interaction: discord.Interaction, hero: str, messag
             'channel_id': interaction.channel.id,
             'message': content,
         }))
-        await interaction.followup.send(f"Thanks for submitting information about **{hero_title}**! It will be reviewed shortly.")
+        await send_followup(interaction, f"Thanks for submitting information about **{hero_title}**! It will be reviewed shortly.")
 
 # Autocomplete function for hero
 @submit_hero_review.autocomplete('hero')
@@ -883,7 +943,7 @@ async def review_hero_autocomplete(interaction: discord.Interaction, current: st
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return
     # Suggest hero names based on user input
     suggestions = []
@@ -1009,7 +1069,7 @@ async def submit_costume(interaction: discord.Interaction, image: discord.Attach
     embed.set_image(url=f"attachment://{filename}")
 
     # Send the embed with the attached image
-    await interaction.followup.send(embed=embed, file=discord_file)
+    await send_followup(interaction, embed=embed, file=discord_file)
 
 @submit_costume.autocomplete('hero')
 async def costume_hero_name_autocomplete(interaction: discord.Interaction, current: str):
@@ -1018,7 +1078,7 @@ async def costume_hero_name_autocomplete(interaction: discord.Interaction, curre
         logger.info("No hero data found, please try again.")
         dropdown_options, hero_name_mapping = fetch_hero_data()
         if dropdown_options is None: 
-            await interaction.followup.send("No hero data found. Please try again later.")
+            await send_followup(interaction, "No hero data found. Please try again later.")
             return    
     suggestions = []
     for slug, title in dropdown_options:
@@ -1035,7 +1095,7 @@ async def costume_item_name_autocomplete(interaction: discord.Interaction, curre
         logger.info("No item data found, trying to reload...")
         item_options, item_name_mapping = fetch_item_data()
         if item_options is None: 
-            await interaction.followup.send("There was a problem getting the list of items. Please try again later.")
+            await send_followup(interaction, "There was a problem getting the list of items. Please try again later.")
             return    
     suggestions = []
     for slug, title in item_options:
@@ -1069,7 +1129,7 @@ async def costume_item_type_name_autocomplete(interaction: discord.Interaction,
         logger.info("No item types found, trying to reload...")
         item_types = fetch_item_data()
         if item_types is None: 
-            await interaction.followup.send("There was a problem getting the list of item types. Please try again later.")
+            await send_followup(interaction, "There was a problem getting the list of item types. Please try again later.")
             return    
     suggestions = []
     for item_type in item_types:
@@ -1079,4 +1139,204 @@ async def costume_item_type_name_autocomplete(interaction: discord.Interaction,
                 break
     return suggestions
 
+# S3 folder for each screen type accepted by the bulk command
+bulk_screen_folders = {
+    'Story': 'hero-stories',
+    'Bio': 'hero-bios',
+    'Stats': 'hero-stats',
+    'Portrait': 'hero-portraits',
+    'Illustration': 'hero-illustrations',
+}
+MAX_BULK_ZIP_IMAGES = 50
+# Uncompressed size limits for zip entries, per image and for the whole
+# command, checked before anything is unpacked
+MAX_BULK_ENTRY_BYTES = 20 * 2**20
+MAX_BULK_TOTAL_BYTES = 200 * 2**20
+BULK_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+def resolve_hero_slug(name: str):
+    """Match a file name against the cached hero slugs and titles."""
+    candidate = name.strip().lower()
+    for slug, title in dropdown_options:
+        if candidate in (slug.lower(), title.lower(), title.lower().replace(' ', '-')):
+            return slug
+    return None
+
+def expand_bulk_files(filename: str, file_content: bytes, budget: int = MAX_BULK_TOTAL_BYTES, limit: int = MAX_BULK_ZIP_IMAGES):
+    """Return (files, rejected): (filename, content) pairs, unpacking zip archives,
+    and (name, reason) pairs for whatever couldn't be unpacked.
+
+    Entries are checked against the sizes in the zip's directory before they're
+    read, and zipfile never inflates an entry past its recorded size, so a zip
+    bomb can't use more than ``budget`` bytes. At most ``limit`` images are
+    taken from the archive.
+    """
+    if not filename.lower().endswith('.zip'):
+        return [(filename, file_content)], []
+    files = []
+    rejected = []
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(file_content))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+        logger.warning(f"Could not open bulk upload archive {filename}: {e}")
+        return [], [(filename, "not a readable zip file")]
+    with archive:
+        for entry in archive.infolist():
+            entry_name = os.path.basename(entry.filename)
+            if entry.is_dir() or entry_name.startswith('.') or not entry_name.lower().endswith(BULK_IMAGE_EXTENSIONS):
+                continue
+            if len(files) >= limit:
+                rejected.append((entry_name, f"over the {MAX_BULK_ZIP_IMAGES} image limit"))
+                continue
+            if entry.file_size > min(MAX_BULK_ENTRY_BYTES, budget):
+                rejected.append((entry_name, "too large to unpack"))
+                continue
+            try:
+                content = archive.read(entry)
+            except RuntimeError:
+                # zipfile raises RuntimeError for encrypted entries
+                rejected.append((entry_name, "encrypted"))
+                continue
+            except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError) as e:
+                logger.warning(f"Could not unpack {entry_name} from {filename}: {e}")
+                rejected.append((entry_name, "could not be unpacked"))
+                continue
+            budget -= entry.file_size
+            files.append((entry_name, content))
+    return files, rejected
+
+@app_commands.command(name="submit_hero_bulk", description="Upload up to 10 hero screenshots (or a zip file) of the same type at once.")
+@app_commands.describe(
+    screen="Select the type of screenshot",
+    image1="Attach an image or a zip file of images",
+    hero="Select a hero, or leave empty to use each file's name as the hero",
+    region="Select a region for portraits and illustrations",
+)
+async def submit_hero_bulk(
+    interaction: discord.Interaction,
+    screen: Literal['Story', 'Bio', 'Stats', 'Portrait', 'Illustration'],
+    image1: discord.Attachment,
+    hero: str = '',
+    region: Literal['Global', 'Japan'] = 'Global',
+    image2: discord.Attachment = None,
+    image3: discord.Attachment = None,
+    image4: discord.Attachment = None,
+    image5: discord.Attachment = None,
+    image6: discord.Attachment = None,
+    image7: discord.Attachment = None,
+    image8: discord.Attachment = None,
+    image9: discord.Attachment = None,
+    image10: discord.Attachment = None,
+):
+    # Acknowledge the interaction
+    await interaction.response.defer(thinking=True)
+
+    attachments = [a for a in (image1, image2, image3, image4, image5, image6, image7, image8, image9, image10) if a is not None]
+    contents = await asyncio.gather(*(attachment.read() for attachment in attachments))
+
+    files = []
+    not_unpacked = []
+    # Both limits hold across every attachment, not per zip file
+    budget = MAX_BULK_TOTAL_BYTES
+    zip_images = MAX_BULK_ZIP_IMAGES
+    for attachment, file_content in zip(attachments, contents):
+        expanded, rejected = expand_bulk_files(attachment.filename, file_content, budget, zip_images)
+        files.extend(expanded)
+        not_unpacked.extend(rejected)
+        budget -= sum(len(content) for _, content in expanded)
+        if attachment.filename.lower().endswith('.zip'):
+            zip_images -= len(expanded)
+
+    folder = bulk_screen_folders[screen]
+    uploads = []
+    skipped = []
+    for filename, file_content in files:
+        name, file_extension = os.path.splitext(filename)
+        slug = hero or resolve_hero_slug(name)
+        if slug is None:
+            skipped.append(filename)
+            continue
+
+        # Same key format as the single-image commands
+        guid = str(uuid.uuid4())
+        if screen in ('Portrait', 'Illustration'):
+            new_filename = f"{slug}_{region}_{guid}{file_extension}"
+        else:
+            new_filename = f"{slug}_{guid}{file_extension}"
+        uploads.append((slug, f"{folder}/{new_filename}", file_content))
+
+    # Upload the images to S3 in parallel; each one is picked up as its own processing job
+    s3_client = boto3.client(
+        's3',
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION,
+    )
+    results = await asyncio.gather(
+        *(asyncio.to_thread(s3_client.put_object, Bucket=AWS_S3_BUCKET, Key=key, Body=file_content) for _, key, file_content in uploads),
+        return_exceptions=True,
+    )
+
+    uploaded_heroes = {}
+    failed = []
+    for (slug, key, _), result in zip(uploads, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to upload image to S3: {key}: {result}")
+            failed.append(key.split('/')[-1])
+            continue
+        logger.info(f"Uploaded image to S3: {key}")
+        uploaded_heroes[slug] = uploaded_heroes.get(slug, 0) + 1
+
+    # One summary embed instead of a confirmation per image
+    uploaded_count = sum(uploaded_heroes.values())
+    embed = discord.Embed(
+        title=f"Hero {screen} Bulk Upload",
+        description=f"{uploaded_count} of {len(files)} images uploaded successfully!"
+    )
+    if uploaded_heroes:
+        embed.add_field(
+            name="Heroes",
+            value="\n".join(f"{hero_name_mapping.get(slug, slug)} ({count})" for slug, count in sorted(uploaded_heroes.items()))[:1024],
+            inline=False,
+        )
+    if skipped:
+        embed.add_field(name="Unknown hero", value="\n".join(skipped)[:1024], inline=False)
+    if failed:
+        embed.add_field(name="Upload failed", value="\n".join(failed)[:1024], inline=False)
+    if not_unpacked:
+        embed.add_field(name="Not unpacked", value="\n".join(f"{name}: {reason}" for name, reason in not_unpacked)[:1024], inline=False)
+
+    embed.color = discord.Color.green() if uploaded_count == len(files) and not not_unpacked else discord.Color.orange()
+
+    await send_followup(interaction, embed=embed)
+
+@submit_hero_bulk.autocomplete('hero')
+async def bulk_hero_name_autocomplete(interaction: discord.Interaction, current: str):
+    suggestions = []
+    for slug, title in dropdown_options:
+        if current.lower() in title.lower():
+            suggestions.append(app_commands.Choice(name=title, value=slug))
+            if len(suggestions) >= 25:
+                break
+    return suggestions
+
+# Slash commands registered with the command tree at startup
+slash_commands = [
+    submit_hero_review,
+    submit_hero_illustration,
+    submit_hero_bio,
+    submit_hero_portrait,
+    submit_hero_story,
+    submit_hero_stats,
+    submit_hero_bulk,
+    submit_weapon_information,
+    submit_merch_information,
+    submit_card_information,
+    submit_relic_information,
+    submit_accessory_information,
+    submit_costume,
+    add_new_hero,
+    add_new_item,
+]
+
 bot.run(DISCORD_TOKEN)
\ No newline at end of file
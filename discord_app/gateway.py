@@ -0,0 +1,33 @@
+import os
+import discord
+
+# Message cache size used in lean mode; polls are tracked through raw events,
+# so the cache only has to cover prefix commands and recent sends
+LEAN_MAX_MESSAGES = int(os.environ.get('DISCORD_LEAN_MAX_MESSAGES', 100))
+
+def lean_mode_enabled():
+    return os.environ.get('DISCORD_LEAN_MODE', '0').lower() in ('1', 'true', 'yes')
+
+def gateway_options(lean: bool):
+    """Return the intents and cache settings passed to the bot's constructor."""
+    if not lean:
+        intents = discord.Intents.default()
+        intents.members = True
+        intents.guilds = True
+        intents.reactions = True
+        intents.message_content = True
+        return {'intents': intents}
+
+    # Only what slash commands, prefix commands and poll reactions need
+    intents = discord.Intents.none()
+    intents.guilds = True  # Channel cache used by get_channel
+    intents.guild_messages = True  # Prefix commands such as !refresh
+    intents.guild_reactions = True  # Poll votes
+    intents.message_content = True  # Prefix commands and hero review messages
+
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+        'max_messages': LEAN_MAX_MESSAGES,
+    }
@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import discord
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers are sent first
+INTERACTIVE = 0
+POLL = 1
+
+# Minimum spacing between requests on the same route, in seconds. Messages and
+# edits share Discord's per-channel message bucket (5 per 5 s), while reactions
+# have their own bucket of roughly one every 0.25 s per channel.
+ROUTE_INTERVALS = {
+    'messages': 1.0,
+    'reactions': 0.3,
+    'interaction': 0.0,
+}
+
+class OutboundQueue:
+    """Single scheduler for the bot's outbound Discord requests.
+
+    Each route (for example the messages of one channel) has its own priority
+    queue and is paced to stay inside Discord's rate limit buckets instead of
+    relying on discord.py's hidden 429 retries. Workers only ever take a job
+    from a route that's free to send, choosing by the priority of each route's
+    next job, so interaction follow-ups overtake poll traffic and a backlog on
+    one channel can't hold workers that others need.
+    """
+
+    def __init__(self, workers: int = 4, route_intervals: dict = None):
+        self.workers = workers
+        self.route_intervals = route_intervals or ROUTE_INTERVALS
+        # Routes ready to send, by the priority of their next job
+        self._ready = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._routes = {}
+        self._busy = set()
+        self._paused = set()
+        self._next_allowed = {}
+        self._tasks = []
+        self._stats = {
+            'sent': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'in_flight': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+        }
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, route: tuple, send, priority: int = POLL):
+        """Queue ``send`` (a no-argument coroutine function) and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._routes.setdefault(route, []), (priority, next(self._sequence), time.monotonic(), send, future))
+        self._schedule(route)
+        return await future
+
+    async def add_reactions(self, message: discord.Message, emojis, priority: int = POLL):
+        """Add several reactions to a message as one paced job on the reaction route."""
+        interval = self.route_intervals.get('reactions', 0.0)
+
+        async def send():
+            for index, emoji in enumerate(emojis):
+                if index:
+                    await asyncio.sleep(interval)
+                await message.add_reaction(emoji)
+
+        return await self.submit(('reactions', message.channel.id), send, priority)
+
+    def metrics(self):
+        sent = self._stats['sent'] + self._stats['failed']
+        return {
+            'queue_depth': sum(len(jobs) for jobs in self._routes.values()),
+            'in_flight': self._stats['in_flight'],
+            'sent': self._stats['sent'],
+            'failed': self._stats['failed'],
+            'rate_limited': self._stats['rate_limited'],
+            'avg_wait_ms': round(self._stats['total_wait'] / sent * 1000, 1) if sent else 0.0,
+            'max_wait_ms': round(self._stats['max_wait'] * 1000, 1),
+        }
+
+    def _schedule(self, route):
+        """Offer a route to the workers once it's idle, has jobs and is past its pacing interval."""
+        jobs = self._routes.get(route)
+        if not jobs or route in self._busy or route in self._paused:
+            return
+        delay = self._next_allowed.get(route, 0.0) - time.monotonic()
+        if delay > 0:
+            # Come back when the route may send again, rather than have a worker wait on it
+            self._paused.add(route)
+            asyncio.get_running_loop().call_later(delay, self._resume, route)
+            return
+        priority, sequence = jobs[0][:2]
+        self._ready.put_nowait((priority, sequence, route))
+
+    def _resume(self, route):
+        self._paused.discard(route)
+        self._schedule(route)
+
+    async def _worker(self):
+        while True:
+            _, _, route = await self._ready.get()
+            jobs = self._routes.get(route)
+            # A route can be offered more than once; only the first taker sends,
+            # and stale offers for a route that must wait are dropped
+            if not jobs or route in self._busy or route in self._paused:
+                continue
+            if self._next_allowed.get(route, 0.0) > time.monotonic():
+                self._schedule(route)
+                continue
+            _, _, queued_at, send, future = heapq.heappop(jobs)
+            if not jobs:
+                del self._routes[route]
+            self._busy.add(route)
+            try:
+                await self._process(queued_at, route, send, future)
+            finally:
+                self._busy.discard(route)
+                self._schedule(route)
+
+    async def _process(self, queued_at, route, send, future):
+        wait = time.monotonic() - queued_at
+        self._stats['total_wait'] += wait
+        self._stats['max_wait'] = max(self._stats['max_wait'], wait)
+        self._stats['in_flight'] += 1
+        interval = self.route_intervals.get(route[0], 0.0)
+        try:
+            result = await send()
+            self._stats['sent'] += 1
+            if not future.done():
+                future.set_result(result)
+        except discord.HTTPException as e:
+            self._stats['failed'] += 1
+            if e.status == 429:
+                self._stats['rate_limited'] += 1
+                retry_after = float(e.response.headers.get('Retry-After', 1.0))
+                logger.warning(f"Rate limited on route {route}, backing off {retry_after}s")
+                interval = max(interval, retry_after)
+            if not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            self._stats['failed'] += 1
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._stats['in_flight'] -= 1
+            self._next_allowed[route] = time.monotonic() + interval
@@ -0,0 +1,83 @@
+"""A local stand-in for the OpenAI Files and Batches endpoints.
+
+Batches complete as soon as they're created. Each request is answered with a
+placeholder that matches its response_format schema (zeros, empty strings,
+empty arrays, the first enum option), so the backfill path can be exercised
+end to end without an API key.
+
+    python tests/openai_batch_stub.py [port]
+    OPENAI_BASE_URL=http://localhost:8089/v1 python -m celery_app.tasks.backfill hero-stories
+"""
+import sys
+import json
+import time
+import uuid
+from flask import Flask, request, jsonify, Response
+
+app = Flask(__name__)
+files = {}
+batches = {}
+
+def placeholder(schema):
+    if 'enum' in schema:
+        return schema['enum'][0]
+    return {
+        'object': lambda: {name: placeholder(sub) for name, sub in schema.get('properties', {}).items()},
+        'array': lambda: [],
+        'string': lambda: '',
+        'integer': lambda: 0,
+        'number': lambda: 0,
+        'boolean': lambda: False,
+    }[schema.get('type', 'object')]()
+
+def answer(body):
+    response_format = body.get('response_format') or {}
+    schema = response_format.get('json_schema', {}).get('schema', {'type': 'object'})
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'model': body.get('model', ''),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': json.dumps(placeholder(schema))}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+    }
+
+@app.post('/v1/files')
+def upload_file():
+    file_id = f"file-{uuid.uuid4().hex}"
+    files[file_id] = request.files['file'].read().decode('utf-8')
+    return jsonify({'id': file_id, 'object': 'file', 'purpose': request.form.get('purpose')})
+
+@app.get('/v1/files/<file_id>/content')
+def file_content(file_id):
+    return Response(files[file_id], mimetype='application/jsonl')
+
+@app.post('/v1/batches')
+def create_batch():
+    body = request.get_json()
+    lines = [json.loads(line) for line in files[body['input_file_id']].splitlines() if line.strip()]
+    output = [
+        json.dumps({'id': f"batch_req_{uuid.uuid4().hex}", 'custom_id': line['custom_id'], 'response': {'status_code': 200, 'body': answer(line['body'])}, 'error': None})
+        for line in lines
+    ]
+    output_file_id = f"file-{uuid.uuid4().hex}"
+    files[output_file_id] = '\n'.join(output)
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    batches[batch_id] = {
+        'id': batch_id,
+        'object': 'batch',
+        'endpoint': body['endpoint'],
+        'input_file_id': body['input_file_id'],
+        'output_file_id': output_file_id,
+        'status': 'completed',
+        'created_at': int(time.time()),
+        'request_counts': {'total': len(lines), 'completed': len(lines), 'failed': 0},
+        'metadata': body.get('metadata'),
+    }
+    return jsonify(batches[batch_id])
+
+@app.get('/v1/batches/<batch_id>')
+def get_batch(batch_id):
+    return jsonify(batches[batch_id])
+
+if __name__ == '__main__':
+    app.run(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8089)
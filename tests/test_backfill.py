@@ -0,0 +1,46 @@
+import io
+import json
+import pytest
+from celery_app.schema import response_format
+from celery_app.prompts.hero_story_prompt import story_schema
+
+backfill = pytest.importorskip('celery_app.tasks.backfill')
+
+def story_request(custom_id):
+    body = {
+        'model': 'gpt-4o-mini',
+        'messages': [{'role': 'user', 'content': 'story'}],
+        'response_format': response_format('hero_story', story_schema),
+    }
+    return json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body})
+
+def test_stub_batch_results_are_read_back() -> None:
+    pytest.importorskip('flask')
+    from tests.openai_batch_stub import app
+
+    client = app.test_client()
+    upload = client.post('/v1/files', data={
+        'purpose': 'batch',
+        'file': (io.BytesIO('\n'.join([story_request('0'), story_request('1')]).encode('utf-8')), 'backfill.jsonl'),
+    })
+    batch = client.post('/v1/batches', json={
+        'input_file_id': upload.get_json()['id'],
+        'endpoint': '/v1/chat/completions',
+        'completion_window': '24h',
+    }).get_json()
+    assert client.get(f"/v1/batches/{batch['id']}").get_json()['status'] in backfill.FINISHED_STATUSES
+
+    output = client.get(f"/v1/files/{batch['output_file_id']}/content").get_data(as_text=True)
+    results = [json.loads(line) for line in output.splitlines() if line.strip()]
+    assert sorted(result['custom_id'] for result in results) == ['0', '1']
+    assert all(json.loads(backfill.result_content(result, story_schema)) == {'story': ''} for result in results)
+
+def test_failed_requests_have_no_content() -> None:
+    errored = {'custom_id': '0', 'response': None, 'error': {'code': 'server_error', 'message': 'failed'}}
+    rejected = {'custom_id': '1', 'response': {'status_code': 400, 'body': {'error': {'message': 'bad request'}}}, 'error': None}
+    assert backfill.result_content(errored, story_schema) is None
+    assert backfill.result_content(rejected, story_schema) is None
+
+def test_output_not_matching_the_schema_is_skipped() -> None:
+    body = {'choices': [{'message': {'content': json.dumps({'story': 3})}}]}
+    assert backfill.result_content({'custom_id': '0', 'response': {'status_code': 200, 'body': body}}, story_schema) is None
@@ -0,0 +1,35 @@
+import io
+import numpy as np
+from PIL import Image
+from celery_app.decoding import open_image, decode_region
+
+BOX = (200, 150, 520, 470)
+
+def screenshot(format):
+    # Smooth gradients, so JPEG's reduced decode stays close to a scaled full one
+    x, y = np.meshgrid(np.linspace(0, 255, 960), np.linspace(0, 255, 720))
+    pixels = np.stack([x, y, (x + y) / 2], axis=-1).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=format)
+    return buffer.getvalue()
+
+def test_png_region_matches_a_full_crop() -> None:
+    content = screenshot('PNG')
+    expected = open_image(content).crop(BOX)
+    region = decode_region(open_image(content), BOX, 64)
+    assert region.size == expected.size
+    assert np.array_equal(np.asarray(region), np.asarray(expected))
+
+def test_jpeg_region_matches_a_full_crop() -> None:
+    content = screenshot('JPEG')
+    expected = open_image(content).crop(BOX)
+    assert np.array_equal(np.asarray(decode_region(open_image(content), BOX)), np.asarray(expected))
+
+def test_reduced_jpeg_region_matches_a_scaled_full_crop() -> None:
+    content = screenshot('JPEG')
+    region = decode_region(open_image(content), BOX, 80)
+    # 320px wide region, so a 1/4 scale decode still keeps 80px
+    assert region.size == (80, 80)
+    expected = open_image(content).crop(BOX).resize(region.size, Image.BOX)
+    difference = np.abs(np.asarray(region, dtype=int) - np.asarray(expected, dtype=int))
+    assert difference.mean() < 3
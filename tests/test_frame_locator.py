@@ -0,0 +1,48 @@
+import io
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+frame_locator = pytest.importorskip('celery_app.frame_locator')
+
+def screenshot(width, height, box, seed):
+    """A noisy screen with a costume frame at ``box``, holding different art each time."""
+    rng = np.random.default_rng(seed)
+    background = rng.integers(40, 90, (height // 8, width // 8), dtype=np.uint8)
+    img = Image.fromarray(background).resize((width, height), Image.BILINEAR).convert('RGB')
+    left, top, right, bottom = box
+    side = right - left
+    art = rng.integers(0, 255, (8, 8, 3), dtype=np.uint8)
+    img.paste(Image.fromarray(art).resize((side, side), Image.NEAREST), (left, top))
+    draw = ImageDraw.Draw(img)
+    border = round(side * 0.06)
+    draw.rectangle(box, outline=(235, 205, 120), width=border)
+    draw.rectangle((left + border, top + border, right - border, bottom - border), outline=(20, 20, 30), width=max(1, border // 2))
+    # A corner ornament, so the ring isn't symmetrical
+    draw.rectangle((left, top, left + side // 5, top + border * 2), fill=(250, 240, 200))
+    return img
+
+def encoded(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_frame_off_the_fixed_ratios_is_located(tmp_path, monkeypatch) -> None:
+    # Template cut from a screenshot the fixed ratios crop correctly
+    reference = tmp_path / 'reference.png'
+    screenshot(1280, 720, frame_locator.fixed_box(1280, 720), seed=1).save(reference)
+    template_path = tmp_path / 'costume_frame.png'
+    frame_locator.build_template(str(reference), output_path=str(template_path))
+    monkeypatch.setattr(frame_locator, '_template', None)
+    frame_locator.load_template(str(template_path))
+
+    # A wider screen with the frame pushed right and down, and drawn smaller
+    box = (760, 250, 980, 470)
+    assert frame_locator.fixed_box(1600, 720) != box
+    located = frame_locator.locate_frame(encoded(screenshot(1600, 720, box, seed=2)))
+    assert located is not None
+    assert all(abs(found - expected) <= 8 for found, expected in zip(located, box))
+
+def test_missing_template_falls_back(monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr(frame_locator, '_template', None)
+    assert frame_locator.load_template(str(tmp_path / 'missing.png')) is None
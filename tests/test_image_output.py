@@ -0,0 +1,56 @@
+import io
+import base64
+import hashlib
+import numpy as np
+import pytest
+from PIL import Image
+from celery_app.image_output import EncodedImage, parse_settings, parse_sizes, upload_files, save_jpeg
+
+def test_parse_settings_reads_integers() -> None:
+    assert parse_settings('quality=80, progressive=0,') == {'quality': 80, 'progressive': 0}
+
+def test_encoded_image_shares_one_buffer() -> None:
+    data = b'\x89PNG\r\n\x1a\nnot really a png'
+    encoded = EncodedImage(data, 'PNG')
+    assert base64.b64decode(encoded.base64()) == data
+    assert encoded.sha256 == hashlib.sha256(data).hexdigest()
+    name, stream, mime_type = encoded.upload('aoba')
+    assert (name, mime_type) == ('aoba.png', 'image/png')
+    assert stream.read() == data
+    # Each upload gets its own position in the same bytes
+    assert encoded.stream().read() == data
+
+def test_busy_art_falls_back_to_a_baseline_jpeg() -> None:
+    # Noise at quality 92 and 4:4:4 needs more than the byte per pixel Pillow allows
+    noise = Image.fromarray(np.random.default_rng(0).integers(0, 256, (512, 512, 3), dtype=np.uint8))
+    encoded = EncodedImage.encode(noise)
+    img = Image.open(io.BytesIO(encoded.data))
+    assert (img.format, img.size) == ('JPEG', (512, 512))
+    assert 'progressive' not in img.info
+
+class FullDisk(io.BytesIO):
+    def write(self, data):
+        raise OSError('No space left on device')
+
+def test_other_save_errors_are_raised() -> None:
+    with pytest.raises(OSError, match='No space left'):
+        save_jpeg(Image.new('RGB', (64, 64)), FullDisk(), {'quality': 92, 'progressive': 1, 'optimize': 1})
+
+def test_parse_sizes_reads_hard_crops() -> None:
+    assert parse_sizes('thumbnail=150x150c, medium_large=768x0') == {
+        'thumbnail': (150, 150, True),
+        'medium_large': (768, 0, False),
+    }
+
+def test_derivatives_are_uploaded_under_their_own_names() -> None:
+    files = upload_files(EncodedImage(b'jpeg', 'JPEG'), {
+        'image_webp': EncodedImage(b'webp', 'WEBP'),
+        'thumbnail': EncodedImage(b'jpeg', 'JPEG'),
+        'thumbnail_webp': EncodedImage(b'webp', 'WEBP'),
+    }, 'aoba')
+    assert {field: (name, mime_type) for field, (name, _, mime_type) in files.items()} == {
+        'image': ('aoba.jpg', 'image/jpeg'),
+        'image_webp': ('aoba.webp', 'image/webp'),
+        'thumbnail': ('aoba-thumbnail.jpg', 'image/jpeg'),
+        'thumbnail_webp': ('aoba-thumbnail.webp', 'image/webp'),
+    }
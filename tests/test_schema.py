@@ -0,0 +1,40 @@
+from celery_app.schema import obj, array, enum, validate, invalid_fields, sub_schema, parse_json, prompt_options
+from celery_app.prompts.stat_prompt import stat_prompt, stat_schema, STAT_OPTIONS
+
+def valid_stats():
+    stats = {name: 0 for name in stat_schema['properties']}
+    stats['compatible_equipment'] = ['Bow']
+    stats['passives'] = [{'affects_party': True, 'stat': 'Atk', 'value': 10}]
+    return stats
+
+def test_valid_stats_have_no_errors() -> None:
+    assert validate(valid_stats(), stat_schema) == []
+
+def test_invalid_fields_are_reported_by_top_level_name() -> None:
+    stats = valid_stats()
+    stats['atk'] = '1,200'
+    stats['passives'][0]['stat'] = 'Attack'
+    del stats['hp']
+    assert invalid_fields(validate(stats, stat_schema)) == ['hp', 'atk', 'passives']
+
+def test_booleans_are_not_integers() -> None:
+    schema = obj({'value': {'type': 'integer'}})
+    assert validate({'value': True}, schema) == [('value', 'expected integer, got bool')]
+
+def test_sub_schema_only_requires_the_given_fields() -> None:
+    schema = sub_schema(stat_schema, ['atk', 'passives'])
+    assert schema['required'] == ['atk', 'passives']
+    assert validate({'atk': 1, 'passives': []}, schema) == []
+
+def test_prompt_options_reads_the_stat_list() -> None:
+    assert STAT_OPTIONS[0] == 'Atk'
+    assert 'Crit Hit Multiplier' in STAT_OPTIONS
+    assert prompt_options(stat_prompt, 'No such heading') == []
+
+def test_parse_json_strips_code_fences() -> None:
+    assert parse_json('```json\n{"atk": 1}\n```') == {'atk': 1}
+    assert parse_json('{"atk": 1}') == {'atk': 1}
+
+def test_nested_paths() -> None:
+    schema = obj({'lines': array(obj({'stat': enum(['Atk'])}))})
+    assert validate({'lines': [{'stat': 'Atk'}, {'stat': 'Def'}]}, schema) == [('lines[1].stat', "'Def' is not one of the allowed values")]
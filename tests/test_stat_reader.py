@@ -0,0 +1,50 @@
+import io
+import json
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+stat_reader = pytest.importorskip('celery_app.stat_reader')
+
+ROWS = {
+    'atk': [0.60, 0.20, 0.90, 0.28],
+    'def': [0.60, 0.32, 0.90, 0.40],
+    'hp': [0.60, 0.44, 0.90, 0.52],
+}
+
+def stats_screen(values):
+    """A stats screen with black bars either side and each value drawn in its row."""
+    img = Image.new('RGB', (1600, 720), (0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    left, right = 160, 1440
+    draw.rectangle((left, 0, right - 1, 719), fill=(70, 76, 96))
+    font = ImageFont.load_default(size=34)
+    for name, text in values.items():
+        box = ROWS[name]
+        x = left + (right - left) * box[0] + 4
+        y = 720 * box[1] + 4
+        draw.text((x, y), text, fill=(240, 236, 220), font=font)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_glyphs_built_from_one_screen_read_another(tmp_path, monkeypatch) -> None:
+    glyph_dir = tmp_path / 'glyphs'
+    glyph_dir.mkdir()
+    (glyph_dir / 'layout.json').write_text(json.dumps({'rows': ROWS}))
+    # Between them the known values show every digit
+    known = {'atk': '1,234', 'def': '567', 'hp': '8,901'}
+    screenshot = tmp_path / 'known.png'
+    screenshot.write_bytes(stats_screen(known))
+    values = tmp_path / 'values.json'
+    values.write_text(json.dumps(known))
+    stat_reader.build_glyphs(str(screenshot), str(values), glyph_dir=str(glyph_dir))
+
+    monkeypatch.setattr(stat_reader, '_glyph_set', stat_reader.load_glyph_set(str(glyph_dir)))
+    stats, confidence = stat_reader.read_stats(stats_screen({'atk': '9,876', 'def': '540', 'hp': '3,012'}))
+    assert stats == {'atk': 9876, 'def': 540, 'hp': 3012}
+    assert confidence >= stat_reader.MIN_CONFIDENCE
+
+def test_missing_glyph_set_leaves_reading_to_the_model(tmp_path, monkeypatch) -> None:
+    assert stat_reader.load_glyph_set(str(tmp_path)) is None
+    monkeypatch.setattr(stat_reader, '_glyph_set', False)
+    assert stat_reader.read_stats(stats_screen({'atk': '1,234'})) is None